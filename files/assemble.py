@@ -23,6 +23,10 @@ import os.path
 import shutil
 import tempfile
 import re
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 DOCUMENTATION = '''
 ---
@@ -79,6 +83,17 @@ options:
         U(http://docs.python.org/2/library/re.html).
     required: false
     default: null
+  checksum_cache:
+    description:
+      - Reuse the checksum of the existing I(dest) recorded by an earlier run (of this or the copy,
+        stat and get_url modules) while its inode, size, mtime and ctime are unchanged.
+      - Also record the name, size and mtime of the fragments used under C(~/.ansible/assemble),
+        along with the checksum of the result. While they and I(dest) are unchanged, later runs
+        with the same I(src), I(delimiter) and I(regexp) don't assemble the fragments again.
+    required: false
+    default: "no"
+    choices: [ "yes", "no" ]
+    version_added: "2.0"
 author: Stephen Fromm
 extends_documentation_fragment: files
 '''
@@ -92,47 +107,200 @@ EXAMPLES = '''
 '''
 
 # ===========================================
-# Support method
+# Checksum cache, shared with the copy, stat, assemble and get_url modules.
+# Digests are stored in one small file per inode, and are only reused while
+# the inode, size, mtime and ctime of the file are unchanged
 
-def assemble_from_fragments(src_path, delimiter=None, compiled_regexp=None):
-    ''' assemble a file from a directory of fragments '''
-    tmpfd, temp_path = tempfile.mkstemp()
-    tmp = os.fdopen(tmpfd,'w')
-    delimit_me = False
-    add_newline = False
+CHECKSUM_CACHE_DIR = '~/.ansible/checksums'
+
+def checksum_cache_path(st):
+    return os.path.join(os.path.expanduser(CHECKSUM_CACHE_DIR), '%d-%d' % (st.st_dev, st.st_ino))
 
+def checksum_cache_stamp(st):
+    return [st.st_ino, st.st_size, st.st_mtime, st.st_ctime]
+
+def load_cached_digests(st):
+    try:
+        infile = open(checksum_cache_path(st))
+        try:
+            entry = json.load(infile)
+        finally:
+            infile.close()
+    except (IOError, ValueError):
+        return {}
+    if not isinstance(entry, dict) or entry.pop('stamp', None) != checksum_cache_stamp(st):
+        return {}
+    return entry
+
+def cache_digests(path, digests):
+    '''
+    Record digests of a file which are already known, such as after it
+    was replaced with content whose digests were computed
+    '''
+    try:
+        st = os.stat(path)
+        cache_dir = os.path.expanduser(CHECKSUM_CACHE_DIR)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0700)
+        entry = load_cached_digests(st)
+        entry.update(digests)
+        entry['stamp'] = checksum_cache_stamp(st)
+        fd, tmp = tempfile.mkstemp(prefix='.checksum-', dir=cache_dir)
+        outfile = os.fdopen(fd, 'w')
+        try:
+            json.dump(entry, outfile)
+        finally:
+            outfile.close()
+        os.rename(tmp, checksum_cache_path(st))
+    except (IOError, OSError):
+        # the cache is only an optimization
+        pass
+
+def file_digests(path, algorithms, use_cache=False):
+    '''
+    Return a dict of the hex digests of a file for the requested algorithms,
+    reading the file once for all of them. Algorithms which are not available
+    (such as md5 in FIPS mode) are left out. With use_cache, digests cached
+    by earlier runs are reused and new ones are added to the cache
+    '''
+    algorithms = [a for a in algorithms if a in AVAILABLE_HASH_ALGORITHMS]
+    digests = {}
+    if use_cache:
+        st = os.stat(path)
+        cached = load_cached_digests(st)
+        for algorithm in algorithms:
+            if algorithm in cached:
+                digests[algorithm] = cached[algorithm]
+
+    missing = [(a, AVAILABLE_HASH_ALGORITHMS[a]()) for a in algorithms if a not in digests]
+    if missing:
+        infile = open(path, 'rb')
+        try:
+            while True:
+                block = infile.read(64 * 1024)
+                if not block:
+                    break
+                for (algorithm, digest) in missing:
+                    digest.update(block)
+        finally:
+            infile.close()
+        for (algorithm, digest) in missing:
+            digests[algorithm] = digest.hexdigest()
+        # don't cache digests of a file which changed while it was read
+        if use_cache and checksum_cache_stamp(os.stat(path)) == checksum_cache_stamp(st):
+            cache_digests(path, digests)
+    return digests
+
+# ===========================================
+# Fragment manifests. The fragments a dest was assembled from are recorded
+# with the digests of the result, so an unchanged set of fragments doesn't
+# have to be assembled again while dest wasn't touched either
+
+MANIFEST_DIR = '~/.ansible/assemble'
+
+def manifest_path(src, dest, delimiter, regexp):
+    # tasks assembling other fragments into the same dest keep their own
+    key = AVAILABLE_HASH_ALGORITHMS['sha1'](json.dumps([os.path.abspath(src), os.path.abspath(dest),
+                                                        delimiter, regexp])).hexdigest()
+    return os.path.join(os.path.expanduser(MANIFEST_DIR), '%s.json' % key)
+
+def list_fragments(src_path, compiled_regexp=None):
+    ''' return the (name, size, mtime) of the fragments to assemble, in order '''
+    fragments = []
     for f in sorted(os.listdir(src_path)):
         if compiled_regexp and not compiled_regexp.search(f):
             continue
         fragment = "%s/%s" % (src_path, f)
         if not os.path.isfile(fragment):
             continue
-        fragment_content = file(fragment).read()
-
-        # always put a newline between fragments if the previous fragment didn't end with a newline.
-        if add_newline:
-            tmp.write('\n')
-
-        # delimiters should only appear between fragments
-        if delimit_me:
-            if delimiter:
-                # un-escape anything like newlines
-                delimiter = delimiter.decode('unicode-escape')
-                tmp.write(delimiter)
-                # always make sure there's a newline after the
-                # delimiter, so lines don't run together
-                if delimiter[-1] != '\n':
-                    tmp.write('\n')
-
-        tmp.write(fragment_content)
-        delimit_me = True
-        if fragment_content.endswith('\n'):
-            add_newline = False
-        else:
-            add_newline = True
-
-    tmp.close()
-    return temp_path
+        st = os.stat(fragment)
+        fragments.append([f, st.st_size, st.st_mtime])
+    return fragments
+
+def load_manifest(src, dest, delimiter, regexp):
+    try:
+        infile = open(manifest_path(src, dest, delimiter, regexp))
+        try:
+            return json.load(infile)
+        finally:
+            infile.close()
+    except (IOError, ValueError):
+        return None
+
+def save_manifest(src, dest, delimiter, regexp, manifest):
+    try:
+        manifest_dir = os.path.expanduser(MANIFEST_DIR)
+        if not os.path.isdir(manifest_dir):
+            os.makedirs(manifest_dir, 0700)
+        manifest['stamp'] = checksum_cache_stamp(os.stat(dest))
+        fd, tmp = tempfile.mkstemp(prefix='.assemble-', dir=manifest_dir)
+        outfile = os.fdopen(fd, 'w')
+        try:
+            json.dump(manifest, outfile)
+        finally:
+            outfile.close()
+        os.rename(tmp, manifest_path(src, dest, delimiter, regexp))
+    except (IOError, OSError):
+        # the manifest is only an optimization
+        pass
+
+# ===========================================
+# Support method
+
+def assemble_from_fragments(src_path, fragments, delimiter=None, algorithms=()):
+    '''
+    assemble a file from a directory of fragments, copying them in chunks
+    and computing the digests of the result while it is written
+    '''
+    tmpfd, temp_path = tempfile.mkstemp()
+    tmp = os.fdopen(tmpfd,'w')
+    digests = [(a, AVAILABLE_HASH_ALGORITHMS[a]()) for a in algorithms if a in AVAILABLE_HASH_ALGORITHMS]
+    delimit_me = False
+    add_newline = False
+
+    def write(data):
+        tmp.write(data)
+        for (algorithm, digest) in digests:
+            digest.update(data)
+
+    if delimiter:
+        # un-escape anything like newlines
+        delimiter = delimiter.decode('unicode-escape')
+
+    try:
+        for (f, size, mtime) in fragments:
+            # always put a newline between fragments if the previous fragment didn't end with a newline.
+            if add_newline:
+                write('\n')
+
+            # delimiters should only appear between fragments
+            if delimit_me:
+                if delimiter:
+                    write(delimiter)
+                    # always make sure there's a newline after the
+                    # delimiter, so lines don't run together
+                    if delimiter[-1] != '\n':
+                        write('\n')
+
+            last_block = ''
+            fragment = open("%s/%s" % (src_path, f), 'rb')
+            try:
+                while True:
+                    block = fragment.read(64 * 1024)
+                    if not block:
+                        break
+                    write(block)
+                    last_block = block
+            finally:
+                fragment.close()
+            delimit_me = True
+            if last_block.endswith('\n'):
+                add_newline = False
+            else:
+                add_newline = True
+    finally:
+        tmp.close()
+    return temp_path, dict([(a, d.hexdigest()) for (a, d) in digests])
 
 # ==============================================================
 # main
@@ -148,6 +316,7 @@ def main():
             backup=dict(default=False, type='bool'),
             remote_src=dict(default=False, type='bool'),
             regexp = dict(required=False),
+            checksum_cache = dict(default=False, type='bool'),
         ),
         add_file_common_args=True
     )
@@ -175,11 +344,30 @@ def main():
         except re.error, e:
             module.fail_json(msg="Invalid Regexp (%s) in \"%s\"" % (e, regexp))
 
-    path = assemble_from_fragments(src, delimiter, compiled_regexp)
-    path_hash = module.sha1(path)
+    checksum_cache = module.params['checksum_cache']
+    fragments = list_fragments(src, compiled_regexp)
+    manifest = dict(fragments=fragments, delimiter=delimiter, regexp=regexp)
 
-    if os.path.exists(dest):
-        dest_hash = module.sha1(dest)
+    path = None
+    path_digests = None
+    previous = None
+    if checksum_cache:
+        previous = load_manifest(src, dest, delimiter, regexp)
+    if previous is not None and os.path.exists(dest):
+        stamp = previous.pop('stamp', None)
+        digests = previous.pop('digests', None)
+        if previous == manifest and stamp == checksum_cache_stamp(os.stat(dest)):
+            # same fragments and dest was last written from them
+            path_digests = digests
+            dest_hash = digests.get('sha1')
+
+    if path_digests is None:
+        path, path_digests = assemble_from_fragments(src, fragments, delimiter, ['sha1', 'md5'])
+
+        if os.path.exists(dest):
+            dest_hash = file_digests(dest, ['sha1'], checksum_cache)['sha1']
+
+    path_hash = path_digests['sha1']
 
     if path_hash != dest_hash:
         if backup and dest_hash is not None:
@@ -188,15 +376,19 @@ def main():
         changed = True
 
     # Backwards compat.  This won't return data if FIPS mode is active
-    try:
-        pathmd5 = module.md5(path)
-    except ValueError:
-        pathmd5 = None
+    pathmd5 = path_digests.get('md5')
 
-    os.remove(path)
+    if path is not None:
+        os.remove(path)
 
     file_args = module.load_file_common_arguments(module.params)
     changed = module.set_fs_attributes_if_different(file_args, changed)
+
+    if checksum_cache:
+        cache_digests(dest, path_digests)
+        manifest['digests'] = path_digests
+        save_manifest(src, dest, delimiter, regexp, manifest)
+
     # Mission complete
     module.exit_json(src=src, dest=dest, md5sum=pathmd5, checksum=path_hash, changed=changed, msg="OK")
 
@@ -20,6 +20,13 @@
 
 import os
 import time
+import pwd
+import grp
+import tempfile
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 DOCUMENTATION = '''
 ---
@@ -85,10 +92,35 @@ options:
         already existed.
     required: false
     version_added: "1.5"
+  checksum_cache:
+    description:
+      - Reuse the checksum of an existing I(dest) recorded by an earlier run (of this or the stat,
+        assemble and get_url modules) while its inode, size, mtime and ctime are unchanged,
+        instead of reading it again. The cache is kept in C(~/.ansible/checksums) on the remote host.
+    required: false
+    default: "no"
+    choices: [ "yes", "no" ]
+    version_added: "2.0"
+  manifest:
+    description:
+      - A list of files to manage below I(dest) in a single invocation, used for recursive copies.
+        Each item is a dict with the C(path) of the file relative to I(dest), the sha1 C(checksum)
+        of its content and optionally C(mode), C(owner) and C(group) (defaulting to the module
+        options) and C(src), the remote path of the already transferred content.
+      - Items whose content differs from the checksum and which have no C(src) are left alone
+        and returned in C(needed), so the content only has to be transferred for those.
+        Items with a C(src) are moved into place, and attributes are applied to all items.
+      - Missing directories are created once each, with I(directory_mode).
+      - I(backup) and I(validate) apply to each file whose content is replaced.
+      - Items whose path leads outside of I(dest), such as through a symlink below it, are refused.
+    required: false
+    default: null
+    version_added: "2.0"
 extends_documentation_fragment: files
 author: Michael DeHaan
 notes:
-   - The "copy" module recursively copy facility does not scale to lots (>hundreds) of files.
+   - The "copy" module recursively copy facility does not scale to lots (>hundreds) of files
+     unless the whole tree is handled with I(manifest).
      For alternative, see synchronize module, which is a wrapper around rsync.
 '''
 
@@ -110,6 +142,21 @@ EXAMPLES = '''
 '''
 
 RETURN = '''
+needed:
+    description: paths from the manifest whose content differs and which had no src
+    returned: when manifest is used
+    type: list
+    sample: [ "conf.d/site.conf" ]
+updated:
+    description: paths from the manifest whose content was replaced
+    returned: when manifest is used
+    type: list
+    sample: [ "conf.d/default.conf" ]
+backup_files:
+    description: paths from the manifest and the name of the backup file created for each
+    returned: when manifest is used and if backup=yes
+    type: dict
+    sample: { "conf.d/default.conf": "/etc/app/conf.d/default.conf.2015-02-12@22:09~" }
 dest:
     description: destination file/path
     returned: success
@@ -172,6 +219,91 @@ state:
     sample: "file"
 '''
 
+# ===========================================
+# Checksum cache, shared with the copy, stat, assemble and get_url modules.
+# Digests are stored in one small file per inode, and are only reused while
+# the inode, size, mtime and ctime of the file are unchanged
+
+CHECKSUM_CACHE_DIR = '~/.ansible/checksums'
+
+def checksum_cache_path(st):
+    return os.path.join(os.path.expanduser(CHECKSUM_CACHE_DIR), '%d-%d' % (st.st_dev, st.st_ino))
+
+def checksum_cache_stamp(st):
+    return [st.st_ino, st.st_size, st.st_mtime, st.st_ctime]
+
+def load_cached_digests(st):
+    try:
+        infile = open(checksum_cache_path(st))
+        try:
+            entry = json.load(infile)
+        finally:
+            infile.close()
+    except (IOError, ValueError):
+        return {}
+    if not isinstance(entry, dict) or entry.pop('stamp', None) != checksum_cache_stamp(st):
+        return {}
+    return entry
+
+def cache_digests(path, digests):
+    '''
+    Record digests of a file which are already known, such as after it
+    was replaced with content whose digests were computed
+    '''
+    try:
+        st = os.stat(path)
+        cache_dir = os.path.expanduser(CHECKSUM_CACHE_DIR)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0700)
+        entry = load_cached_digests(st)
+        entry.update(digests)
+        entry['stamp'] = checksum_cache_stamp(st)
+        fd, tmp = tempfile.mkstemp(prefix='.checksum-', dir=cache_dir)
+        outfile = os.fdopen(fd, 'w')
+        try:
+            json.dump(entry, outfile)
+        finally:
+            outfile.close()
+        os.rename(tmp, checksum_cache_path(st))
+    except (IOError, OSError):
+        # the cache is only an optimization
+        pass
+
+def file_digests(path, algorithms, use_cache=False):
+    '''
+    Return a dict of the hex digests of a file for the requested algorithms,
+    reading the file once for all of them. Algorithms which are not available
+    (such as md5 in FIPS mode) are left out. With use_cache, digests cached
+    by earlier runs are reused and new ones are added to the cache
+    '''
+    algorithms = [a for a in algorithms if a in AVAILABLE_HASH_ALGORITHMS]
+    digests = {}
+    if use_cache:
+        st = os.stat(path)
+        cached = load_cached_digests(st)
+        for algorithm in algorithms:
+            if algorithm in cached:
+                digests[algorithm] = cached[algorithm]
+
+    missing = [(a, AVAILABLE_HASH_ALGORITHMS[a]()) for a in algorithms if a not in digests]
+    if missing:
+        infile = open(path, 'rb')
+        try:
+            while True:
+                block = infile.read(64 * 1024)
+                if not block:
+                    break
+                for (algorithm, digest) in missing:
+                    digest.update(block)
+        finally:
+            infile.close()
+        for (algorithm, digest) in missing:
+            digests[algorithm] = digest.hexdigest()
+        # don't cache digests of a file which changed while it was read
+        if use_cache and checksum_cache_stamp(os.stat(path)) == checksum_cache_stamp(st):
+            cache_digests(path, digests)
+    return digests
+
 def split_pre_existing_dir(dirname):
     '''
     Return the first pre-existing directory and a list of the new directories that will be created.
@@ -199,6 +331,134 @@ def adjust_recursive_directory_permissions(pre_existing_dir, new_directory_list,
     return changed
 
 
+def resolve_id(cache, name, lookup):
+    '''
+    Resolve an owner or group name to a numeric id once per name, so
+    set_fs_attributes_if_different doesn't look it up for every file
+    '''
+    if name is None:
+        return None
+    if name not in cache:
+        try:
+            cache[name] = str(int(name))
+        except ValueError:
+            try:
+                cache[name] = str(lookup(name)[2])
+            except KeyError:
+                # leave the name, so the error is reported as usual
+                cache[name] = name
+    return cache[name]
+
+
+def is_inside(real_dest, path):
+    ''' Whether path, once its symlinks are resolved, is dest or below it '''
+    path = os.path.realpath(path)
+    return path == real_dest or path.startswith(real_dest.rstrip('/') + '/')
+
+
+def copy_manifest(module, dest, manifest):
+    '''
+    Handle a whole tree of files in one pass: find which ones differ,
+    move in the content of those which were transferred, create missing
+    directories once each and apply the attributes
+    '''
+    checksum_cache = module.params['checksum_cache']
+    force = module.params['force']
+    backup = module.params['backup']
+    validate = module.params['validate']
+    changed = False
+    needed = []
+    updated = []
+    backup_files = {}
+    uids = {}
+    gids = {}
+
+    if not os.path.isabs(dest):
+        module.fail_json(msg="dest must be an absolute path when using manifest", dest=dest)
+    if validate and "%s" not in validate:
+        module.fail_json(msg="validate must contain %%s: %s" % (validate))
+    real_dest = os.path.realpath(dest)
+
+    common_args = module.load_file_common_arguments(module.params)
+    directory_args = dict(common_args)
+    directory_args['mode'] = module.params['directory_mode']
+    directory_args['owner'] = resolve_id(uids, directory_args['owner'], pwd.getpwnam)
+    directory_args['group'] = resolve_id(gids, directory_args['group'], grp.getgrnam)
+    created = {}
+
+    for item in manifest:
+        if not isinstance(item, dict) or 'path' not in item or 'checksum' not in item:
+            module.fail_json(msg="manifest items must be dicts with a path and a checksum", item=item)
+        relpath = os.path.normpath(item['path'])
+        if os.path.isabs(relpath) or relpath == os.pardir or relpath.startswith(os.pardir + os.sep):
+            module.fail_json(msg="manifest paths must be relative to dest", path=item['path'])
+        path = os.path.join(dest, relpath)
+        # the parent could be a symlink leading out of dest
+        if not is_inside(real_dest, os.path.dirname(path)):
+            module.fail_json(msg="%s would be written outside of %s" % (item['path'], dest), path=item['path'])
+
+        exists = os.path.lexists(path)
+        if exists and os.path.isdir(path) and not os.path.islink(path):
+            module.fail_json(msg="%s is a directory, but the manifest has a file there" % path)
+        checksum_dest = None
+        replaced = False
+        if exists and os.path.isfile(path) and not os.path.islink(path):
+            checksum_dest = file_digests(path, ['sha1'], checksum_cache)['sha1']
+
+        if checksum_dest != item['checksum'] and (force or not exists):
+            src = item.get('src')
+            if not src:
+                needed.append(item['path'])
+                continue
+            src = os.path.expanduser(src)
+            if validate and not module.check_mode:
+                (rc,out,err) = module.run_command(validate % src)
+                if rc != 0:
+                    module.fail_json(msg="failed to validate %s: rc:%s error:%s" % (item['path'], rc, err))
+            # create missing parent directories once, the top most first,
+            # and only set the attributes of the ones created here
+            dirname = os.path.dirname(path)
+            if dirname not in created and not os.path.isdir(dirname):
+                (pre_existing_dir, new_directory_list) = split_pre_existing_dir(dirname)
+                working_dir = pre_existing_dir
+                for name in new_directory_list:
+                    working_dir = os.path.join(working_dir, name)
+                    created[working_dir] = True
+                    if module.check_mode:
+                        continue
+                    os.mkdir(working_dir)
+                    directory_args['path'] = working_dir
+                    module.set_fs_attributes_if_different(directory_args, False)
+                changed = True
+            created[dirname] = True
+            if not module.check_mode:
+                if backup and exists and not os.path.islink(path):
+                    backup_files[item['path']] = module.backup_local(path)
+                if os.path.islink(path):
+                    os.unlink(path)
+                module.atomic_move(src, path)
+            updated.append(item['path'])
+            replaced = True
+            changed = True
+
+        if not exists and (module.check_mode or not replaced):
+            continue
+        file_args = dict(common_args)
+        file_args['path'] = path
+        file_args['mode'] = item.get('mode', common_args['mode'])
+        file_args['owner'] = resolve_id(uids, item.get('owner', common_args['owner']), pwd.getpwnam)
+        file_args['group'] = resolve_id(gids, item.get('group', common_args['group']), grp.getgrnam)
+        changed = module.set_fs_attributes_if_different(file_args, changed)
+        if checksum_cache and not module.check_mode and \
+           (checksum_dest == item['checksum'] or replaced):
+            cache_digests(path, dict(sha1=item['checksum']))
+
+    res_args = dict(dest=dest, changed=changed, needed=needed, updated=updated)
+    if backup_files:
+        res_args['backup_files'] = backup_files
+    module.exit_json(**res_args)
+
+
 def main():
 
     module = AnsibleModule(
@@ -211,12 +471,20 @@ def main():
             backup            = dict(default=False, type='bool'),
             force             = dict(default=True, aliases=['thirsty'], type='bool'),
             validate          = dict(required=False, type='str'),
-            directory_mode    = dict(required=False)
+            directory_mode    = dict(required=False),
+            checksum_cache    = dict(default=False, type='bool'),
+            manifest          = dict(required=False, type='list'),
         ),
         add_file_common_args=True,
         supports_check_mode=True,
     )
 
+    if module.params['manifest'] is not None:
+        copy_manifest(module, os.path.expanduser(module.params['dest']), module.params['manifest'])
+
+    if module.params['src'] is None:
+        module.fail_json(msg="src is required unless manifest is used")
+
     src    = os.path.expanduser(module.params['src'])
     dest   = os.path.expanduser(module.params['dest'])
     backup = module.params['backup']
@@ -224,19 +492,18 @@ def main():
     original_basename = module.params.get('original_basename',None)
     validate = module.params.get('validate',None)
     follow = module.params['follow']
+    checksum_cache = module.params['checksum_cache']
 
     if not os.path.exists(src):
         module.fail_json(msg="Source %s failed to transfer" % (src))
     if not os.access(src, os.R_OK):
         module.fail_json(msg="Source %s not readable" % (src))
 
-    checksum_src = module.sha1(src)
+    digests_src = file_digests(src, ['sha1', 'md5'])
+    checksum_src = digests_src['sha1']
     checksum_dest = None
     # Backwards compat only.  This will be None in FIPS mode
-    try:
-        md5sum_src = module.md5(src)
-    except ValueError:
-        md5sum_src = None
+    md5sum_src = digests_src.get('md5')
 
     changed = False
 
@@ -265,8 +532,8 @@ def main():
             if original_basename:
                 basename = original_basename
             dest = os.path.join(dest, basename)
-        if os.access(dest, os.R_OK):
-            checksum_dest = module.sha1(dest)
+        if os.access(dest, os.R_OK) and os.path.isfile(dest):
+            checksum_dest = file_digests(dest, ['sha1'], checksum_cache)['sha1']
     else:
         if not os.path.exists(os.path.dirname(dest)):
             try:
@@ -315,6 +582,9 @@ def main():
     file_args = module.load_file_common_arguments(module.params)
     res_args['changed'] = module.set_fs_attributes_if_different(file_args, res_args['changed'])
 
+    if checksum_cache:
+        cache_digests(dest, digests_src)
+
     module.exit_json(**res_args)
 
 # import module snippets
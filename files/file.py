@@ -28,6 +28,16 @@ try:
 except ImportError:
     HAVE_SELINUX=False
 
+try:
+    from os import scandir
+    HAS_SCANDIR=True
+except ImportError:
+    try:
+        from scandir import scandir
+        HAS_SCANDIR=True
+    except ImportError:
+        HAS_SCANDIR=False
+
 DOCUMENTATION = '''
 ---
 module: file
@@ -123,27 +133,135 @@ def get_state(path):
 
     return 'absent'
 
+def resolve_owner_group(module, file_args):
+    ''' Resolve the owner and group to ids once, -1 when not set '''
+
+    uid = gid = -1
+    owner = file_args['owner']
+    group = file_args['group']
+    if owner is not None:
+        try:
+            uid = int(owner)
+        except ValueError:
+            try:
+                uid = pwd.getpwnam(owner).pw_uid
+            except KeyError:
+                module.fail_json(path=file_args['path'], msg='chown failed: failed to look up user %s' % owner)
+    if group is not None:
+        try:
+            gid = int(group)
+        except ValueError:
+            try:
+                gid = grp.getgrnam(group).gr_gid
+            except KeyError:
+                module.fail_json(path=file_args['path'], msg='chgrp failed: failed to look up group %s' % group)
+    return (uid, gid)
+
+def list_tree(path):
+    ''' Yield (path, lstat result) for everything below path, depth first '''
+
+    stack = [path]
+    while stack:
+        top = stack.pop()
+        try:
+            if HAS_SCANDIR:
+                entries = [(entry.path, entry.stat(follow_symlinks=False)) for entry in scandir(top)]
+            else:
+                entries = [(os.path.join(top, name), os.lstat(os.path.join(top, name))) for name in os.listdir(top)]
+        except OSError:
+            continue
+        for (fsname, st) in entries:
+            yield (fsname, st)
+            if stat.S_ISDIR(st.st_mode):
+                stack.append(fsname)
+
 def recursive_set_attributes(module, path, follow, file_args):
+    '''
+    Apply the owner, group and mode to everything below path, using the
+    lstat result of the walk and only issuing syscalls for entries that
+    differ. Returns (changed, number of entries examined, number of
+    entries changed)
+    '''
     changed = False
-    for root, dirs, files in os.walk(path):
-        for fsobj in dirs + files:
-            fsname = os.path.join(root, fsobj)
-            if not os.path.islink(fsname):
-                tmp_file_args = file_args.copy()
-                tmp_file_args['path']=fsname
-                changed |= module.set_fs_attributes_if_different(tmp_file_args, changed)
-            else:
+    examined = 0
+    modified = 0
+
+    (uid, gid) = resolve_owner_group(module, file_args)
+    mode = file_args['mode']
+    symbolic_mode = False
+    if mode is not None and not isinstance(mode, int):
+        try:
+            mode = int(mode, 8)
+        except ValueError:
+            symbolic_mode = True
+    context = None
+    if [c for c in file_args.get('secontext') or [] if c is not None]:
+        context = file_args['secontext']
+
+    for (fsname, st) in list_tree(path):
+        examined += 1
+        if stat.S_ISLNK(st.st_mode):
+            # symlinks need lchmod and may be followed, leave them to
+            # the generic code
+            tmp_file_args = file_args.copy()
+            tmp_file_args['path']=fsname
+            if module.set_fs_attributes_if_different(tmp_file_args, False):
+                changed = True
+                modified += 1
+            if follow:
+                fsname = os.path.join(os.path.dirname(fsname), os.readlink(fsname))
+                if os.path.isdir(fsname):
+                    (sub_changed, sub_examined, sub_modified) = recursive_set_attributes(module, fsname, follow, file_args)
+                    changed |= sub_changed
+                    examined += sub_examined
+                    modified += sub_modified
                 tmp_file_args = file_args.copy()
                 tmp_file_args['path']=fsname
-                changed |= module.set_fs_attributes_if_different(tmp_file_args, changed)
-                if follow:
-                    fsname = os.path.join(root, os.readlink(fsname))
-                    if os.path.isdir(fsname):
-                        changed |= recursive_set_attributes(module, fsname, follow, file_args)
-                    tmp_file_args = file_args.copy()
-                    tmp_file_args['path']=fsname
-                    changed |= module.set_fs_attributes_if_different(tmp_file_args, changed)
-    return changed
+                if module.set_fs_attributes_if_different(tmp_file_args, False):
+                    changed = True
+                    modified += 1
+            continue
+
+        entry_changed = False
+        if context is not None:
+            entry_changed = module.set_context_if_different(fsname, context, False)
+
+        new_uid = -1
+        new_gid = -1
+        if uid != -1 and st.st_uid != uid:
+            new_uid = uid
+        if gid != -1 and st.st_gid != gid:
+            new_gid = gid
+        if new_uid != -1 or new_gid != -1:
+            entry_changed = True
+            if not module.check_mode:
+                try:
+                    os.lchown(fsname, new_uid, new_gid)
+                except OSError:
+                    module.fail_json(path=fsname, msg='chown failed')
+                # chown may clear the setuid and setgid bits
+                st = os.lstat(fsname)
+
+        if mode is not None:
+            new_mode = mode
+            if symbolic_mode:
+                try:
+                    new_mode = module._symbolic_mode_to_octal(st, mode)
+                except Exception, e:
+                    module.fail_json(path=fsname, msg="mode must be in octal or symbolic form", details=str(e))
+            if stat.S_IMODE(st.st_mode) != new_mode:
+                entry_changed = True
+                if not module.check_mode:
+                    try:
+                        os.chmod(fsname, new_mode)
+                    except OSError, e:
+                        module.fail_json(path=fsname, msg='chmod failed', details=str(e))
+
+        if entry_changed:
+            changed = True
+            modified += 1
+
+    return (changed, examined, modified)
 
 def main():
 
@@ -290,7 +408,9 @@ def main():
         changed = module.set_fs_attributes_if_different(file_args, changed)
 
         if recurse:
-            changed |= recursive_set_attributes(module, file_args['path'], follow, file_args)
+            (recurse_changed, examined, modified) = recursive_set_attributes(module, file_args['path'], follow, file_args)
+            changed |= recurse_changed
+            module.exit_json(path=path, changed=changed, examined=examined, modified=modified)
 
         module.exit_json(path=path, changed=changed)
 
@@ -26,6 +26,29 @@ import fnmatch
 import time
 import re
 import shutil
+import threading
+import tempfile
+import Queue
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import xxhash
+    HAS_XXHASH = True
+except ImportError:
+    HAS_XXHASH = False
+
+try:
+    from os import scandir
+    HAS_SCANDIR = True
+except ImportError:
+    try:
+        from scandir import scandir
+        HAS_SCANDIR = True
+    except ImportError:
+        HAS_SCANDIR = False
 
 
 DOCUMENTATION = '''
@@ -91,6 +114,7 @@ options:
         choices: [ True, False ]
         description:
             - Set this to true to include hidden files, otherwise they'll be ignored.
+              Hidden directories are not descended into either unless this is set.
     follow:
         required: false
         default: "False"
@@ -102,7 +126,46 @@ options:
         default: "False"
         choices: [ True, False ]
         description:
-            - Set this to true to retrieve a file's sha1 checksum
+            - Set this to true to retrieve a file's checksum, see I(checksum_algorithm)
+    checksum_algorithm:
+        required: false
+        default: "sha1"
+        choices: [ "sha1", "sha224", "sha256", "sha384", "sha512", "md5", "xxhash" ]
+        version_added: "2.0"
+        description:
+            - The algorithm used for the checksums when I(get_checksum) is set.
+              C(xxhash) requires the xxhash python library on the remote host.
+    checksum_cache:
+        required: false
+        default: null
+        version_added: "2.0"
+        description:
+            - Path to a file on the remote host where checksums are cached between runs, keyed by the
+              device, inode, size and mtime of each file, so unchanged files are not read again.
+              The cache only keeps the files matched by the last run, so use a separate cache file
+              for each find task.
+    excludes:
+        required: false
+        default: null
+        version_added: "2.0"
+        description:
+            - One or more (shell type) file glob patterns. Files and directories whose basenames match
+              any of them are skipped, and matching directories are not descended into.
+    max_depth:
+        required: false
+        default: null
+        version_added: "2.0"
+        description:
+            - When recursing, the maximum number of directory levels to look at below each path.
+              Entries directly inside a path are at depth 1, so C(max_depth=1) is the same as not recursing.
+    workers:
+        required: false
+        default: 1
+        version_added: "2.0"
+        description:
+            - Number of threads used to walk the paths and to compute checksums. When recursing,
+              the directories directly inside each path are walked in parallel as well. The order
+              of the results does not depend on the number of workers.
 '''
 
 
@@ -118,6 +181,13 @@ EXAMPLES = '''
 
 # find /var/log files equal or greater than 10 megabytes ending with .log or .log.gz
 - find: paths="/var/tmp" patterns="*.log","*.log.gz" size="10m"
+
+# verify artifacts with sha256, only reading files which changed since the last run
+- find: paths="/srv/artifacts" recurse=yes get_checksum=yes checksum_algorithm=sha256
+        checksum_cache=/var/cache/artifacts.checksums workers=4
+
+# find .log files in a large tree using 8 threads, skipping archived logs
+- find: paths="/srv/logs" patterns="*.log" excludes="archive" recurse=yes workers=8
 '''
 
 RETURN = '''
@@ -147,14 +217,18 @@ examined:
     sample: 34
 '''
 
+def compile_patterns(patterns):
+    '''compile a list of glob patterns into a single regex, None matches everything'''
+    if not patterns or '*' in patterns:
+        return None
+    return re.compile('|'.join(['(?:%s)' % fnmatch.translate(p) for p in patterns]))
+
+
 def pfilter(f, patterns=None):
-    '''filter using glob patterns'''
+    '''filter using a compiled pattern regex'''
     if patterns is None:
         return True
-    for p in patterns:
-        if fnmatch.fnmatch(f, p):
-             return True
-    return False
+    return patterns.match(f) is not None
 
 
 def agefilter(st, now, age, timestamp):
@@ -211,6 +285,233 @@ def statinfo(st):
     }
 
 
+class ListdirEntry(object):
+    '''a minimal stand in for scandir entries, for pythons without scandir'''
+
+    def __init__(self, root, name):
+        self.name = name
+        self.path = os.path.join(root, name)
+        self._lstat = None
+        self._stat = None
+
+    def _get_lstat(self):
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        return self._lstat
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self._get_lstat().st_mode)
+
+    def stat(self):
+        if self._stat is None:
+            if self.is_symlink():
+                self._stat = os.stat(self.path)
+            else:
+                self._stat = self._get_lstat()
+        return self._stat
+
+    def is_dir(self):
+        try:
+            return stat.S_ISDIR(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def is_file(self):
+        try:
+            return stat.S_ISREG(self.stat().st_mode)
+        except OSError:
+            return False
+
+
+def list_entries(path):
+    '''return the entries of a directory, or an empty list if it can't be read'''
+    try:
+        if HAS_SCANDIR:
+            return list(scandir(path))
+        return [ListdirEntry(path, name) for name in os.listdir(path)]
+    except OSError:
+        return []
+
+
+class Walker(object):
+    '''match the entries of directory trees against the find criteria'''
+
+    def __init__(self, params, age, size, now):
+        self.params = params
+        self.patterns = compile_patterns(params['patterns'])
+        self.excludes = None
+        if params['excludes']:
+            self.excludes = compile_patterns(params['excludes'])
+        self.age = age
+        self.size = size
+        self.now = now
+
+    def match(self, entry):
+        '''return the result dict for an entry if it matches, None otherwise'''
+        params = self.params
+        if not pfilter(entry.name, self.patterns):
+            return None
+        try:
+            if params['file_type'] == 'directory':
+                if not entry.is_dir():
+                    return None
+                st = entry.stat()
+                if not agefilter(st, self.now, self.age, params['age_stamp']):
+                    return None
+            else:
+                if not entry.is_file():
+                    return None
+                st = entry.stat()
+                if not agefilter(st, self.now, self.age, params['age_stamp']) or \
+                   not sizefilter(st, self.size):
+                    return None
+        except OSError:
+            # the entry went away or is a broken symlink
+            return None
+        r = {'path': os.path.normpath(entry.path)}
+        r.update(statinfo(st))
+        return r
+
+    def scan(self, path, depth):
+        '''
+        look at the entries of a single directory, returning the matches,
+        the subdirectories to descend into and the number of entries seen
+        '''
+        params = self.params
+        entries = list_entries(path)
+        descend = params['recurse'] and (params['max_depth'] is None or depth < params['max_depth'])
+        files = []
+        dirs = []
+        subdirs = []
+        for entry in entries:
+            if entry.name.startswith('.') and not params['hidden']:
+                continue
+            if self.excludes is not None and self.excludes.match(entry.name):
+                continue
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            r = self.match(entry)
+            if is_dir:
+                if r is not None:
+                    dirs.append(r)
+                if descend and (params['follow'] or not entry.is_symlink()):
+                    subdirs.append(entry.path)
+            elif r is not None:
+                files.append(r)
+        return (files + dirs, subdirs, len(entries))
+
+    def walk(self, path, depth=1):
+        '''walk a tree depth first, returning the matches and the number of entries seen'''
+        matches = []
+        looked = 0
+        stack = [(path, depth)]
+        while stack:
+            (path, depth) = stack.pop()
+            (found, subdirs, seen) = self.scan(path, depth)
+            matches.extend(found)
+            looked += seen
+            subdirs.reverse()
+            for subdir in subdirs:
+                stack.append((subdir, depth + 1))
+        return (matches, looked)
+
+
+def run_parallel(func, units, workers):
+    '''call func for each unit using a pool of threads, returning the results in order'''
+    results = [None] * len(units)
+    errors = []
+    queue = Queue.Queue()
+    for i in range(len(units)):
+        queue.put(i)
+
+    def worker():
+        while True:
+            try:
+                i = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = func(*units[i])
+            except Exception, e:
+                errors.append(e)
+
+    threads = []
+    for i in range(min(workers, len(units))):
+        t = threading.Thread(target=worker)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def new_digest(algorithm):
+    if algorithm == 'xxhash':
+        return xxhash.xxh64()
+    return AVAILABLE_HASH_ALGORITHMS[algorithm]()
+
+
+def checksum_file(path, algorithm):
+    '''return the hex digest of a file'''
+    digest = new_digest(algorithm)
+    infile = open(path, 'rb')
+    try:
+        while True:
+            block = infile.read(1024 * 1024)
+            if not block:
+                break
+            digest.update(block)
+    finally:
+        infile.close()
+    return digest.hexdigest()
+
+
+class ChecksumCache(object):
+    '''checksums of files keyed by algorithm, device, inode, size and mtime'''
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.used = {}
+        try:
+            infile = open(path)
+            try:
+                self.entries = json.load(infile)
+            finally:
+                infile.close()
+        except (IOError, ValueError):
+            # missing or unreadable caches just start out empty
+            pass
+
+    def key(self, r, algorithm):
+        return '%s:%d:%d:%d:%r' % (algorithm, r['dev'], r['inode'], r['size'], r['mtime'])
+
+    def get(self, key):
+        checksum = self.entries.get(key)
+        if checksum is not None:
+            self.used[key] = checksum
+        return checksum
+
+    def set(self, key, checksum):
+        self.used[key] = checksum
+
+    def save(self, module):
+        '''replace the cache with the checksums used by this run'''
+        if self.used == self.entries:
+            return
+        fd, tmp = tempfile.mkstemp(prefix='.find-', dir=os.path.dirname(os.path.abspath(self.path)))
+        outfile = os.fdopen(fd, 'w')
+        try:
+            json.dump(self.used, outfile)
+        finally:
+            outfile.close()
+        module.atomic_move(tmp, self.path)
+
+
 def main():
     module = AnsibleModule(
         argument_spec = dict(
@@ -224,6 +525,11 @@ def main():
             hidden        = dict(default="False", type='bool'),
             follow        = dict(default="False", type='bool'),
             get_checksum  = dict(default="False", type='bool'),
+            checksum_algorithm = dict(default="sha1", choices=['sha1', 'sha224', 'sha256', 'sha384', 'sha512', 'md5', 'xxhash'], type='str'),
+            checksum_cache = dict(default=None, type='str'),
+            excludes      = dict(default=None, type='list'),
+            max_depth     = dict(default=None, type='int'),
+            workers       = dict(default=1, type='int'),
         ),
     )
 
@@ -256,39 +562,75 @@ def main():
     now = time.time()
     msg = ''
     looked = 0
+    walker = Walker(params, age, size, now)
+    workers = max(1, params['workers'])
+
+    # each path is a unit of work, and when walking in parallel so is
+    # each directory directly inside a path, once the path itself has
+    # been scanned. The matches are collected in slots so they end up
+    # in the same order as when walking serially
+    slots = []
+    units = []
     for npath in params['paths']:
         if os.path.isdir(npath):
-            for root,dirs,files in os.walk( npath, followlinks=params['follow'] ):
-
-                looked = looked + len(files) + len(dirs)
-                for fsobj in (files + dirs):
-                    fsname=os.path.normpath(os.path.join(root, fsobj))
-
-                    if os.path.basename(fsname).startswith('.') and not params['hidden']:
-                       continue
-
-                    st = os.stat(fsname)
-                    r = {'path': fsname}
-                    if stat.S_ISDIR(st.st_mode) and params['file_type'] == 'directory':
-                        if pfilter(fsobj, params['patterns']) and agefilter(st, now, age, params['age_stamp']):
-
-                            r.update(statinfo(st))
-                            filelist.append(r)
-
-                    elif stat.S_ISREG(st.st_mode) and params['file_type'] == 'file':
-                        if pfilter(fsobj, params['patterns']) and \
-                           agefilter(st, now, age, params['age_stamp']) and \
-                           sizefilter(st, size):
-
-                            r.update(statinfo(st))
-                            if params['get_checksum']:
-                                r['checksum'] = module.sha1(fsname)
-                            filelist.append(r)
-
-                if not params['recurse']:
-                    break
+            if workers > 1 and params['recurse']:
+                (found, subdirs, seen) = walker.scan(npath, 1)
+                slots.append(found)
+                looked += seen
+                for subdir in subdirs:
+                    units.append((len(slots), subdir, 2))
+                    slots.append(None)
+            else:
+                units.append((len(slots), npath, 1))
+                slots.append(None)
         else:
-            msg+="%s was skipped as it does not seem to be a valid directory or it cannot be accessed\n"
+            msg+="%s was skipped as it does not seem to be a valid directory or it cannot be accessed\n" % npath
+
+    def walk_unit(slot, path, depth):
+        (slots[slot], seen) = walker.walk(path, depth)
+        return seen
+
+    for seen in run_parallel(walk_unit, units, workers):
+        looked += seen
+    for found in slots:
+        filelist.extend(found)
+
+    if params['get_checksum']:
+        algorithm = params['checksum_algorithm']
+        if algorithm == 'xxhash' and not HAS_XXHASH:
+            module.fail_json(msg="The xxhash checksum algorithm requires the xxhash python library")
+        if algorithm != 'xxhash' and algorithm not in AVAILABLE_HASH_ALGORITHMS:
+            module.fail_json(msg="The %s checksum algorithm is not available on this host" % algorithm)
+
+        cache = None
+        if params['checksum_cache']:
+            cache = ChecksumCache(params['checksum_cache'])
+
+        todo = []
+        for r in filelist:
+            if not r['isreg']:
+                continue
+            if cache is not None:
+                r['checksum'] = cache.get(cache.key(r, algorithm))
+                if r['checksum'] is not None:
+                    continue
+            todo.append((r,))
+
+        def checksum(r):
+            r['checksum'] = checksum_file(r['path'], algorithm)
+            if cache is not None:
+                cache.set(cache.key(r, algorithm), r['checksum'])
+
+        try:
+            run_parallel(checksum, todo, workers)
+        except (IOError, OSError), e:
+            module.fail_json(msg="Could not checksum %s: %s" % (e.filename, e.strerror))
+
+        if cache is not None:
+            try:
+                cache.save(module)
+            except (IOError, OSError), e:
+                module.fail_json(msg="Could not write the checksum cache %s: %s" % (params['checksum_cache'], str(e)))
 
     matched = len(filelist)
     module.exit_json(files=filelist, changed=False, msg=msg, matched=matched, examined=looked)
@@ -28,8 +28,8 @@ description:
      - Manage (add, remove, change) individual settings in an INI-style file without having
        to manage the file as a whole with, say, M(template) or M(assemble). Adds missing
        sections if they don't exist.
-     - Comments are discarded when the source file is read, and therefore will not 
-       show up in the destination file.
+     - Comments, blank lines and the order of sections and options are kept, and
+       the file is only written when its contents change.
 version_added: "0.9"
 options:
   dest:
@@ -41,7 +41,8 @@ options:
     description:
       - Section name in INI file. This is added if C(state=present) automatically when
         a single value is being set.
-    required: true
+      - Required unless C(settings) is given.
+    required: false
     default: null
   option:
     description:
@@ -54,6 +55,17 @@ options:
      - the string value to be associated with an I(option). May be omitted when removing an I(option).
     required: false
     default: null
+  settings:
+    description:
+      - A hash of sections, each a hash of options and their values, that are all
+        changed with a single read and write of the file. Options whose value is
+        null are left alone.
+      - With C(state=absent), the options listed under each section are removed,
+        and sections given as null are removed as a whole.
+      - May not be used with C(section), C(option) or C(value).
+    required: false
+    default: null
+    version_added: "2.0"
   backup:
     description:
       - Create a backup file including the timestamp information so you can get
@@ -68,11 +80,10 @@ options:
 notes:
    - While it is possible to add an I(option) without specifying a I(value), this makes
      no sense.
-   - A section named C(default) cannot be added by the module, but if it exists, individual
-     options within the section can be updated. (This is a limitation of Python's I(ConfigParser).)
-     Either use M(template) to create a base INI file with a C([default]) section, or use
-     M(lineinfile) to add the missing line.
-requirements: [ ConfigParser ]
+   - A C(DEFAULT) section is only added when an option is set in it, and is added
+     before the other sections.
+   - Options are compared by name case sensitively, and values as strings, the way
+     Python's I(ConfigParser) reads them.
 author: Jan-Piet Mens
 '''
 
@@ -85,90 +96,199 @@ EXAMPLES = '''
             option=temperature
             value=cold
             backup=yes
+
+# Set several options of php.ini with a single read and write of the file
+- ini_file:
+    dest: /etc/php.ini
+    settings:
+      PHP:
+        memory_limit: 256M
+        expose_php: "Off"
+      Date:
+        date.timezone: UTC
 '''
 
-import ConfigParser
-import sys
+import re
+import tempfile
+
+SECTION_RE = re.compile(r'\[(?P<header>[^]]+)\]')
+OPTION_RE = re.compile(r'(?P<key>[^:=\s][^:=]*?)(?P<sep>\s*[:=]\s*)(?P<value>.*?)(?P<comment>\s+;.*)?\s*$')
 
 # ==============================================================
-# do_ini
+# IniFile
+
+class IniFile(object):
+    """
+    An INI file kept as the lines it was read from, grouped by section,
+    so that changing an option only touches the lines of that option.
+    Lines are parsed the way ConfigParser reads them.
+    """
 
-def do_ini(module, filename, section=None, option=None, value=None, state='present', backup=False):
+    def __init__(self, text):
+        # lines before the first section header are kept under None
+        self.sections = [[None, []]]
+        for line in text.splitlines(True):
+            m = SECTION_RE.match(line)
+            if m:
+                self.sections.append([m.group('header'), [line]])
+            else:
+                self.sections[-1][1].append(line)
 
-    changed = False
-    if (sys.version_info[0] == 2 and sys.version_info[1] >= 7) or sys.version_info[0] >= 3: 
-        cp = ConfigParser.ConfigParser(allow_no_value=True)
-    else:
-        cp = ConfigParser.ConfigParser()
-    cp.optionxform = identity
+    def render(self):
+        return ''.join([''.join(lines) for (name, lines) in self.sections])
 
-    try:
-        f = open(filename)
-        cp.readfp(f)
-    except IOError:
-        pass
+    def has_section(self, name):
+        return self.find_section(name) is not None
 
+    def find_section(self, name):
+        for section in self.sections[1:]:
+            if section[0] == name:
+                return section
+        return None
 
-    if state == 'absent':
-        if option is None and value is None:
-            if cp.has_section(section):
-                cp.remove_section(section)
-                changed = True
+    def options(self, lines):
+        """ Yield (key, value, match, start, end) for each option in the lines of a section """
+        i = 1
+        while i < len(lines):
+            line = lines[i]
+            if not line.strip() or line[0] in '#;' or line[0].isspace():
+                i += 1
+                continue
+            m = OPTION_RE.match(line.rstrip('\r\n'))
+            if m:
+                key, value = m.group('key'), m.group('value')
+            else:
+                # an option without a value
+                key, value = line.strip(), None
+            end = i + 1
+            while end < len(lines) and lines[end][0].isspace() and lines[end].strip():
+                if value is not None:
+                    value += '\n' + lines[end].strip()
+                end += 1
+            yield key, value, m, i, end
+            i = end
+
+    def ensure_newline(self, lines):
+        if lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+
+    def add_section(self, name):
+        section = [name, ['[%s]\n' % name]]
+        if name.upper() == 'DEFAULT':
+            # ConfigParser writes the defaults first
+            if len(self.sections) > 1:
+                section[1].append('\n')
+            self.sections.insert(1, section)
+            return section
+        previous = self.sections[-1][1]
+        if not previous and len(self.sections) > 1:
+            previous = self.sections[-2][1]
+        self.ensure_newline(previous)
+        if previous and previous[-1].strip():
+            previous.append('\n')
+        self.sections.append(section)
+        return section
+
+    def remove_section(self, name):
+        before = len(self.sections)
+        self.sections = [s for s in self.sections if s[0] != name or s[0] is None]
+        return len(self.sections) != before
+
+    def set(self, name, option, value):
+        section = self.find_section(name)
+        if section is None:
+            section = self.add_section(name)
+        lines = section[1]
+        found = None
+        last_end = 1
+        for opt in self.options(lines):
+            last_end = opt[4]
+            if opt[0] == option:
+                found = opt
+        value = str(value)
+        new_value = '\n\t'.join(value.split('\n'))
+        if found is None:
+            if not lines[last_end - 1].endswith('\n'):
+                lines[last_end - 1] += '\n'
+            lines.insert(last_end, '%s = %s\n' % (option, new_value))
+            return True
+        (key, old_value, m, start, end) = found
+        if old_value == value:
+            return False
+        line = lines[end - 1]
+        eol = line[len(line.rstrip('\r\n')):]
+        if m is not None:
+            # keep the spacing and any comment of the line being changed
+            new_line = '%s%s%s%s%s' % (key, m.group('sep'), new_value, m.group('comment') or '', eol)
         else:
-            if option is not None:
-                try:
-                    if cp.get(section, option):
-                        cp.remove_option(section, option)
-                        changed = True
-                except:
-                    pass
+            new_line = '%s = %s%s' % (key, new_value, eol)
+        lines[start:end] = [new_line]
+        return True
 
-    if state == 'present':
+    def remove_option(self, name, option):
+        changed = False
+        for section in self.sections[1:]:
+            if section[0] != name:
+                continue
+            for (key, value, m, start, end) in reversed(list(self.options(section[1]))):
+                if key == option:
+                    del section[1][start:end]
+                    changed = True
+        return changed
 
+# ==============================================================
+# do_ini
+
+def apply_settings(ini, settings, state):
+    for section in sorted(settings):
+        options = settings[section]
+        if state == 'absent':
+            if options is None:
+                ini.remove_section(section)
+            else:
+                for option in sorted(options):
+                    ini.remove_option(section, option)
+            continue
         # DEFAULT section is always there by DEFAULT, so never try to add it.
-        if not cp.has_section(section) and section.upper() != 'DEFAULT':
+        if not ini.has_section(section) and section.upper() != 'DEFAULT':
+            ini.add_section(section)
+        for option in sorted(options or {}):
+            if options[option] is not None:
+                ini.set(section, option, options[option])
 
-            cp.add_section(section)
-            changed = True
+def do_ini(module, filename, settings, state='present', backup=False):
 
-        if option is not None and value is not None:
-            try:
-                oldvalue = cp.get(section, option)
-                if str(value) != str(oldvalue):
-                    cp.set(section, option, value)
-                    changed = True
-            except ConfigParser.NoSectionError:
-                cp.set(section, option, value)
-                changed = True
-            except ConfigParser.NoOptionError:
-                cp.set(section, option, value)
-                changed = True
+    try:
+        f = open(filename, 'rb')
+        try:
+            original = f.read()
+        finally:
+            f.close()
+    except IOError:
+        original = ''
 
+    ini = IniFile(original)
+    apply_settings(ini, settings, state)
+    contents = ini.render()
+
+    changed = contents != original
     if changed and not module.check_mode:
-        if backup:
+        if backup and os.path.exists(filename):
             module.backup_local(filename)
 
         try:
-            f = open(filename, 'w')
-            cp.write(f)
-        except:
+            tmpfd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)))
+            f = os.fdopen(tmpfd, 'wb')
+            try:
+                f.write(contents)
+            finally:
+                f.close()
+        except (IOError, OSError):
             module.fail_json(msg="Can't create %s" % filename)
+        module.atomic_move(tmpfile, os.path.realpath(filename))
 
     return changed
 
-# ==============================================================
-# identity
-
-def identity(arg):
-    """
-    This function simply returns its argument. It serves as a
-    replacement for ConfigParser.optionxform, which by default
-    changes arguments to lower case. The identity function is a
-    better choice than str() or unicode(), because it is
-    encoding-agnostic.
-    """
-    return arg
-
 # ==============================================================
 # main
 
@@ -177,12 +297,15 @@ def main():
     module = AnsibleModule(
         argument_spec = dict(
             dest = dict(required=True),
-            section = dict(required=True),
+            section = dict(required=False),
             option = dict(required=False),
             value = dict(required=False),
+            settings = dict(required=False, type='dict'),
             backup = dict(default='no', type='bool'),
             state = dict(default='present', choices=['present', 'absent'])
         ),
+        mutually_exclusive = [['settings', 'section'], ['settings', 'option'], ['settings', 'value']],
+        required_one_of = [['settings', 'section']],
         add_file_common_args = True,
         supports_check_mode = True
     )
@@ -196,7 +319,22 @@ def main():
     state = module.params['state']
     backup = module.params['backup']
 
-    changed = do_ini(module, dest, section, option, value, state, backup)
+    settings = module.params['settings']
+    if settings is None:
+        if option is None and value is None:
+            settings = {section: None}
+            if state == 'present':
+                settings = {section: {}}
+        else:
+            settings = {section: {option: value}}
+    else:
+        allowed = dict
+        if state == 'absent':
+            allowed = (dict, list)
+        if [s for s in settings.values() if not (s is None or isinstance(s, allowed))]:
+            module.fail_json(msg="settings must map each section to a hash of options")
+
+    changed = do_ini(module, dest, settings, state, backup)
 
     file_args = module.load_file_common_arguments(module.params)
     changed = module.set_fs_attributes_if_different(file_args, changed)
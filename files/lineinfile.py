@@ -124,6 +124,20 @@ options:
      required: false
      default: None
      version_added: "1.4"
+  edits:
+     required: false
+     default: null
+     version_added: "2.0"
+     description:
+       - A list of edits to apply to the file in a single pass, each a hash
+         with the C(regexp), C(line), C(state), C(backrefs), C(insertafter)
+         and C(insertbefore) keys described above. Every edit is matched
+         against the file as it was before any of them were applied, the file
+         is read line by line and, if anything changed, written once.
+       - Lines removed by a C(state=absent) edit are not replaced by a
+         C(state=present) edit.
+       - May not be used with C(regexp), C(line), C(backrefs), C(insertafter)
+         or C(insertbefore).
   others:
      description:
        - All arguments accepted by the M(file) module also work here.
@@ -151,6 +165,16 @@ EXAMPLES = r"""
 
 # Validate the sudoers file before saving
 - lineinfile: dest=/etc/sudoers state=present regexp='^%ADMIN ALL\=' line='%ADMIN ALL=(ALL) NOPASSWD:ALL' validate='visudo -cf %s'
+
+# Manage several lines of the same file with a single read and write
+- lineinfile:
+    dest: /etc/ssh/sshd_config
+    validate: 'sshd -t -f %s'
+    edits:
+      - { regexp: '^PermitRootLogin ', line: 'PermitRootLogin no' }
+      - { regexp: '^PasswordAuthentication ', line: 'PasswordAuthentication no' }
+      - { regexp: '^UseDNS ', line: 'UseDNS no', insertafter: '^#UseDNS ' }
+      - { regexp: '^Protocol 1', state: absent }
 """
 
 def write_changes(module,lines,dest):
@@ -325,6 +349,224 @@ def absent(module, dest, regexp, line, backup):
     module.exit_json(changed=changed, found=len(found), msg=msg, backup=backupdest)
 
 
+class LineEdit(object):
+    ''' One edit of a batch, tracking the lines it matched while scanning '''
+
+    def __init__(self, module, spec):
+        if not isinstance(spec, dict):
+            module.fail_json(msg='edits must be a list of hashes: %s' % (spec,))
+        unknown = set(spec) - set(['regexp', 'line', 'state', 'backrefs',
+                                   'insertafter', 'insertbefore'])
+        if unknown:
+            module.fail_json(msg='unsupported keys in edit: %s' % ', '.join(sorted(unknown)))
+        # the same conversion as the str type of the top level options
+        for key in ('regexp', 'line', 'insertafter', 'insertbefore'):
+            if spec.get(key) is not None and not isinstance(spec[key], basestring):
+                spec[key] = str(spec[key])
+        self.regexp = spec.get('regexp', None)
+        self.line = spec.get('line', None)
+        self.state = spec.get('state', 'present')
+        self.backrefs = module.boolean(spec.get('backrefs', False))
+        self.insertafter = spec.get('insertafter', None)
+        self.insertbefore = spec.get('insertbefore', None)
+
+        if self.state not in ('present', 'absent'):
+            module.fail_json(msg='state must be present or absent: %s' % (spec,))
+        if self.state == 'present':
+            if self.backrefs and self.regexp is None:
+                module.fail_json(msg='regexp is required with backrefs=true: %s' % (spec,))
+            if self.line is None:
+                module.fail_json(msg='line is required with state=present: %s' % (spec,))
+            if self.insertafter is not None and self.insertbefore is not None:
+                module.fail_json(msg='insertafter and insertbefore are mutually exclusive: %s' % (spec,))
+            if self.insertafter is None and self.insertbefore is None:
+                self.insertafter = 'EOF'
+        elif self.regexp is None and self.line is None:
+            module.fail_json(msg='one of line or regexp is required with state=absent: %s' % (spec,))
+
+        try:
+            self.mre = None
+            if self.regexp is not None:
+                self.mre = re.compile(self.regexp)
+            self.insre = None
+            if self.state == 'present':
+                if self.insertafter not in (None, 'BOF', 'EOF'):
+                    self.insre = re.compile(self.insertafter)
+                elif self.insertbefore not in (None, 'BOF'):
+                    self.insre = re.compile(self.insertbefore)
+        except re.error, e:
+            module.fail_json(msg='invalid regular expression in %s: %s' % (spec, str(e)))
+
+        # line number and line of the last match, and where to insert
+        self.match = -1
+        self.matched_line = None
+        self.m = None
+        self.anchor = -1
+        self.removed = []
+
+    def patterns(self):
+        return [r.pattern for r in (self.mre, self.insre) if r is not None]
+
+    def scan(self, lineno, cur_line):
+        if self.mre is not None:
+            match_found = self.mre.search(cur_line)
+        else:
+            match_found = self.line == cur_line.rstrip('\r\n')
+        if match_found:
+            if self.state == 'absent':
+                self.removed.append(lineno)
+            else:
+                self.match = lineno
+                self.matched_line = cur_line
+                self.m = match_found
+        elif self.insre is not None and self.insre.search(cur_line):
+            if self.insertafter:
+                # + 1 for the next line
+                self.anchor = lineno + 1
+            else:
+                self.anchor = lineno
+
+
+# patterns that refer to their own groups can't be joined together
+BACKREF_RE = re.compile(r'\\[1-9]|\(\?P=')
+
+def build_prefilter(edits):
+    '''
+    Join the patterns of all edits in a single alternation, so lines that
+    no edit cares about are skipped with one search. Returns None when
+    every line has to go through the edits.
+    '''
+    patterns = []
+    for edit in edits:
+        patterns.extend(edit.patterns())
+    if not patterns or [p for p in patterns if BACKREF_RE.search(p)]:
+        return None
+    try:
+        return re.compile('|'.join(['(?:%s)' % p for p in patterns]))
+    except re.error:
+        # e.g. the same group name used by two edits
+        return None
+
+
+def stream_lines(f, replaced, removed, inserts, count, last_line):
+    '''
+    Yield the edited lines of the open dest file f, or of an empty one when
+    f is None, without holding the file in memory
+    '''
+    if f is not None:
+        for lineno, cur_line in enumerate(f):
+            for new_line in inserts.get(lineno, ()):
+                yield new_line
+            if lineno in removed:
+                continue
+            yield replaced.get(lineno, cur_line)
+    if inserts.get(count):
+        # If the file is not empty then ensure there's a newline before the added lines
+        if last_line and not (last_line.endswith('\n') or last_line.endswith('\r')):
+            yield os.linesep
+        for new_line in inserts[count]:
+            yield new_line
+
+
+def batch(module, dest, edits, create, backup):
+
+    exists = os.path.exists(dest)
+    if not exists:
+        if [e for e in edits if e.state == 'present'] and not create:
+            module.fail_json(rc=257, msg='Destination %s does not exist !' % dest)
+        destpath = os.path.dirname(dest)
+        if not os.path.exists(destpath) and not module.check_mode:
+            os.makedirs(destpath)
+
+    prefilter = build_prefilter(edits)
+    exact = set([e.line for e in edits if e.regexp is None])
+
+    count = 0
+    last_line = None
+    if exists:
+        f = open(dest, 'rb')
+        try:
+            for lineno, cur_line in enumerate(f):
+                count = lineno + 1
+                last_line = cur_line
+                if prefilter is not None and not prefilter.search(cur_line) \
+                        and cur_line.rstrip('\r\n') not in exact:
+                    continue
+                for edit in edits:
+                    edit.scan(lineno, cur_line)
+        finally:
+            f.close()
+
+    removed = set()
+    for edit in edits:
+        removed.update(edit.removed)
+
+    replaced = {}
+    inserts = {}
+    added = set()
+    n_replaced = n_added = 0
+    for edit in edits:
+        if edit.state == 'absent':
+            continue
+        if edit.match != -1:
+            if edit.match in removed:
+                continue
+            if edit.backrefs:
+                new_line = edit.m.expand(edit.line) + os.linesep
+            else:
+                new_line = edit.line + os.linesep
+            if replaced.get(edit.match, edit.matched_line) != new_line:
+                replaced[edit.match] = new_line
+                n_replaced += 1
+        elif edit.backrefs:
+            # Do absolutely nothing, since it's not safe generating the line
+            # without the regexp matching to populate the backrefs.
+            pass
+        elif edit.line in added:
+            # an earlier edit of the batch already adds this line
+            pass
+        else:
+            if edit.insertbefore == 'BOF' or edit.insertafter == 'BOF':
+                pos = 0
+            elif edit.insertafter == 'EOF' or edit.anchor == -1:
+                pos = count
+            else:
+                pos = edit.anchor
+            inserts.setdefault(pos, []).append(edit.line + os.linesep)
+            added.add(edit.line)
+            n_added += 1
+
+    msg = []
+    if n_replaced:
+        msg.append('%s line(s) replaced' % n_replaced)
+    if n_added:
+        msg.append('%s line(s) added' % n_added)
+    if removed:
+        msg.append('%s line(s) removed' % len(removed))
+    msg = ', '.join(msg)
+    changed = bool(msg)
+
+    backupdest = ""
+    if changed and not module.check_mode:
+        if backup and exists:
+            backupdest = module.backup_local(dest)
+        f = None
+        if exists:
+            f = open(dest, 'rb')
+        try:
+            write_changes(module, stream_lines(f, replaced, removed, inserts, count, last_line), dest)
+        finally:
+            if f is not None:
+                f.close()
+
+    if module.check_mode and not exists:
+        module.exit_json(changed=changed, msg=msg, backup=backupdest)
+
+    msg, changed = check_file_attrs(module, changed, msg)
+    module.exit_json(changed=changed, msg=msg, found=len(removed),
+                     replaced=n_replaced, added=n_added, backup=backupdest)
+
+
 def main():
     module = AnsibleModule(
         argument_spec=dict(
@@ -338,8 +580,12 @@ def main():
             create=dict(default=False, type='bool'),
             backup=dict(default=False, type='bool'),
             validate=dict(default=None, type='str'),
+            edits=dict(default=None, type='list'),
         ),
-        mutually_exclusive=[['insertbefore', 'insertafter']],
+        mutually_exclusive=[['insertbefore', 'insertafter'],
+                            ['edits', 'regexp'], ['edits', 'line'],
+                            ['edits', 'backrefs'], ['edits', 'insertafter'],
+                            ['edits', 'insertbefore']],
         add_file_common_args=True,
         supports_check_mode=True
     )
@@ -354,7 +600,10 @@ def main():
     if os.path.isdir(dest):
         module.fail_json(rc=256, msg='Destination %s is a directory !' % dest)
 
-    if params['state'] == 'present':
+    if params['edits'] is not None:
+        edits = [LineEdit(module, spec) for spec in params['edits']]
+        batch(module, dest, edits, create, backup)
+    elif params['state'] == 'present':
         if backrefs and params['regexp'] is None:
             module.fail_json(msg='regexp= is required with backrefs=true')
 
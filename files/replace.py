@@ -20,6 +20,7 @@
 
 import re
 import os
+import mmap
 import tempfile
 
 DOCUMENTATION = """
@@ -41,19 +42,30 @@ options:
     description:
       - The file to modify.
   regexp:
-    required: true
+    required: false
     description:
       - The regular expression to look for in the contents of the file.
         Uses Python regular expressions; see
         U(http://docs.python.org/2/library/re.html).
         Uses multiline mode, which means C(^) and C($) match the beginning
         and end respectively of I(each line) of the file.
+        Required unless C(replacements) is given.
   replace:
     required: false
     description:
       - The string to replace regexp matches. May contain backreferences
         that will get expanded with the regexp capture groups if the regexp
         matches. If not set, matches are removed entirely.
+  replacements:
+    required: false
+    default: null
+    version_added: "2.0"
+    description:
+      - A list of C(regexp)/C(replace) pairs, given as hashes with those keys
+        or as two item lists, that are applied in a single pass over the
+        file. Where several of them match at the same position the first
+        one in the list wins, and replaced text is not searched again.
+        May not be used with C(regexp).
   backup:
     required: false
     default: "no"
@@ -79,14 +91,18 @@ EXAMPLES = r"""
 - replace: dest=/home/jdoe/.ssh/known_hosts regexp='^old\.host\.name[^\n]*\n' owner=jdoe group=jdoe mode=644
 
 - replace: dest=/etc/apache/ports regexp='^(NameVirtualHost|Listen)\s+80\s*$' replace='\1 127.0.0.1:8080' validate='/usr/sbin/apache2ctl -f %s -t'
+
+- replace:
+    dest: /srv/dump.sql
+    replacements:
+      - { regexp: 'old\.example\.com', replace: 'new.example.com' }
+      - { regexp: '^-- Dumped by .*$', replace: '' }
 """
 
-def write_changes(module,contents,dest):
+# size of the pieces unchanged text is copied in
+COPY_CHUNK_SIZE = 1024 * 1024
 
-    tmpfd, tmpfile = tempfile.mkstemp()
-    f = os.fdopen(tmpfd,'wb')
-    f.write(contents)
-    f.close()
+def write_changes(module,tmpfile,dest):
 
     validate = module.params.get('validate', None)
     valid = not validate
@@ -96,11 +112,116 @@ def write_changes(module,contents,dest):
         (rc, out, err) = module.run_command(validate % tmpfile)
         valid = rc == 0
         if rc != 0:
+            os.unlink(tmpfile)
             module.fail_json(msg='failed to validate: '
                                  'rc:%s error:%s' % (rc,err))
     if valid:
         module.atomic_move(tmpfile, dest)
 
+def map_file(f):
+    '''
+    Map the file so the regular expressions can search it without reading
+    it into memory, falling back to reading it where that isn't possible
+    '''
+    size = os.fstat(f.fileno()).st_size
+    if size == 0:
+        return ''
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (mmap.error, OverflowError, ValueError, EnvironmentError):
+        return f.read()
+
+def copy_range(out, data, start, end):
+    while start < end:
+        stop = min(end, start + COPY_CHUNK_SIZE)
+        out.write(data[start:stop])
+        start = stop
+
+def iter_matches(regexps, data):
+    '''
+    Yield (index, match) for the matches of all regexps in data in order,
+    the way re.subn() would find them for a single one: the earliest match
+    wins, text that was matched is not searched again and an empty match
+    right after the previous match is skipped
+    '''
+    pending = [None] * len(regexps)
+    done = [False] * len(regexps)
+    pos = 0
+    last_end = -1
+    while pos <= len(data):
+        best = None
+        for i, mre in enumerate(regexps):
+            if done[i]:
+                continue
+            m = pending[i]
+            if m is None or m.start() < pos:
+                m = pending[i] = mre.search(data, pos)
+                if m is None:
+                    done[i] = True
+                    continue
+            if best is None or m.start() < best[1].start():
+                best = (i, m)
+        if best is None:
+            return
+        m = best[1]
+        if m.start() == m.end():
+            pos = m.start() + 1
+            if m.start() == last_end:
+                continue
+        else:
+            pos = m.end()
+        last_end = m.end()
+        yield best
+
+def replace_all(module, dest, pairs):
+    '''
+    Apply the (regexp, replace) pairs to dest in one pass. Nothing is
+    written until a match actually changes the text, so a run without
+    changes only reads the file. Returns the number of matches and the
+    temporary file with the new contents, if any.
+    '''
+    regexps = [mre for (mre, replace) in pairs]
+    count = 0
+    tmpfile = None
+    out = None
+    f = open(dest, 'rb')
+    try:
+        data = map_file(f)
+        try:
+            last = 0
+            for (i, m) in iter_matches(regexps, data):
+                count += 1
+                try:
+                    new = m.expand(pairs[i][1])
+                except re.error, e:
+                    if out:
+                        out.close()
+                    if tmpfile is not None:
+                        os.remove(tmpfile)
+                    module.fail_json(msg='invalid replacement %s: %s' % (pairs[i][1], str(e)))
+                if out is None:
+                    if new == m.group(0):
+                        continue
+                    if module.check_mode:
+                        # only the number of matches is needed
+                        out = False
+                    else:
+                        tmpfd, tmpfile = tempfile.mkstemp()
+                        out = os.fdopen(tmpfd, 'wb')
+                if out:
+                    copy_range(out, data, last, m.start())
+                    out.write(new)
+                last = m.end()
+            if out:
+                copy_range(out, data, last, len(data))
+                out.close()
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+    finally:
+        f.close()
+    return count, out is not None, tmpfile
+
 def check_file_attrs(module, changed, message):
 
     file_args = module.load_file_common_arguments(module.params)
@@ -117,11 +238,14 @@ def main():
     module = AnsibleModule(
         argument_spec=dict(
             dest=dict(required=True, aliases=['name', 'destfile']),
-            regexp=dict(required=True),
+            regexp=dict(default=None),
             replace=dict(default='', type='str'),
+            replacements=dict(default=None, type='list'),
             backup=dict(default=False, type='bool'),
             validate=dict(default=None, type='str'),
         ),
+        mutually_exclusive=[['regexp', 'replacements']],
+        required_one_of=[['regexp', 'replacements']],
         add_file_common_args=True,
         supports_check_mode=True
     )
@@ -134,27 +258,44 @@ def main():
 
     if not os.path.exists(dest):
         module.fail_json(rc=257, msg='Destination %s does not exist !' % dest)
+
+    if params['replacements'] is not None:
+        pairs = []
+        for item in params['replacements']:
+            if isinstance(item, dict):
+                item = (item.get('regexp', None), item.get('replace', ''))
+            if not isinstance(item, (list, tuple)) or len(item) != 2 or item[0] is None:
+                module.fail_json(msg='replacements must be regexp/replace pairs: %s' % (item,))
+            pairs.append((item[0], item[1] or ''))
     else:
-        f = open(dest, 'rb')
-        contents = f.read()
-        f.close()
+        pairs = [(params['regexp'], params['replace'])]
 
-    mre = re.compile(params['regexp'], re.MULTILINE)
-    result = re.subn(mre, params['replace'], contents, 0)
+    # YAML may have typed the values, such as replace: 8080
+    for (n, (regexp, replace)) in enumerate(pairs):
+        if not isinstance(regexp, basestring):
+            regexp = str(regexp)
+        if not isinstance(replace, basestring):
+            replace = str(replace)
+        pairs[n] = (regexp, replace)
 
-    if result[1] > 0 and contents != result[0]:
-        msg = '%s replacements made' % result[1]
-        changed = True
+    try:
+        pairs = [(re.compile(regexp, re.MULTILINE), replace) for (regexp, replace) in pairs]
+    except re.error, e:
+        module.fail_json(msg='invalid regular expression: %s' % str(e))
+
+    (count, changed, tmpfile) = replace_all(module, dest, pairs)
+
+    if changed:
+        msg = '%s replacements made' % count
     else:
         msg = ''
-        changed = False
 
     if changed and not module.check_mode:
         if params['backup'] and os.path.exists(dest):
             module.backup_local(dest)
         if params['follow'] and os.path.islink(dest):
             dest = os.path.realpath(dest)
-        write_changes(module, result[0], dest)
+        write_changes(module, tmpfile, dest)
 
     msg, changed = check_file_attrs(module, changed, msg)
     module.exit_json(changed=changed, msg=msg)
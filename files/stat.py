@@ -47,6 +47,15 @@ options:
     default: yes
     aliases: []
     version_added: "1.8"
+  checksum_cache:
+    description:
+      - Reuse the md5 and checksum of the file recorded by an earlier run (of this or the copy,
+        assemble and get_url modules) while its inode, size, mtime and ctime are unchanged.
+        When both are requested the file is read once for both of them.
+    required: false
+    default: no
+    aliases: []
+    version_added: "2.0"
 author: Bruce Pennypacker
 '''
 
@@ -257,6 +266,96 @@ import sys
 from stat import *
 import pwd
 import grp
+import tempfile
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+# ===========================================
+# Checksum cache, shared with the copy, stat, assemble and get_url modules.
+# Digests are stored in one small file per inode, and are only reused while
+# the inode, size, mtime and ctime of the file are unchanged
+
+CHECKSUM_CACHE_DIR = '~/.ansible/checksums'
+
+def checksum_cache_path(st):
+    return os.path.join(os.path.expanduser(CHECKSUM_CACHE_DIR), '%d-%d' % (st.st_dev, st.st_ino))
+
+def checksum_cache_stamp(st):
+    return [st.st_ino, st.st_size, st.st_mtime, st.st_ctime]
+
+def load_cached_digests(st):
+    try:
+        infile = open(checksum_cache_path(st))
+        try:
+            entry = json.load(infile)
+        finally:
+            infile.close()
+    except (IOError, ValueError):
+        return {}
+    if not isinstance(entry, dict) or entry.pop('stamp', None) != checksum_cache_stamp(st):
+        return {}
+    return entry
+
+def cache_digests(path, digests):
+    '''
+    Record digests of a file which are already known, such as after it
+    was replaced with content whose digests were computed
+    '''
+    try:
+        st = os.stat(path)
+        cache_dir = os.path.expanduser(CHECKSUM_CACHE_DIR)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0700)
+        entry = load_cached_digests(st)
+        entry.update(digests)
+        entry['stamp'] = checksum_cache_stamp(st)
+        fd, tmp = tempfile.mkstemp(prefix='.checksum-', dir=cache_dir)
+        outfile = os.fdopen(fd, 'w')
+        try:
+            json.dump(entry, outfile)
+        finally:
+            outfile.close()
+        os.rename(tmp, checksum_cache_path(st))
+    except (IOError, OSError):
+        # the cache is only an optimization
+        pass
+
+def file_digests(path, algorithms, use_cache=False):
+    '''
+    Return a dict of the hex digests of a file for the requested algorithms,
+    reading the file once for all of them. Algorithms which are not available
+    (such as md5 in FIPS mode) are left out. With use_cache, digests cached
+    by earlier runs are reused and new ones are added to the cache
+    '''
+    algorithms = [a for a in algorithms if a in AVAILABLE_HASH_ALGORITHMS]
+    digests = {}
+    if use_cache:
+        st = os.stat(path)
+        cached = load_cached_digests(st)
+        for algorithm in algorithms:
+            if algorithm in cached:
+                digests[algorithm] = cached[algorithm]
+
+    missing = [(a, AVAILABLE_HASH_ALGORITHMS[a]()) for a in algorithms if a not in digests]
+    if missing:
+        infile = open(path, 'rb')
+        try:
+            while True:
+                block = infile.read(64 * 1024)
+                if not block:
+                    break
+                for (algorithm, digest) in missing:
+                    digest.update(block)
+        finally:
+            infile.close()
+        for (algorithm, digest) in missing:
+            digests[algorithm] = digest.hexdigest()
+        # don't cache digests of a file which changed while it was read
+        if use_cache and checksum_cache_stamp(os.stat(path)) == checksum_cache_stamp(st):
+            cache_digests(path, digests)
+    return digests
 
 def main():
     module = AnsibleModule(
@@ -264,7 +363,8 @@ def main():
             path = dict(required=True),
             follow = dict(default='no', type='bool'),
             get_md5 = dict(default='yes', type='bool'),
-            get_checksum = dict(default='yes', type='bool')
+            get_checksum = dict(default='yes', type='bool'),
+            checksum_cache = dict(default='no', type='bool'),
         ),
         supports_check_mode = True
     )
@@ -326,15 +426,19 @@ def main():
     if S_ISLNK(mode):
         d['lnk_source'] = os.path.realpath(path)
 
-    if S_ISREG(mode) and get_md5 and os.access(path,os.R_OK):
-        # Will fail on FIPS-140 compliant systems
-        try:
-            d['md5']       = module.md5(path)
-        except ValueError:
-            d['md5']       = None
+    if S_ISREG(mode) and (get_md5 or get_checksum) and os.access(path,os.R_OK):
+        algorithms = []
+        if get_md5:
+            algorithms.append('md5')
+        if get_checksum:
+            algorithms.append('sha1')
+        digests = file_digests(path, algorithms, module.params.get('checksum_cache'))
 
-    if S_ISREG(mode) and get_checksum and os.access(path,os.R_OK):
-        d['checksum']       = module.sha1(path)
+        # md5 is not available on FIPS-140 compliant systems
+        if get_md5:
+            d['md5']       = digests.get('md5')
+        if get_checksum:
+            d['checksum']       = digests['sha1']
 
 
     try:
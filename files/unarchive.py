@@ -58,17 +58,27 @@ options:
     choices: [ "yes", "no" ]
     default: "no"
     version_added: "2.0"
+  workers:
+    description:
+      - Number of threads used to unpack the members of zip archives, which are
+        compressed independently of each other.
+    required: false
+    default: 1
+    version_added: "2.0"
 author: Dylan Martin
 todo:
-    - detect changed/unchanged for .zip files
     - handle common unarchive args, like preserve owner/timestamp etc...
 notes:
-    - requires C(tar)/C(unzip) command on target host
-    - can handle I(gzip), I(bzip2) and I(xz) compressed as well as uncompressed tar files
-    - detects type of archive automatically
-    - uses tar's C(--diff arg) to calculate if changed or not. If this C(arg) is not
-      supported, it will always unpack the archive
-    - does not detect if a .zip file is different from destination - always unzips
+    - detects type of archive automatically from its first bytes
+    - tar and zip archives are read in a single pass with python's C(tarfile) and C(zipfile)
+      modules. Members whose type, size and mtime (or CRC, for zip files) already match the
+      destination are not written, and the module only reports a change if a member was written
+    - the members of an unpacked archive are recorded in C(~/.ansible/unarchive) on the target
+      host, so unpacking the same archive again only needs to read it to compute its checksum,
+      without decompressing it, as long as the unpacked files are unchanged
+    - falls back to the C(tar) command for archives the python modules can't read, such as
+      I(xz) compressed tar files on python 2. It then uses tar's C(--diff arg) to calculate if
+      changed or not. If this C(arg) is not supported, it will always unpack the archive
     - existing files/directories in the destination which are not in the archive
       are not touched.  This is the same behavior as a normal archive extraction
     - existing files/directories in the destination which are not in the archive
@@ -85,54 +95,551 @@ EXAMPLES = '''
 
 import re
 import os
-from zipfile import ZipFile
+import stat
+import time
+import tarfile
+import tempfile
+import binascii
+import shutil
+import threading
+import Queue
+import pwd
+import grp
+from cStringIO import StringIO
+from zipfile import ZipFile, BadZipfile
+try:
+    import json
+except ImportError:
+    import simplejson as json
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
 
 # String from tar that shows the tar contents are different from the
 # filesystem
 DIFFERENCE_RE = re.compile(r': (.*) differs$')
 
+# Where the members of unpacked archives are recorded
+MANIFEST_DIR = '~/.ansible/unarchive'
+
+# First bytes of the supported archive and compression formats
+MAGIC = (
+    ('\x1f\x8b', 'gz'),
+    ('BZh', 'bz2'),
+    ('\xfd7zXZ\x00', 'xz'),
+    ('PK\x03\x04', 'zip'),
+    ('PK\x05\x06', 'zip'),
+)
+
 class UnarchiveError(Exception):
     pass
 
-# class to handle .zip files
-class ZipArchive(object):
+
+def detect_format(src):
+    ''' Return the archive or compression format of src from its first bytes '''
+    f = open(src, 'rb')
+    try:
+        header = f.read(512)
+    finally:
+        f.close()
+    for (magic, fmt) in MAGIC:
+        if header.startswith(magic):
+            return fmt
+    if header[257:262] == 'ustar':
+        return 'tar'
+    return None
+
+
+def file_sha1(path):
+    digest = sha1()
+    f = open(path, 'rb')
+    try:
+        while True:
+            block = f.read(1024 * 1024)
+            if not block:
+                break
+            digest.update(block)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+def is_inside(real_dest, path):
+    ''' Whether path, once its symlinks are resolved, is dest or below it '''
+    path = os.path.realpath(path)
+    return path == real_dest or path.startswith(real_dest.rstrip('/') + '/')
+
+
+def check_parent(dest, path, name):
+    '''
+    Refuse a member whose parent directory leads outside of dest, such as
+    through a symlink unpacked by an earlier member
+    '''
+    if not is_inside(os.path.realpath(dest), os.path.dirname(path)):
+        raise UnarchiveError('Archive member %s would be unpacked outside of %s' % (name, dest))
+
+
+def check_link_target(dest, name, linkname):
+    '''
+    Refuse a hard link member whose target is outside of dest. Symlinks may
+    point anywhere, check_parent() keeps members from being written through
+    them
+    '''
+    # hard link targets are named relative to the root of the archive
+    target = os.path.join(dest, linkname)
+    if not is_inside(os.path.realpath(dest), target):
+        raise UnarchiveError('Archive member %s links to %s, outside of %s' % (name, linkname, dest))
+
+
+def member_path(dest, name):
+    ''' Return where a member is unpacked, refusing members outside of dest '''
+    dest = os.path.normpath(dest)
+    path = os.path.normpath(os.path.join(dest, name.lstrip('/')))
+    if path != dest and not path.startswith(dest.rstrip('/') + '/'):
+        raise UnarchiveError('Archive member %s would be unpacked outside of %s' % (name, dest))
+    if path != dest:
+        check_parent(dest, path, name)
+    return path
+
+
+def member_matches(path, kind, size, mtime, linkname=None):
+    ''' Whether what is at path already matches the member, based on lstat '''
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    if kind == 'dir':
+        return stat.S_ISDIR(st.st_mode)
+    if kind == 'link':
+        return stat.S_ISLNK(st.st_mode) and os.readlink(path) == linkname
+    if kind == 'file':
+        return stat.S_ISREG(st.st_mode) and st.st_size == size and int(st.st_mtime) == int(mtime)
+    # devices, fifos and hard links are only created when missing
+    return True
+
+
+class InProcessArchive(object):
+    '''
+    Base class for archives unpacked by python itself in a single pass,
+    which only writes the members that differ from dest, applies the
+    owner, group and mode while unpacking, and records the members in a
+    manifest so an unchanged archive can be skipped
+    '''
 
     def __init__(self, src, dest, module):
         self.src = src
         self.dest = dest
         self.module = module
-        self.cmd_path = self.module.get_bin_path('unzip')
         self._files_in_archive = []
+        self._checksum = None
+        self.uid = -1
+        self.gid = -1
+        self.mode = None
+        self.context = None
+        self.attributes_changed = False
 
     @property
     def files_in_archive(self, force_refresh=False):
         if self._files_in_archive and not force_refresh:
             return self._files_in_archive
+        self._files_in_archive = [m[0] for m in self.list_members()]
+        return self._files_in_archive
 
-        archive = ZipFile(self.src)
+    def set_file_args(self, file_args):
+        ''' Resolve the requested owner, group and mode once for all members '''
+        owner = file_args['owner']
+        group = file_args['group']
+        if owner is not None:
+            try:
+                self.uid = int(owner)
+            except ValueError:
+                try:
+                    self.uid = pwd.getpwnam(owner).pw_uid
+                except KeyError:
+                    self.module.fail_json(path=self.dest, msg='chown failed: failed to look up user %s' % owner)
+        if group is not None:
+            try:
+                self.gid = int(group)
+            except ValueError:
+                try:
+                    self.gid = grp.getgrnam(group).gr_gid
+                except KeyError:
+                    self.module.fail_json(path=self.dest, msg='chgrp failed: failed to look up group %s' % group)
+        self.mode = file_args['mode']
+        if self.mode is not None and not isinstance(self.mode, int):
+            try:
+                self.mode = int(self.mode, 8)
+            except ValueError:
+                # symbolic modes are evaluated against each member
+                pass
+        if [c for c in file_args.get('secontext') or [] if c is not None]:
+            self.context = file_args['secontext']
+
+    def target_mode(self, st):
+        if self.mode is None or isinstance(self.mode, int):
+            return self.mode
+        return self.module._symbolic_mode_to_octal(st, self.mode)
+
+    def apply_fd_attributes(self, fd, mode=None, uid=-1, gid=-1):
+        '''
+        Apply the owner, group and mode to a member being written through fd,
+        the requested ones or else those from the archive. Like tar, the
+        archived owner is only kept when running as root
+        '''
+        if os.geteuid() != 0:
+            uid = gid = -1
+        if self.uid != -1:
+            uid = self.uid
+        if self.gid != -1:
+            gid = self.gid
+        if uid != -1 or gid != -1:
+            os.fchown(fd, uid, gid)
+        if self.mode is not None:
+            mode = self.target_mode(os.fstat(fd))
+        if mode is not None:
+            os.fchmod(fd, mode)
+
+    def apply_attributes(self, path):
+        ''' Apply the owner, group and mode to a member, only where they differ '''
+        changed = False
+        if self.context is not None:
+            changed = self.module.set_context_if_different(path, self.context, changed)
+        st = os.lstat(path)
+        uid = gid = -1
+        if self.uid != -1 and st.st_uid != self.uid:
+            uid = self.uid
+        if self.gid != -1 and st.st_gid != self.gid:
+            gid = self.gid
+        if uid != -1 or gid != -1:
+            os.lchown(path, uid, gid)
+            changed = True
+            st = os.lstat(path)
+        if not stat.S_ISLNK(st.st_mode):
+            mode = self.target_mode(st)
+            if mode is not None and stat.S_IMODE(st.st_mode) != mode:
+                os.chmod(path, mode)
+                changed = True
+        if changed:
+            self.attributes_changed = True
+        return changed
+
+    def apply_all_attributes(self):
+        for name in self.files_in_archive:
+            self.apply_attributes(member_path(self.dest, name))
+
+    def write_member(self, stream, path, mtime, mode=None, uid=-1, gid=-1):
+        '''
+        Write a member to a temporary file next to path, so dest never has a
+        partial member, applying the attributes on the open file. mode, uid
+        and gid are those of the member in the archive
+        '''
+        # checked again now, a symlink could have been unpacked since
+        check_parent(self.dest, path, path)
+        parent = os.path.dirname(path)
+        fd, tmp = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path), dir=parent)
+        out = os.fdopen(fd, 'wb')
         try:
-            self._files_in_archive = archive.namelist()
+            try:
+                shutil.copyfileobj(stream, out, 1024 * 1024)
+                out.flush()
+                self.apply_fd_attributes(out.fileno(), mode, uid, gid)
+            finally:
+                out.close()
+            os.utime(tmp, (mtime, mtime))
+            os.rename(tmp, path)
         except:
-            raise UnarchiveError('Unable to list files in the archive')
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
 
-        return self._files_in_archive
+    def checksum(self):
+        if self._checksum is None:
+            self._checksum = file_sha1(self.src)
+        return self._checksum
+
+    def manifest_path(self):
+        key = sha1('%s\0%s' % (os.path.abspath(self.dest), self.checksum())).hexdigest()
+        return os.path.join(os.path.expanduser(MANIFEST_DIR), '%s.json' % key)
+
+    def load_manifest(self):
+        try:
+            f = open(self.manifest_path())
+            try:
+                return json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return None
+
+    def save_manifest(self, members):
+        try:
+            manifest_dir = os.path.expanduser(MANIFEST_DIR)
+            if not os.path.isdir(manifest_dir):
+                os.makedirs(manifest_dir, 0700)
+            fd, tmp = tempfile.mkstemp(prefix='.unarchive-', dir=manifest_dir)
+            f = os.fdopen(fd, 'w')
+            try:
+                json.dump(dict(src=self.src, dest=self.dest, members=members), f)
+            finally:
+                f.close()
+            os.rename(tmp, self.manifest_path())
+        except (IOError, OSError):
+            # the manifest is only an optimization
+            pass
 
     def is_unarchived(self, mode, owner, group):
-        return dict(unarchived=False)
+        # only the manifest is checked here, the archive itself is compared
+        # with dest while unpacking it so it is only decompressed once
+        manifest = self.load_manifest()
+        if manifest is None:
+            return dict(unarchived=False, manifest=False)
+        try:
+            for (name, kind, size, mtime, linkname) in manifest['members']:
+                if not member_matches(member_path(self.dest, name), kind, size, mtime, linkname):
+                    return dict(unarchived=False, manifest=True)
+        except (UnarchiveError, ValueError, TypeError, KeyError):
+            return dict(unarchived=False, manifest=False)
+        self._files_in_archive = [m[0] for m in manifest['members']]
+        return dict(unarchived=True, manifest=True)
+
+    def finish(self):
+        ''' Hook for members whose extraction was deferred, returns their names '''
+        return []
 
     def unarchive(self):
-        cmd = '%s -o "%s" -d "%s"' % (self.cmd_path, self.src, self.dest)
-        rc, out, err = self.module.run_command(cmd)
-        return dict(cmd=cmd, rc=rc, out=out, err=err)
+        members = []
+        changed = []
+        try:
+            archive = self.open()
+            try:
+                self.unarchive_members(archive, members, changed)
+            finally:
+                archive.close()
+            finished = self.finish()
+            # the attributes which can't be set through the open file, such
+            # as the selinux context, still have to be applied to them
+            for name in finished:
+                self.apply_attributes(member_path(self.dest, name))
+            changed.extend(finished)
+        except (UnarchiveError, IOError, OSError, EOFError, tarfile.TarError, BadZipfile), e:
+            return dict(rc=1, out='', err=str(e), changed=bool(changed))
+
+        self._files_in_archive = [m[0] for m in members]
+        self.save_manifest(members)
+        return dict(rc=0, out='', err='', changed=bool(changed), updated=len(changed))
+
+    def unarchive_members(self, archive, members, changed):
+        ''' Unpack the members that differ from dest, recording all of them '''
+        for (name, kind, size, mtime, linkname, extract, unchanged) in self.iter_members(archive):
+            members.append([name, kind, size, mtime, linkname])
+            path = member_path(self.dest, name)
+            if unchanged or member_matches(path, kind, size, mtime, linkname):
+                self.apply_attributes(path)
+                continue
+            if os.path.lexists(path) and not (kind == 'dir' and os.path.isdir(path)):
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+            parent = os.path.dirname(path)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            # extract returns False when the member is unpacked later
+            if extract(path):
+                self.apply_attributes(path)
+                changed.append(name)
+
+
+# class to handle tar files, optionally compressed, with the tarfile module
+class TarFileArchive(InProcessArchive):
+
+    def __init__(self, src, dest, module, compression=''):
+        super(TarFileArchive, self).__init__(src, dest, module)
+        self.compression = compression
+
+    def open(self):
+        # stream mode reads the archive sequentially, decompressing it once
+        return tarfile.open(self.src, 'r|%s' % self.compression)
 
     def can_handle_archive(self):
-        if not self.cmd_path:
+        try:
+            archive = self.open()
+            try:
+                archive.next()
+            finally:
+                archive.close()
+        except (tarfile.TarError, IOError, EOFError, ValueError):
             return False
-        cmd = '%s -l "%s"' % (self.cmd_path, self.src)
-        rc, out, err = self.module.run_command(cmd)
-        if rc == 0:
-            return True
-        return False
+        return True
+
+    def list_members(self):
+        archive = self.open()
+        try:
+            return [(m.name, None) for m in archive]
+        finally:
+            archive.close()
+
+    def iter_members(self, archive):
+        for member in archive:
+            name = member.name
+            linkname = None
+            if member.isdir():
+                kind = 'dir'
+            elif member.isfile():
+                kind = 'file'
+            elif member.issym():
+                kind = 'link'
+                linkname = member.linkname
+            else:
+                kind = 'other'
+            def extract(path, member=member, kind=kind):
+                if kind == 'file':
+                    stream = archive.extractfile(member)
+                    try:
+                        self.write_member(stream, path, member.mtime, stat.S_IMODE(member.mode), member.uid, member.gid)
+                    finally:
+                        stream.close()
+                else:
+                    if member.islnk():
+                        check_link_target(self.dest, member.name, member.linkname)
+                    # unpack relative to dest even if the member name is
+                    # absolute, member_path() already refused anything else
+                    member.name = path[len(os.path.normpath(self.dest)):].lstrip('/')
+                    archive.extract(member, self.dest)
+                return True
+            yield (name, kind, member.size, member.mtime, linkname, extract, False)
+
+
+# class to handle .zip files with the zipfile module
+class ZipArchive(InProcessArchive):
+
+    def __init__(self, src, dest, module):
+        super(ZipArchive, self).__init__(src, dest, module)
+        self.workers = 1
+        self.pending = []
+
+    def open(self):
+        return ZipFile(self.src)
+
+    def can_handle_archive(self):
+        try:
+            archive = ZipFile(self.src)
+            archive.close()
+        except (BadZipfile, IOError):
+            return False
+        return True
+
+    def list_members(self):
+        archive = ZipFile(self.src)
+        try:
+            return [(name, None) for name in archive.namelist()]
+        finally:
+            archive.close()
+
+    def iter_members(self, archive):
+        for info in archive.infolist():
+            mtime = time.mktime(info.date_time + (0, 0, -1))
+            mode = info.external_attr >> 16
+            linkname = None
+            unchanged = False
+            if info.filename.endswith('/'):
+                kind = 'dir'
+            elif stat.S_ISLNK(mode):
+                kind = 'link'
+                linkname = archive.read(info.filename)
+            else:
+                kind = 'file'
+                path = member_path(self.dest, info.filename)
+                # zip mtimes have a two second resolution and are in
+                # local time, so fall back to the CRC of the content
+                unchanged = not member_matches(path, kind, info.file_size, mtime) and self.crc_matches(path, info)
+            def extract(path, info=info, mode=mode, mtime=mtime, kind=kind, linkname=linkname):
+                if kind == 'file' and self.workers > 1:
+                    # members are compressed independently, so they can
+                    # be unpacked in parallel once the pass is done
+                    self.pending.append((info, path, mode, mtime))
+                    return False
+                self.extract_member(archive, info, path, mode, mtime, kind, linkname)
+                return True
+            yield (info.filename, kind, info.file_size, mtime, linkname, extract, unchanged)
+
+    def crc_matches(self, path, info):
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return False
+        if not stat.S_ISREG(st.st_mode) or st.st_size != info.file_size:
+            return False
+        crc = 0
+        f = open(path, 'rb')
+        try:
+            while True:
+                block = f.read(1024 * 1024)
+                if not block:
+                    break
+                crc = binascii.crc32(block, crc)
+        finally:
+            f.close()
+        return (crc & 0xffffffff) == info.CRC
+
+    def extract_member(self, archive, info, path, mode, mtime, kind, linkname):
+        if kind == 'dir':
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            if stat.S_IMODE(mode):
+                os.chmod(path, stat.S_IMODE(mode))
+            os.utime(path, (mtime, mtime))
+        elif kind == 'link':
+            os.symlink(linkname, path)
+        else:
+            if hasattr(archive, 'open'):
+                member = archive.open(info)
+            else:
+                # ZipFile.open() is only in python 2.6 and later
+                member = StringIO(archive.read(info.filename))
+            try:
+                # zip files made on other systems don't carry a mode
+                self.write_member(member, path, mtime, stat.S_IMODE(mode) or None)
+            finally:
+                member.close()
+
+    def finish(self):
+        if not self.pending:
+            return []
+        pending = self.pending
+        self.pending = []
+        queue = Queue.Queue()
+        for item in pending:
+            queue.put(item)
+        errors = []
+
+        def worker():
+            # ZipFile objects can't be shared between threads
+            archive = ZipFile(self.src)
+            try:
+                while not errors:
+                    try:
+                        (info, path, mode, mtime) = queue.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        self.extract_member(archive, info, path, mode, mtime, 'file', None)
+                    except Exception, e:
+                        errors.append(e)
+            finally:
+                archive.close()
+
+        threads = []
+        for i in range(min(self.workers, len(pending))):
+            t = threading.Thread(target=worker)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        return [item[0].filename for item in pending]
 
 
 # class to handle gzipped tar files
@@ -236,11 +743,24 @@ class TarXzArchive(TgzArchive):
         self.zipflag = 'J'
 
 
+# handlers to try for each detected format, the in process ones first
+FORMAT_HANDLERS = {
+    'gz': [(TarFileArchive, 'gz'), (TgzArchive, None)],
+    'bz2': [(TarFileArchive, 'bz2'), (TarBzipArchive, None)],
+    'xz': [(TarFileArchive, 'xz'), (TarXzArchive, None)],
+    'zip': [(ZipArchive, None)],
+    'tar': [(TarFileArchive, ''), (TarArchive, None)],
+}
+
 # try handlers in order and return the one that works or bail if none work
 def pick_handler(src, dest, module):
-    handlers = [TgzArchive, ZipArchive, TarArchive, TarBzipArchive, TarXzArchive]
-    for handler in handlers:
-        obj = handler(src, dest, module)
+    handlers = [(TarFileArchive, ''), (TgzArchive, None), (ZipArchive, None), (TarArchive, None), (TarBzipArchive, None), (TarXzArchive, None)]
+    handlers = FORMAT_HANDLERS.get(detect_format(src), []) + handlers
+    for (handler, compression) in handlers:
+        if compression is None:
+            obj = handler(src, dest, module)
+        else:
+            obj = handler(src, dest, module, compression)
         if obj.can_handle_archive():
             return obj
     module.fail_json(msg='Failed to find handler to unarchive. Make sure the required command to extract the file is installed.')
@@ -256,6 +776,7 @@ def main():
             copy              = dict(default=True, type='bool'),
             creates           = dict(required=False),
             list_files          = dict(required=False, default=False, type='bool'),
+            workers           = dict(required=False, default=1, type='int'),
         ),
         add_file_common_args=True,
     )
@@ -281,6 +802,11 @@ def main():
         module.fail_json(msg="Destination '%s' not writable" % dest)
 
     handler = pick_handler(src, dest, module)
+    in_process = isinstance(handler, InProcessArchive)
+    if in_process:
+        handler.set_file_args(file_args)
+    if isinstance(handler, ZipArchive):
+        handler.workers = max(1, module.params['workers'])
 
     res_args = dict(handler=handler.__class__.__name__, dest=dest, src=src)
 
@@ -298,15 +824,25 @@ def main():
         except IOError:
             module.fail_json(msg="failed to unpack %s to %s" % (src, dest))
         else:
-            res_args['changed'] = True
+            # the in process handlers only write members that differ
+            res_args['changed'] = res_args['extract_results'].get('changed', True)
 
     # do we need to change perms?
-    for filename in handler.files_in_archive:
-        file_args['path'] = os.path.join(dest, filename)
+    if in_process:
+        # unpacked members already had their attributes applied
         try:
-            res_args['changed'] = module.set_fs_attributes_if_different(file_args, res_args['changed'])
-        except (IOError, OSError), e:
+            if res_args['check_results']['unarchived']:
+                handler.apply_all_attributes()
+        except (IOError, OSError, UnarchiveError), e:
             module.fail_json(msg="Unexpected error when accessing exploded file: %s" % str(e))
+        res_args['changed'] = res_args['changed'] or handler.attributes_changed
+    else:
+        for filename in handler.files_in_archive:
+            file_args['path'] = os.path.join(dest, filename)
+            try:
+                res_args['changed'] = module.set_fs_attributes_if_different(file_args, res_args['changed'])
+            except (IOError, OSError), e:
+                module.fail_json(msg="Unexpected error when accessing exploded file: %s" % str(e))
 
     if module.params['list_files']:
         res_args['files'] = handler.files_in_archive
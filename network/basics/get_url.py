@@ -24,6 +24,16 @@ import shutil
 import datetime
 import re
 import tempfile
+import threading
+try:
+    import json
+except ImportError:
+    import simplejson as json
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
 
 DOCUMENTATION = '''
 ---
@@ -73,9 +83,19 @@ options:
       - If a SHA-256 checksum is passed to this parameter, the digest of the
         destination file will be calculated after it is downloaded to ensure
         its integrity and verify that the transfer completed successfully.
+      - If an existing I(dest) already has this checksum, nothing is downloaded.
     version_added: "1.3"
     required: false
     default: null
+  parallel:
+    description:
+      - Number of byte ranges to download at the same time for large files,
+        when the server supports range requests and sends an ETag or
+        Last-Modified header. The download fails if the file changes on the
+        server while the ranges are fetched.
+    required: false
+    default: 1
+    version_added: "2.0"
   use_proxy:
     description:
       - if C(no), it will not use a proxy, even if one is defined in
@@ -108,10 +128,51 @@ options:
         parameter is not specified, the C(url_password) parameter will not be used.
     required: false
     version_added: '1.6'
+  checksum_cache:
+    description:
+      - Reuse the checksum of an existing I(dest) recorded by an earlier run (of this or the copy,
+        stat and assemble modules) while its inode, size, mtime and ctime are unchanged, and
+        record the checksums of the downloaded file for later runs.
+    required: false
+    default: "no"
+    choices: [ "yes", "no" ]
+    version_added: "2.0"
+  cache_dir:
+    description:
+      - Directory of a download cache shared with the M(uri) module. Downloads
+        are stored there by their sha256 and revalidated with the ETag or
+        Last-Modified they were served with, so a url (or, with C(sha256sum), any
+        url with that content) is only transferred once per host.
+      - A download is only reused by requests with the same I(url_username),
+        I(url_password) and I(force_basic_auth). The directories are created
+        readable by their owner only.
+    required: false
+    default: null
+    version_added: "2.0"
+  cache_size:
+    description:
+      - Size in megabytes the download cache is kept under, by evicting the least
+        recently used downloads.
+    required: false
+    default: 1024
+    version_added: "2.0"
+  cache_hardlink:
+    description:
+      - Place cached downloads with a hard link rather than a copy. The file
+        attributes of I(dest) then also apply to the cached copy, and I(dest) must
+        not be modified in place.
+    required: false
+    default: "no"
+    choices: [ "yes", "no" ]
+    version_added: "2.0"
   others:
     description:
       - all arguments accepted by the M(file) module also work here
     required: false
+notes:
+   - The file is downloaded next to I(dest) and renamed into place. If a
+     download is interrupted and the server sent an ETag or Last-Modified
+     header, the next run resumes it with a range request.
 # informational: requirements for nodes
 requirements: [ urllib2, urlparse ]
 author: Jan-Piet Mens
@@ -123,6 +184,9 @@ EXAMPLES='''
 
 - name: download file with sha256 check
   get_url: url=http://example.com/path/file.conf dest=/etc/foo.conf sha256sum=b5bb9d8014a0f9b1d61e21e796d78dccdf1352f23cd32812f4850b878ae4944c
+
+- name: download a large image in four parallel ranges
+  get_url: url=http://example.com/images/disk.qcow2 dest=/var/lib/images/disk.qcow2 parallel=4
 '''
 
 try:
@@ -131,6 +195,237 @@ try:
 except ImportError:
     HAS_HASHLIB=False
 
+# ===========================================
+# Checksum cache, shared with the copy, stat, assemble and get_url modules.
+# Digests are stored in one small file per inode, and are only reused while
+# the inode, size, mtime and ctime of the file are unchanged
+
+CHECKSUM_CACHE_DIR = '~/.ansible/checksums'
+
+def checksum_cache_path(st):
+    return os.path.join(os.path.expanduser(CHECKSUM_CACHE_DIR), '%d-%d' % (st.st_dev, st.st_ino))
+
+def checksum_cache_stamp(st):
+    return [st.st_ino, st.st_size, st.st_mtime, st.st_ctime]
+
+def load_cached_digests(st):
+    try:
+        infile = open(checksum_cache_path(st))
+        try:
+            entry = json.load(infile)
+        finally:
+            infile.close()
+    except (IOError, ValueError):
+        return {}
+    if not isinstance(entry, dict) or entry.pop('stamp', None) != checksum_cache_stamp(st):
+        return {}
+    return entry
+
+def cache_digests(path, digests):
+    '''
+    Record digests of a file which are already known, such as after it
+    was replaced with content whose digests were computed
+    '''
+    try:
+        st = os.stat(path)
+        cache_dir = os.path.expanduser(CHECKSUM_CACHE_DIR)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0700)
+        entry = load_cached_digests(st)
+        entry.update(digests)
+        entry['stamp'] = checksum_cache_stamp(st)
+        fd, tmp = tempfile.mkstemp(prefix='.checksum-', dir=cache_dir)
+        outfile = os.fdopen(fd, 'w')
+        try:
+            json.dump(entry, outfile)
+        finally:
+            outfile.close()
+        os.rename(tmp, checksum_cache_path(st))
+    except (IOError, OSError):
+        # the cache is only an optimization
+        pass
+
+def file_digests(path, algorithms, use_cache=False):
+    '''
+    Return a dict of the hex digests of a file for the requested algorithms,
+    reading the file once for all of them. Algorithms which are not available
+    (such as md5 in FIPS mode) are left out. With use_cache, digests cached
+    by earlier runs are reused and new ones are added to the cache
+    '''
+    algorithms = [a for a in algorithms if a in AVAILABLE_HASH_ALGORITHMS]
+    digests = {}
+    if use_cache:
+        st = os.stat(path)
+        cached = load_cached_digests(st)
+        for algorithm in algorithms:
+            if algorithm in cached:
+                digests[algorithm] = cached[algorithm]
+
+    missing = [(a, AVAILABLE_HASH_ALGORITHMS[a]()) for a in algorithms if a not in digests]
+    if missing:
+        infile = open(path, 'rb')
+        try:
+            while True:
+                block = infile.read(64 * 1024)
+                if not block:
+                    break
+                for (algorithm, digest) in missing:
+                    digest.update(block)
+        finally:
+            infile.close()
+        for (algorithm, digest) in missing:
+            digests[algorithm] = digest.hexdigest()
+        # don't cache digests of a file which changed while it was read
+        if use_cache and checksum_cache_stamp(os.stat(path)) == checksum_cache_stamp(st):
+            cache_digests(path, digests)
+    return digests
+
+# ===========================================
+# Download cache, shared with the get_url and uri modules. Downloads are
+# stored once under cache_dir/objects by their sha256, cache_dir/urls maps
+# each request to its object and the validators it was served with. Objects
+# which weren't used for the longest time are evicted first
+
+def cache_url_path(cache_dir, url, identity=None):
+    # a download is only served again to requests with the same credentials
+    # and headers as the one it was fetched with
+    key = AVAILABLE_HASH_ALGORITHMS['sha1'](json.dumps([url, identity])).hexdigest()
+    return os.path.join(cache_dir, 'urls', '%s.json' % key)
+
+def cache_object_path(cache_dir, sha256):
+    return os.path.join(cache_dir, 'objects', sha256)
+
+def clone_file(src, dest):
+    '''
+    Copy src to dest, sharing the data blocks with a reflink where the
+    filesystem supports it
+    '''
+    infile = open(src, 'rb')
+    try:
+        outfile = open(dest, 'wb')
+        try:
+            if HAS_FCNTL:
+                try:
+                    # FICLONE, only on Linux filesystems such as btrfs and xfs
+                    fcntl.ioctl(outfile.fileno(), 0x40049409, infile.fileno())
+                    return
+                except (IOError, OSError):
+                    pass
+            shutil.copyfileobj(infile, outfile, 64 * 1024)
+        finally:
+            outfile.close()
+    finally:
+        infile.close()
+
+def load_cache_entry(cache_dir, url, identity=None):
+    ''' Return the cache entry of url, if its object is still cached '''
+    try:
+        infile = open(cache_url_path(cache_dir, url, identity))
+        try:
+            entry = json.load(infile)
+        finally:
+            infile.close()
+    except (IOError, ValueError):
+        return None
+    if not isinstance(entry, dict) or not os.path.isfile(cache_object_path(cache_dir, entry.get('sha256', ''))):
+        return None
+    return entry
+
+def cache_validators(entry):
+    ''' Return the headers to revalidate a cache entry with '''
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last-modified'):
+        headers['If-Modified-Since'] = entry['last-modified']
+    return headers
+
+def evict_cache(cache_dir, max_size, keep=None):
+    objects_dir = os.path.join(cache_dir, 'objects')
+    objects = []
+    total = 0
+    for name in os.listdir(objects_dir):
+        path = os.path.join(objects_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        objects.append((st.st_mtime, st.st_size, path))
+        total += st.st_size
+    objects.sort()
+    for (mtime, size, path) in objects:
+        if total <= max_size:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+def store_in_cache(cache_dir, url, path, sha256, headers, max_size, identity=None):
+    '''
+    Add the download of url in path to the cache and record the
+    validators it was served with
+    '''
+    try:
+        for subdir in ('objects', 'urls'):
+            if not os.path.isdir(os.path.join(cache_dir, subdir)):
+                # downloads can be private, only their owner may read them
+                os.makedirs(os.path.join(cache_dir, subdir), 0700)
+        obj = cache_object_path(cache_dir, sha256)
+        try:
+            # mark it as recently used, if it is already cached
+            os.utime(obj, None)
+        except OSError:
+            fd, tmp = tempfile.mkstemp(prefix='.object-', dir=os.path.dirname(obj))
+            os.close(fd)
+            clone_file(path, tmp)
+            os.chmod(tmp, 0600)
+            os.rename(tmp, obj)
+        entry = {'url': url, 'sha256': sha256, 'etag': headers.get('etag'),
+                 'last-modified': headers.get('last-modified')}
+        fd, tmp = tempfile.mkstemp(prefix='.url-', dir=os.path.join(cache_dir, 'urls'))
+        outfile = os.fdopen(fd, 'w')
+        try:
+            json.dump(entry, outfile)
+        finally:
+            outfile.close()
+        os.rename(tmp, cache_url_path(cache_dir, url, identity))
+        evict_cache(cache_dir, max_size, keep=obj)
+    except (IOError, OSError):
+        # the cache is only an optimization
+        pass
+
+def place_from_cache(cache_dir, sha256, tmp_dir, hardlink=False):
+    '''
+    Return a temporary file in tmp_dir with the content of a cached
+    object, a hard link to it if requested and possible, and whether it
+    is a link. Returns None if another run evicted the object meanwhile
+    '''
+    obj = cache_object_path(cache_dir, sha256)
+    try:
+        # mark it as recently used
+        os.utime(obj, None)
+    except OSError:
+        return None
+    fd, tmp = tempfile.mkstemp(prefix='.cached-', dir=tmp_dir)
+    os.close(fd)
+    if hardlink:
+        try:
+            os.remove(tmp)
+            os.link(obj, tmp)
+            return tmp, True
+        except OSError:
+            pass
+    try:
+        clone_file(obj, tmp)
+    except (IOError, OSError):
+        os.remove(tmp)
+        return None
+    return tmp, False
+
 # ==============================================================
 # url handling
 
@@ -140,32 +435,205 @@ def url_filename(url):
         return 'index.html'
     return fn
 
-def url_get(module, url, dest, use_proxy, last_mod_time, force, timeout=10):
+# files smaller than this are not worth splitting in ranges
+PARALLEL_MIN_SIZE = 8 * 1024 * 1024
+
+def partial_path(url, dest, tmp_dir):
+    key = AVAILABLE_HASH_ALGORITHMS['sha1']('%s\0%s' % (url, dest)).hexdigest()
+    return os.path.join(tmp_dir, '.get_url-%s.part' % key)
+
+def load_validator(partial):
+    ''' return the ETag or Last-Modified a partial download was started with '''
+    try:
+        infile = open(partial + '.json')
+        try:
+            return json.load(infile).get('validator')
+        finally:
+            infile.close()
+    except (IOError, ValueError, AttributeError):
+        return None
+
+def save_validator(partial, validator):
+    try:
+        if validator is None:
+            if os.path.exists(partial + '.json'):
+                os.remove(partial + '.json')
+            return
+        outfile = open(partial + '.json', 'w')
+        try:
+            json.dump(dict(validator=validator), outfile)
+        finally:
+            outfile.close()
+    except (IOError, OSError):
+        pass
+
+def discard_partial(partial):
+    for path in (partial, partial + '.json'):
+        if os.path.exists(path):
+            os.remove(path)
+
+def content_range_start(info):
+    match = re.match(r'bytes (\d+)-', info.get('content-range', ''))
+    if match:
+        return int(match.group(1))
+    return None
+
+def fetch_ranges(module, url, rsp, path, length, parallel, use_proxy, timeout, validator):
+    '''
+    Fetch length bytes of url into path, the first range from the already
+    open response and the others with range requests on their own threads.
+    The range requests carry the validator of the first response, so a
+    file which changed in between is not stitched together
+    '''
+    segment = (length + parallel - 1) // parallel
+    ranges = [(start, min(length, start + segment) - 1) for start in range(0, length, segment)]
+    out = open(path, 'wb')
+    out.truncate(length)
+    out.close()
+    errors = []
+
+    def fetch(start, end, stream=None):
+        try:
+            if stream is None:
+                stream = open_url(url, headers={'Range': 'bytes=%d-%d' % (start, end), 'If-Range': validator},
+                        use_proxy=use_proxy, timeout=timeout,
+                        validate_certs=module.params.get('validate_certs', True),
+                        url_username=module.params.get('url_username', ''),
+                        url_password=module.params.get('url_password', ''),
+                        http_agent=module.params.get('http_agent', None),
+                        force_basic_auth=module.params.get('force_basic_auth', ''))
+                if stream.getcode() == 200:
+                    stream.close()
+                    raise IOError('%s changed during the download' % url)
+                if stream.getcode() != 206:
+                    stream.close()
+                    raise IOError('range request for bytes %d-%d was answered with %s' % (start, end, stream.getcode()))
+            try:
+                out = open(path, 'r+b')
+                try:
+                    out.seek(start)
+                    remaining = end - start + 1
+                    while remaining > 0:
+                        block = stream.read(min(remaining, 64 * 1024))
+                        if not block:
+                            raise IOError('connection closed %d bytes before the end of range %d-%d' % (remaining, start, end))
+                        out.write(block)
+                        remaining -= len(block)
+                finally:
+                    out.close()
+            finally:
+                stream.close()
+        except Exception, e:
+            errors.append(e)
+
+    threads = []
+    for (start, end) in ranges[1:]:
+        t = threading.Thread(target=fetch, args=(start, end))
+        t.start()
+        threads.append(t)
+    fetch(ranges[0][0], ranges[0][1], rsp)
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+def url_get(module, url, dest, use_proxy, last_mod_time, force, timeout=10,
+            tmp_dir=None, algorithms=(), parallel=1, cache_headers=None):
     """
-    Download data from the url and store in a temporary file.
+    Download data from the url and store in a temporary file in tmp_dir,
+    resuming an earlier partial download of it if possible.
 
-    Return (tempfile, info about the request)
+    Return (tempfile, info about the request, digests of the data), with
+    no tempfile if the cache_headers show the cached download is current
     """
 
-    rsp, info = fetch_url(module, url, use_proxy=use_proxy, force=force, last_mod_time=last_mod_time, timeout=timeout)
+    partial = partial_path(url, dest, tmp_dir)
+    offset = 0
+    headers = dict(cache_headers or {})
+    validator = load_validator(partial)
+    if validator is not None and os.path.exists(partial):
+        offset = os.path.getsize(partial)
+        if offset:
+            headers.update({'Range': 'bytes=%d-' % offset, 'If-Range': validator})
+
+    rsp, info = fetch_url(module, url, headers=headers or None, use_proxy=use_proxy, force=force, last_mod_time=last_mod_time, timeout=timeout)
 
     if info['status'] == 304:
+        if cache_headers:
+            return None, info, None
         module.exit_json(url=url, dest=dest, changed=False, msg=info.get('msg', ''))
 
+    if offset and (info['status'] == 416 or (rsp is not None and rsp.getcode() == 206 and content_range_start(info) != offset)):
+        # the partial download can't be resumed, start over
+        if rsp is not None:
+            rsp.close()
+        discard_partial(partial)
+        return url_get(module, url, dest, use_proxy, last_mod_time, force, timeout, tmp_dir, algorithms, parallel, cache_headers)
+
     # create a temporary file and copy content to do checksum-based replacement
     if info['status'] != 200:
         module.fail_json(msg="Request failed", status_code=info['status'], response=info['msg'], url=url, dest=dest)
 
-    fd, tempname = tempfile.mkstemp()
-    f = os.fdopen(fd, 'wb')
+    if rsp.getcode() != 206:
+        offset = 0
+    validator = info.get('etag') or info.get('last-modified')
+    length = info.get('content-length')
+    if length is not None:
+        length = int(length)
+
+    digests = [(a, AVAILABLE_HASH_ALGORITHMS[a]()) for a in algorithms if a in AVAILABLE_HASH_ALGORITHMS]
     try:
-        shutil.copyfileobj(rsp, f)
+        if offset:
+            # the data already downloaded goes into the digests first
+            f = open(partial, 'rb')
+            try:
+                while True:
+                    block = f.read(64 * 1024)
+                    if not block:
+                        break
+                    for (algorithm, digest) in digests:
+                        digest.update(block)
+            finally:
+                f.close()
+        save_validator(partial, validator)
+
+        if parallel > 1 and not offset and length is not None and length >= PARALLEL_MIN_SIZE \
+                and info.get('accept-ranges') == 'bytes' and validator:
+            # a file with holes can't be resumed
+            save_validator(partial, None)
+            range_validator = validator
+            validator = None
+            fetch_ranges(module, info['url'], rsp, partial, length, parallel, use_proxy, timeout, range_validator)
+            # the ranges arrive out of order, so hash the result in one pass
+            digests = file_digests(partial, [a for (a, d) in digests])
+        else:
+            if offset:
+                f = open(partial, 'ab')
+            else:
+                f = open(partial, 'wb')
+            try:
+                received = 0
+                while True:
+                    block = rsp.read(64 * 1024)
+                    if not block:
+                        break
+                    f.write(block)
+                    received += len(block)
+                    for (algorithm, digest) in digests:
+                        digest.update(block)
+            finally:
+                f.close()
+            rsp.close()
+            if length is not None and received < length:
+                raise IOError('connection closed after %d of %d bytes' % (offset + received, offset + length))
+            digests = dict([(a, d.hexdigest()) for (a, d) in digests])
     except Exception, err:
-        os.remove(tempname)
+        if validator is None:
+            discard_partial(partial)
         module.fail_json(msg="failed to create temporary content file: %s" % str(err))
-    f.close()
-    rsp.close()
-    return tempname, info
+
+    save_validator(partial, None)
+    return partial, info, digests
 
 def extract_filename_from_headers(headers):
     """
@@ -197,6 +665,11 @@ def main():
         dest = dict(required=True),
         sha256sum = dict(default=''),
         timeout = dict(required=False, type='int', default=10),
+        checksum_cache = dict(default=False, type='bool'),
+        parallel = dict(required=False, type='int', default=1),
+        cache_dir = dict(required=False, default=None),
+        cache_size = dict(required=False, type='int', default=1024),
+        cache_hardlink = dict(default=False, type='bool'),
     )
 
     module = AnsibleModule(
@@ -211,21 +684,112 @@ def main():
     sha256sum = module.params['sha256sum']
     use_proxy = module.params['use_proxy']
     timeout = module.params['timeout']
+    checksum_cache = module.params['checksum_cache']
+    parallel = module.params['parallel']
+    cache_dir = module.params['cache_dir']
+    cache_hardlink = module.params['cache_hardlink']
+    if cache_dir is not None:
+        cache_dir = os.path.expanduser(cache_dir)
+
+    # Remove any non-alphanumeric characters, including the infamous
+    # Unicode zero-width space
+    stripped_sha256sum = re.sub(r'\W+', '', sha256sum).lower()
+    if sha256sum != '' and not HAS_HASHLIB:
+        module.fail_json(msg="The sha256sum parameter requires hashlib, which is available in Python 2.5 and higher")
 
     dest_is_dir = os.path.isdir(dest)
     last_mod_time = None
 
+    # compute everything that will be reported or checked in one pass,
+    # dest has the same content once it has been replaced
+    algorithms = ['sha1', 'md5']
+    if sha256sum != '' or cache_dir is not None:
+        algorithms.append('sha256')
+
     if not dest_is_dir and os.path.exists(dest):
         if not force:
             module.exit_json(msg="file already exists", dest=dest, url=url, changed=False)
 
+        if sha256sum != '' and os.access(dest, os.R_OK):
+            # the expected content is already there, no need to download it
+            digests_dest = file_digests(dest, algorithms, checksum_cache)
+            if digests_dest['sha256'] == stripped_sha256sum:
+                file_args = module.load_file_common_arguments(module.params)
+                file_args['path'] = dest
+                changed = module.set_fs_attributes_if_different(file_args, False)
+                module.exit_json(url=url, dest=dest, md5sum=digests_dest.get('md5'),
+                    checksum=digests_dest['sha1'], sha256sum=sha256sum, changed=changed,
+                    msg="file already has the expected sha256sum")
+
         # If the file already exists, prepare the last modified time for the
         # request.
         mtime = os.path.getmtime(dest)
         last_mod_time = datetime.datetime.utcfromtimestamp(mtime)
 
-    # download to tmpsrc
-    tmpsrc, info = url_get(module, url, dest, use_proxy, last_mod_time, force, timeout)
+    # download next to dest, so it can be renamed into place
+    if dest_is_dir:
+        tmp_dir = dest
+    else:
+        tmp_dir = os.path.dirname(os.path.abspath(dest))
+    if not os.access(tmp_dir, os.W_OK):
+        tmp_dir = tempfile.gettempdir()
+
+    tmpsrc = None
+    cached = None
+    linked = False
+    cache_headers = None
+    # the credentials a download was fetched with, see cache_url_path()
+    identity = [module.params.get('url_username'), module.params.get('url_password'),
+                module.params.get('force_basic_auth')]
+    if cache_dir is not None:
+        if sha256sum != '' and os.path.isfile(cache_object_path(cache_dir, stripped_sha256sum)):
+            # any url with the expected content will do
+            cached = stripped_sha256sum
+            info = dict(url=url, status=200, msg='OK (cached)')
+        else:
+            entry = load_cache_entry(cache_dir, url, identity)
+            if entry is not None:
+                cache_headers = cache_validators(entry)
+                if cache_headers:
+                    # revalidate the cached download rather than dest
+                    last_mod_time = None
+
+    if cached is not None:
+        placed = place_from_cache(cache_dir, cached, tmp_dir, cache_hardlink)
+        if placed is None:
+            # evicted by another run since it was looked up
+            cached = None
+
+    if cached is None:
+        # download to tmpsrc
+        tmpsrc, info, digests_src = url_get(module, url, dest, use_proxy, last_mod_time, force, timeout,
+                                            tmp_dir, algorithms, parallel, cache_headers)
+        if tmpsrc is None:
+            # not modified since it was cached
+            placed = place_from_cache(cache_dir, entry['sha256'], tmp_dir, cache_hardlink)
+            if placed is None:
+                # evicted by another run meanwhile, download it after all
+                tmpsrc, info, digests_src = url_get(module, url, dest, use_proxy, None, force, timeout,
+                                                    tmp_dir, algorithms, parallel)
+            else:
+                cached = entry['sha256']
+                info['msg'] = 'OK (cached)'
+        if tmpsrc is not None and cache_dir is not None:
+            store_in_cache(cache_dir, url, tmpsrc, digests_src['sha256'], info,
+                           module.params['cache_size'] * 1024 * 1024, identity)
+            if cache_hardlink:
+                placed = place_from_cache(cache_dir, digests_src['sha256'], tmp_dir, True)
+                if placed is not None:
+                    os.remove(tmpsrc)
+                    cached = digests_src['sha256']
+
+    if cached is not None:
+        tmpsrc, linked = placed
+        # objects don't change, so their digests are worth caching
+        try:
+            digests_src = file_digests(cache_object_path(cache_dir, cached), algorithms, checksum_cache)
+        except (IOError, OSError):
+            digests_src = file_digests(tmpsrc, algorithms)
 
     # Now the request has completed, we can finally generate the final
     # destination file name from the info dict.
@@ -239,18 +803,9 @@ def main():
             filename = url_filename(info['url'])
         dest = os.path.join(dest, filename)
 
-    checksum_src   = None
+    checksum_src   = digests_src['sha1']
     checksum_dest  = None
 
-    # raise an error if there is no tmpsrc file
-    if not os.path.exists(tmpsrc):
-        os.remove(tmpsrc)
-        module.fail_json(msg="Request failed", status_code=info['status'], response=info['msg'])
-    if not os.access(tmpsrc, os.R_OK):
-        os.remove(tmpsrc)
-        module.fail_json( msg="Source %s not readable" % (tmpsrc))
-    checksum_src = module.sha1(tmpsrc)
-
     # check if there is no dest file
     if os.path.exists(dest):
         # raise an error if copy has no permission on dest
@@ -260,52 +815,47 @@ def main():
         if not os.access(dest, os.R_OK):
             os.remove(tmpsrc)
             module.fail_json( msg="Destination %s not readable" % (dest))
-        checksum_dest = module.sha1(dest)
+        checksum_dest = file_digests(dest, ['sha1'], checksum_cache)['sha1']
     else:
         if not os.access(os.path.dirname(dest), os.W_OK):
             os.remove(tmpsrc)
             module.fail_json( msg="Destination %s not writable" % (os.path.dirname(dest)))
 
+    # Check the digest of the downloaded file and ensure that it matches the
+    # sha256sum parameter if it is present, before it replaces dest
+    if sha256sum != '':
+        destination_checksum = digests_src['sha256']
+        if stripped_sha256sum != destination_checksum:
+            os.remove(tmpsrc)
+            module.fail_json(msg="The SHA-256 checksum for %s did not match %s; it was %s." % (dest, sha256sum, destination_checksum))
+
     if checksum_src != checksum_dest:
         try:
-            shutil.copyfile(tmpsrc, dest)
+            if linked:
+                # atomic_move would change the attributes of the cached object
+                os.rename(tmpsrc, dest)
+            else:
+                module.atomic_move(tmpsrc, dest)
         except Exception, err:
-            os.remove(tmpsrc)
-            module.fail_json(msg="failed to copy %s to %s: %s" % (tmpsrc, dest, str(err)))
+            if os.path.exists(tmpsrc):
+                os.remove(tmpsrc)
+            module.fail_json(msg="failed to move %s to %s: %s" % (tmpsrc, dest, str(err)))
         changed = True
     else:
+        os.remove(tmpsrc)
         changed = False
 
-    # Check the digest of the destination file and ensure that it matches the
-    # sha256sum parameter if it is present
-    if sha256sum != '':
-        # Remove any non-alphanumeric characters, including the infamous
-        # Unicode zero-width space
-        stripped_sha256sum = re.sub(r'\W+', '', sha256sum)
-
-        if not HAS_HASHLIB:
-            os.remove(dest)
-            module.fail_json(msg="The sha256sum parameter requires hashlib, which is available in Python 2.5 and higher")
-        else:
-            destination_checksum = module.sha256(dest)
-
-        if stripped_sha256sum.lower() != destination_checksum:
-            os.remove(dest)
-            module.fail_json(msg="The SHA-256 checksum for %s did not match %s; it was %s." % (dest, sha256sum, destination_checksum))
-
-    os.remove(tmpsrc)
-
     # allow file attribute changes
     module.params['path'] = dest
     file_args = module.load_file_common_arguments(module.params)
     file_args['path'] = dest
     changed = module.set_fs_attributes_if_different(file_args, changed)
 
+    if checksum_cache:
+        cache_digests(dest, digests_src)
+
     # Backwards compat only.  We'll return None on FIPS enabled systems
-    try:
-        md5sum = module.md5(dest)
-    except ValueError:
-        md5sum = None
+    md5sum = digests_src.get('md5')
 
     # Mission complete
 
@@ -34,8 +34,34 @@ options:
     required: true
     default: null
     aliases: []
+  offset:
+    description:
+      - Byte offset in the file to start reading at. A negative offset is
+        counted back from the end of the file.
+    required: false
+    default: 0
+    version_added: "2.0"
+  length:
+    description:
+      - Maximum number of bytes to read, by default the rest of the file.
+        Large files can be fetched in pieces by calling the module again
+        with the returned C(next_offset) until C(eof) is true, so that
+        neither the remote node nor the controller holds the whole file.
+    required: false
+    default: null
+    version_added: "2.0"
+  compression:
+    description:
+      - Compress the data before it is encoded. The returned C(compression)
+        tells how to decompress the decoded content.
+    required: false
+    choices: [ "none", "gzip", "zlib" ]
+    default: "none"
+    version_added: "2.0"
 notes:
    - "See also: M(fetch)"
+   - The file is read, compressed and encoded in chunks, so only the encoded
+     result is held in memory.
 requirements: []
 author: Michael DeHaan
 '''
@@ -46,27 +72,102 @@ ansible host -m slurp -a 'src=/tmp/xx'
       "content": "aGVsbG8gQW5zaWJsZSB3b3JsZAo=", 
       "encoding": "base64"
    }
+
+# Fetch the last megabyte of a log, gzip compressed
+- slurp: src=/var/log/messages offset=-1048576 compression=gzip
 '''
 
 import base64
+import zlib
+
+# read size, a multiple of 3 so the chunks encode to contiguous base64
+CHUNK_SIZE = 3 * 64 * 1024
+
+def read_range(infile, length):
+    ''' yield chunks of up to length bytes from the current position '''
+    while length is None or length > 0:
+        size = CHUNK_SIZE
+        if length is not None:
+            size = min(size, length)
+        block = infile.read(size)
+        if not block:
+            break
+        if length is not None:
+            length -= len(block)
+        yield block
+
+def compress_chunks(chunks, compression):
+    if compression == 'none':
+        for block in chunks:
+            yield block
+        return
+    if compression == 'gzip':
+        # wbits + 16 writes a gzip header and trailer
+        compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS + 16)
+    else:
+        compressor = zlib.compressobj(6)
+    for block in chunks:
+        block = compressor.compress(block)
+        if block:
+            yield block
+    yield compressor.flush()
+
+def encode_chunks(chunks):
+    ''' base64 encode a stream of chunks without joining them first '''
+    encoded = []
+    pending = ''
+    for block in chunks:
+        pending += block
+        cut = len(pending) - len(pending) % 3
+        if cut:
+            encoded.append(base64.b64encode(pending[:cut]))
+            pending = pending[cut:]
+    if pending:
+        encoded.append(base64.b64encode(pending))
+    return ''.join(encoded)
 
 def main():
     module = AnsibleModule(
         argument_spec = dict(
             src = dict(required=True, aliases=['path']),
+            offset = dict(default=0, type='int'),
+            length = dict(default=None, type='int'),
+            compression = dict(default='none', choices=['none', 'gzip', 'zlib']),
         ),
         supports_check_mode=True
     )
     source = os.path.expanduser(module.params['src'])
+    offset = module.params['offset']
+    length = module.params['length']
+    compression = module.params['compression']
 
     if not os.path.exists(source):
         module.fail_json(msg="file not found: %s" % source)
     if not os.access(source, os.R_OK):
         module.fail_json(msg="file is not readable: %s" % source)
+    if length is not None and length < 0:
+        module.fail_json(msg="length must not be negative: %s" % length)
 
-    data = base64.b64encode(file(source).read())
+    infile = open(source, 'rb')
+    try:
+        size = os.fstat(infile.fileno()).st_size
+        if offset < 0:
+            offset = max(0, size + offset)
+        if offset:
+            infile.seek(offset)
+        read = [0]
+        def counted(chunks):
+            for block in chunks:
+                read[0] += len(block)
+                yield block
+        data = encode_chunks(compress_chunks(counted(read_range(infile, length)), compression))
+    finally:
+        infile.close()
 
-    module.exit_json(content=data, source=source, encoding='base64')
+    next_offset = offset + read[0]
+    module.exit_json(content=data, source=source, encoding='base64', compression=compression,
+                     offset=offset, length=read[0], size=size, next_offset=next_offset,
+                     eof=next_offset >= size)
 
 # import module snippets
 from ansible.module_utils.basic import *
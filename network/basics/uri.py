@@ -25,10 +25,18 @@ import shutil
 import tempfile
 import base64
 import datetime
+import time
+import threading
+import Queue
 try:
     import json
 except ImportError:
     import simplejson as json
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
 
 DOCUMENTATION = '''
 ---
@@ -42,7 +50,8 @@ options:
   url:
     description:
       - HTTP or HTTPS URL in the form (http|https)://host.domain[:port]/path
-    required: true
+      - Required unless C(requests) is given.
+    required: false
     default: null
     aliases: []
   dest:
@@ -121,6 +130,25 @@ options:
       - The socket level timeout in seconds 
     required: false
     default: 30
+  requests:
+    description:
+      - A list of requests to make in one task, each a hash with a C(url) and
+        optionally C(method), C(body), C(body_format), C(status_code),
+        C(return_content) and C(headers), which default to the options of the
+        task. Connections are kept alive and reused between the requests to the
+        same host. The result has a C(results) list with the status, response
+        headers and C(elapsed) time of each request, in order, and the task
+        fails if any of them didn't return one of its status codes.
+      - May not be used with C(url) or C(dest).
+    required: false
+    default: null
+    version_added: "2.0"
+  concurrency:
+    description:
+      - Number of C(requests) made at the same time, each on its own connections.
+    required: false
+    default: 4
+    version_added: "2.0"
   HEADER_:
     description:
       - Any parameter starting with "HEADER_" is a sent with your request as a header.
@@ -128,6 +156,34 @@ options:
         "Content-Type" along with your request with a value of "application/json".
     required: false
     default: null
+  cache_dir:
+    description:
+      - Directory of a download cache shared with the M(get_url) module, used
+        when I(dest) is set and the method is C(GET). Downloads are stored there
+        by their sha256 and revalidated with the ETag or Last-Modified they were
+        served with, so a url is only transferred once per host.
+      - A download is only reused by requests with the same I(user),
+        I(password) and headers. The directories are created readable by
+        their owner only.
+    required: false
+    default: null
+    version_added: "2.0"
+  cache_size:
+    description:
+      - Size in megabytes the download cache is kept under, by evicting the least
+        recently used downloads.
+    required: false
+    default: 1024
+    version_added: "2.0"
+  cache_hardlink:
+    description:
+      - Place cached downloads with a hard link rather than a copy. The file
+        attributes of I(dest) then also apply to the cached copy, and I(dest) must
+        not be modified in place.
+    required: false
+    default: "no"
+    choices: [ "yes", "no" ]
+    version_added: "2.0"
   others:
     description:
       - all arguments accepted by the M(file) module also work here
@@ -196,6 +252,15 @@ EXAMPLES = '''
     force_basic_auth: yes
     status_code: 201
 
+# Check a list of health endpoints, reusing connections between them
+- uri:
+    requests:
+      - { url: "http://app.example.com/health" }
+      - { url: "http://app.example.com/ready", status_code: [200, 204] }
+      - { url: "http://api.example.com/v1/items", method: POST, body: { name: foo }, body_format: json, status_code: 201 }
+    concurrency: 2
+  register: checks
+
 '''
 
 HAS_HTTPLIB2 = True
@@ -212,7 +277,153 @@ try:
 except ImportError:
     HAS_URLPARSE = False
 
-def write_file(module, url, dest, content):
+# ===========================================
+# Download cache, shared with the get_url and uri modules. Downloads are
+# stored once under cache_dir/objects by their sha256, cache_dir/urls maps
+# each request to its object and the validators it was served with. Objects
+# which weren't used for the longest time are evicted first
+
+def cache_url_path(cache_dir, url, identity=None):
+    # a download is only served again to requests with the same credentials
+    # and headers as the one it was fetched with
+    key = AVAILABLE_HASH_ALGORITHMS['sha1'](json.dumps([url, identity])).hexdigest()
+    return os.path.join(cache_dir, 'urls', '%s.json' % key)
+
+def cache_object_path(cache_dir, sha256):
+    return os.path.join(cache_dir, 'objects', sha256)
+
+def clone_file(src, dest):
+    '''
+    Copy src to dest, sharing the data blocks with a reflink where the
+    filesystem supports it
+    '''
+    infile = open(src, 'rb')
+    try:
+        outfile = open(dest, 'wb')
+        try:
+            if HAS_FCNTL:
+                try:
+                    # FICLONE, only on Linux filesystems such as btrfs and xfs
+                    fcntl.ioctl(outfile.fileno(), 0x40049409, infile.fileno())
+                    return
+                except (IOError, OSError):
+                    pass
+            shutil.copyfileobj(infile, outfile, 64 * 1024)
+        finally:
+            outfile.close()
+    finally:
+        infile.close()
+
+def load_cache_entry(cache_dir, url, identity=None):
+    ''' Return the cache entry of url, if its object is still cached '''
+    try:
+        infile = open(cache_url_path(cache_dir, url, identity))
+        try:
+            entry = json.load(infile)
+        finally:
+            infile.close()
+    except (IOError, ValueError):
+        return None
+    if not isinstance(entry, dict) or not os.path.isfile(cache_object_path(cache_dir, entry.get('sha256', ''))):
+        return None
+    return entry
+
+def cache_validators(entry):
+    ''' Return the headers to revalidate a cache entry with '''
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last-modified'):
+        headers['If-Modified-Since'] = entry['last-modified']
+    return headers
+
+def evict_cache(cache_dir, max_size, keep=None):
+    objects_dir = os.path.join(cache_dir, 'objects')
+    objects = []
+    total = 0
+    for name in os.listdir(objects_dir):
+        path = os.path.join(objects_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        objects.append((st.st_mtime, st.st_size, path))
+        total += st.st_size
+    objects.sort()
+    for (mtime, size, path) in objects:
+        if total <= max_size:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+def store_in_cache(cache_dir, url, path, sha256, headers, max_size, identity=None):
+    '''
+    Add the download of url in path to the cache and record the
+    validators it was served with
+    '''
+    try:
+        for subdir in ('objects', 'urls'):
+            if not os.path.isdir(os.path.join(cache_dir, subdir)):
+                # downloads can be private, only their owner may read them
+                os.makedirs(os.path.join(cache_dir, subdir), 0700)
+        obj = cache_object_path(cache_dir, sha256)
+        try:
+            # mark it as recently used, if it is already cached
+            os.utime(obj, None)
+        except OSError:
+            fd, tmp = tempfile.mkstemp(prefix='.object-', dir=os.path.dirname(obj))
+            os.close(fd)
+            clone_file(path, tmp)
+            os.chmod(tmp, 0600)
+            os.rename(tmp, obj)
+        entry = {'url': url, 'sha256': sha256, 'etag': headers.get('etag'),
+                 'last-modified': headers.get('last-modified')}
+        fd, tmp = tempfile.mkstemp(prefix='.url-', dir=os.path.join(cache_dir, 'urls'))
+        outfile = os.fdopen(fd, 'w')
+        try:
+            json.dump(entry, outfile)
+        finally:
+            outfile.close()
+        os.rename(tmp, cache_url_path(cache_dir, url, identity))
+        evict_cache(cache_dir, max_size, keep=obj)
+    except (IOError, OSError):
+        # the cache is only an optimization
+        pass
+
+def place_from_cache(cache_dir, sha256, tmp_dir, hardlink=False):
+    '''
+    Return a temporary file in tmp_dir with the content of a cached
+    object, a hard link to it if requested and possible, and whether it
+    is a link. Returns None if another run evicted the object meanwhile
+    '''
+    obj = cache_object_path(cache_dir, sha256)
+    try:
+        # mark it as recently used
+        os.utime(obj, None)
+    except OSError:
+        return None
+    fd, tmp = tempfile.mkstemp(prefix='.cached-', dir=tmp_dir)
+    os.close(fd)
+    if hardlink:
+        try:
+            os.remove(tmp)
+            os.link(obj, tmp)
+            return tmp, True
+        except OSError:
+            pass
+    try:
+        clone_file(obj, tmp)
+    except (IOError, OSError):
+        os.remove(tmp)
+        return None
+    return tmp, False
+
+def write_file(module, url, dest, content, cache_dir=None, cache_size=None, headers=None, identity=None):
     # create a tempfile with some test content
     fd, tmpsrc = tempfile.mkstemp()
     f = open(tmpsrc, 'wb')
@@ -222,7 +433,15 @@ def write_file(module, url, dest, content):
         os.remove(tmpsrc)
         module.fail_json(msg="failed to create temporary content file: %s" % str(err))
     f.close()
- 
+
+    if cache_dir is not None:
+        sha256 = AVAILABLE_HASH_ALGORITHMS['sha256'](content).hexdigest()
+        store_in_cache(cache_dir, url, tmpsrc, sha256, headers, cache_size, identity)
+
+    replace_file(module, tmpsrc, dest)
+
+def replace_file(module, tmpsrc, dest, linked=False):
+    """ Move tmpsrc over dest if their contents differ, return whether they did """
     checksum_src   = None
     checksum_dest  = None
  
@@ -252,12 +471,17 @@ def write_file(module, url, dest, content):
 
     if checksum_src != checksum_dest:
         try:
+            if linked:
+                # copying would change the cached object through the link
+                os.rename(tmpsrc, dest)
+                return True
             shutil.copyfile(tmpsrc, dest)
         except Exception, err:
             os.remove(tmpsrc)
             module.fail_json(msg="failed to copy %s to %s: %s" % (tmpsrc, dest, str(err)))
 
     os.remove(tmpsrc)
+    return checksum_src != checksum_dest
 
 
 def url_filename(url):
@@ -267,10 +491,7 @@ def url_filename(url):
     return fn
 
 
-def uri(module, url, dest, user, password, body, body_format, method, headers, redirects, socket_timeout, validate_certs):
-    # To debug
-    #httplib2.debug = 4
-
+def build_http(module, user, password, redirects, socket_timeout, validate_certs):
     # Handle Redirects
     if redirects == "all" or redirects == "yes":
         follow_redirects = True
@@ -297,6 +518,42 @@ def uri(module, url, dest, user, password, body, body_format, method, headers, r
     if user is not None and password is not None:
         h.add_credentials(user, password)
 
+    return h, follow_redirects
+
+
+def request_error_message(e, url):
+    """ Return the message for an error raised by a request, None if it is unexpected """
+    if isinstance(e, httplib2.RedirectMissingLocation):
+        return "A 3xx redirect response code was provided but no Location: header was provided to point to the new location."
+    if isinstance(e, httplib2.RedirectLimit):
+        return "The maximum number of redirections was reached without coming to a final URI."
+    if isinstance(e, httplib2.ServerNotFoundError):
+        return "Unable to resolve the host name given."
+    if isinstance(e, httplib2.RelativeURIError):
+        return "A relative, as opposed to an absolute URI, was passed in."
+    if isinstance(e, httplib2.FailedToDecompressContent):
+        return "The headers claimed that the content of the response was compressed but the decompression algorithm applied to the content failed."
+    if isinstance(e, httplib2.UnimplementedDigestAuthOptionError):
+        return "The server requested a type of Digest authentication that we are unfamiliar with."
+    if isinstance(e, httplib2.UnimplementedHmacDigestAuthOptionError):
+        return "The server requested a type of HMACDigest authentication that we are unfamiliar with."
+    if isinstance(e, httplib2.CertificateHostnameMismatch):
+        return "The server's certificate does not match with its hostname."
+    if isinstance(e, httplib2.SSLHandshakeError):
+        return "Unable to validate server's certificate against available CA certs."
+    if isinstance(e, socket.error):
+        return "Socket error: %s to %s" % (e, url)
+    return None
+
+
+def uri(module, url, dest, user, password, body, body_format, method, headers, redirects, socket_timeout, validate_certs, cache_headers=None):
+    # To debug
+    #httplib2.debug = 4
+
+    h, follow_redirects = build_http(module, user, password, redirects, socket_timeout, validate_certs)
+    # the validators added below are only for this request
+    headers = dict(headers)
+
     # is dest is set and is a directory, let's check if we get redirected and
     # set the filename from that url
     redirected = False
@@ -318,8 +575,11 @@ def uri(module, url, dest, user, password, body, body_format, method, headers, r
                 url = resp_redir['location']
                 redirected = True
             dest = os.path.join(dest, url_filename(url))
+        if cache_headers:
+            # revalidate the cached download rather than dest
+            headers.update(cache_headers)
         # if destination file already exist, only download if file newer
-        if os.path.exists(dest):
+        elif os.path.exists(dest):
             t = datetime.datetime.utcfromtimestamp(os.path.getmtime(dest))
             tstamp = t.strftime('%a, %d %b %Y %H:%M:%S +0000')
             headers['If-Modified-Since'] = tstamp
@@ -334,34 +594,118 @@ def uri(module, url, dest, user, password, body, body_format, method, headers, r
         r.update(resp_redir)
         r.update(resp)
         return r, content, dest
-    except httplib2.RedirectMissingLocation:
-        module.fail_json(msg="A 3xx redirect response code was provided but no Location: header was provided to point to the new location.")
-    except httplib2.RedirectLimit:
-        module.fail_json(msg="The maximum number of redirections was reached without coming to a final URI.")
-    except httplib2.ServerNotFoundError:
-        module.fail_json(msg="Unable to resolve the host name given.")
-    except httplib2.RelativeURIError:
-        module.fail_json(msg="A relative, as opposed to an absolute URI, was passed in.")
-    except httplib2.FailedToDecompressContent:
-        module.fail_json(msg="The headers claimed that the content of the response was compressed but the decompression algorithm applied to the content failed.")
-    except httplib2.UnimplementedDigestAuthOptionError:
-        module.fail_json(msg="The server requested a type of Digest authentication that we are unfamiliar with.")
-    except httplib2.UnimplementedHmacDigestAuthOptionError:
-        module.fail_json(msg="The server requested a type of HMACDigest authentication that we are unfamiliar with.")
-    except httplib2.UnimplementedHmacDigestAuthOptionError:
-        module.fail_json(msg="The server requested a type of HMACDigest authentication that we are unfamiliar with.")
-    except httplib2.CertificateHostnameMismatch:
-        module.fail_json(msg="The server's certificate does not match with its hostname.")
-    except httplib2.SSLHandshakeError:
-        module.fail_json(msg="Unable to validate server's certificate against available CA certs.")
-    except socket.error, e:
-        module.fail_json(msg="Socket error: %s to %s" % (e, url))
+    except Exception, e:
+        msg = request_error_message(e, url)
+        if msg is None:
+            raise
+        module.fail_json(msg=msg)
+
+
+def format_response(resp, content):
+    """ Return the response headers usable as variables, and the decoded content """
+    # Transmogrify the headers, replacing '-' with '_', since variables dont work with dashes.
+    uresp = {}
+    for key, value in resp.iteritems():
+        ukey = key.replace("-", "_")
+        uresp[ukey] = value
+
+    # Default content_encoding to try
+    content_encoding = 'utf-8'
+    if 'content_type' in uresp:
+        content_type, params = cgi.parse_header(uresp['content_type'])
+        if 'charset' in params:
+            content_encoding = params['charset']
+        u_content = unicode(content, content_encoding, errors='xmlcharrefreplace')
+        if content_type.startswith('application/json') or \
+                content_type.startswith('text/json'):
+            try:
+                js = json.loads(u_content)
+                uresp['json'] = js
+            except:
+                pass
+    else:
+        u_content = unicode(content, content_encoding, errors='xmlcharrefreplace')
+
+    return uresp, u_content
+
+
+def uri_batch(module, requests, user, password, body, method, body_format, status_code, return_content,
+              headers, redirects, socket_timeout, validate_certs, concurrency):
+    """
+    Make a list of requests, concurrency at a time. Each worker has its
+    own Http object, which keeps its connections alive between requests.
+    Returns the results in the order of the requests.
+    """
+    items = []
+    for (i, item) in enumerate(requests):
+        if not isinstance(item, dict) or not item.get('url'):
+            module.fail_json(msg="each of requests must be a hash with a url: %s" % (item,))
+        item_headers = dict(headers)
+        item_headers.update(item.get('headers') or {})
+        item_body = item.get('body', body)
+        if item.get('body_format', body_format) == 'json':
+            item_body = json.dumps(item_body)
+            item_headers['Content-Type'] = 'application/json'
+        item_status = item.get('status_code', status_code)
+        if not isinstance(item_status, list):
+            item_status = str(item_status).split(',')
+        items.append((i, item['url'], item.get('method', method).upper(), item_body, item_headers,
+                      [int(x) for x in item_status], module.boolean(item.get('return_content', return_content))))
+
+    # fail on bad credentials before any worker starts
+    build_http(module, user, password, redirects, socket_timeout, validate_certs)
+
+    queue = Queue.Queue()
+    for item in items:
+        queue.put(item)
+    results = [None] * len(items)
+
+    def worker():
+        h, follow_redirects = build_http(module, user, password, redirects, socket_timeout, validate_certs)
+        while True:
+            try:
+                (i, url, item_method, item_body, item_headers, item_status, item_content) = queue.get_nowait()
+            except Queue.Empty:
+                return
+            result = dict(url=url, method=item_method)
+            start = time.time()
+            try:
+                try:
+                    resp, content = h.request(url, method=item_method, body=item_body, headers=item_headers)
+                    result['elapsed'] = time.time() - start
+                    resp['status'] = int(resp['status'])
+                    uresp, u_content = format_response(resp, content)
+                except Exception, e:
+                    result['elapsed'] = time.time() - start
+                    result['failed'] = True
+                    result['msg'] = request_error_message(e, url) or "An unknown error occurred: %s" % e
+                    continue
+                result.update(uresp)
+                result['url'] = url
+                if resp['status'] not in item_status:
+                    result['failed'] = True
+                    result['msg'] = "Status code was not " + str(item_status)
+                    result['content'] = u_content
+                elif item_content:
+                    result['content'] = u_content
+            finally:
+                results[i] = result
+
+    threads = []
+    for n in range(max(1, min(concurrency, len(items)))):
+        t = threading.Thread(target=worker)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    return results
+
 
 def main():
 
     module = AnsibleModule(
         argument_spec = dict(
-            url = dict(required=True),
+            url = dict(required=False, default=None),
             dest = dict(required=False, default=None),
             user = dict(required=False, default=None),
             password = dict(required=False, default=None),
@@ -376,7 +720,14 @@ def main():
             status_code = dict(required=False, default=[200], type='list'),
             timeout = dict(required=False, default=30, type='int'),
             validate_certs = dict(required=False, default=True, type='bool'),
+            cache_dir = dict(required=False, default=None),
+            cache_size = dict(required=False, default=1024, type='int'),
+            cache_hardlink = dict(required=False, default='no', type='bool'),
+            requests = dict(required=False, default=None, type='list'),
+            concurrency = dict(required=False, default=4, type='int'),
         ),
+        mutually_exclusive=[['requests', 'url'], ['requests', 'dest']],
+        required_one_of=[['requests', 'url']],
         check_invalid_arguments=False,
         add_file_common_args=True
     )
@@ -441,16 +792,65 @@ def main():
         dict_headers["Authorization"] = "Basic {0}".format(base64.b64encode("{0}:{1}".format(user, password))) 
 
 
+    if module.params['requests'] is not None:
+        batch_headers = dict(dict_headers)
+        if body_format == 'json' and 'HEADER_Content-Type' not in module.params:
+            # each request sets it from its own body_format
+            del batch_headers['Content-Type']
+        results = uri_batch(module, module.params['requests'], user, password, module.params['body'],
+                            method, body_format, status_code, return_content, batch_headers,
+                            redirects, socket_timeout, validate_certs, module.params['concurrency'])
+        failed = [r for r in results if r.get('failed')]
+        if failed:
+            module.fail_json(msg="%d of %d requests failed" % (len(failed), len(results)), results=results)
+        module.exit_json(changed=False, results=results)
+
+    cache_dir = module.params['cache_dir']
+    cache_size = module.params['cache_size'] * 1024 * 1024
+    entry = None
+    cache_headers = None
+    # the credentials and headers a download was fetched with, see cache_url_path()
+    identity = [user, password, sorted(dict_headers.items())]
+    if cache_dir is not None and dest is not None and method == 'GET':
+        cache_dir = os.path.expanduser(cache_dir)
+        entry = load_cache_entry(cache_dir, url, identity)
+        if entry is not None:
+            cache_headers = cache_validators(entry)
+    else:
+        cache_dir = None
+
     # Make the request
-    resp, content, dest = uri(module, url, dest, user, password, body, body_format, method, dict_headers, redirects, socket_timeout, validate_certs)
+    resp, content, dest = uri(module, url, dest, user, password, body, body_format, method, dict_headers, redirects, socket_timeout, validate_certs, cache_headers)
     resp['status'] = int(resp['status'])
 
+    placed = None
+    if dest is not None and resp['status'] == 304 and cache_headers:
+        placed = place_from_cache(cache_dir, entry['sha256'], os.path.dirname(dest), module.params['cache_hardlink'])
+        if placed is None:
+            # evicted by another run since it was looked up, fetch it again
+            resp, content, dest = uri(module, url, dest, user, password, body, body_format, method, dict_headers, redirects, socket_timeout, validate_certs)
+            resp['status'] = int(resp['status'])
+
     # Write the file out if requested
     if dest is not None:
-        if resp['status'] == 304:
+        if placed is not None:
+            # not modified since it was cached, dest may still differ
+            tmpsrc, linked = placed
+            changed = replace_file(module, tmpsrc, dest, linked)
+            module.params['path'] = dest
+            file_args = module.load_file_common_arguments(module.params)
+            file_args['path'] = dest
+            changed = module.set_fs_attributes_if_different(file_args, changed)
+            # the content was served from the cache
+            resp['status'] = 200
+            resp['cached'] = True
+        elif resp['status'] == 304:
             changed = False
         else:
-            write_file(module, url, dest, content)
+            if not 200 <= resp['status'] < 300:
+                # only cache the content of successful responses
+                cache_dir = None
+            write_file(module, url, dest, content, cache_dir, cache_size, resp, identity)
             # allow file attribute changes
             changed = True
             module.params['path'] = dest
@@ -461,28 +861,7 @@ def main():
     else:
         changed = False
 
-    # Transmogrify the headers, replacing '-' with '_', since variables dont work with dashes.
-    uresp = {}
-    for key, value in resp.iteritems():
-        ukey = key.replace("-", "_")
-        uresp[ukey] = value
-
-    # Default content_encoding to try
-    content_encoding = 'utf-8'
-    if 'content_type' in uresp:
-        content_type, params = cgi.parse_header(uresp['content_type'])
-        if 'charset' in params:
-            content_encoding = params['charset']
-        u_content = unicode(content, content_encoding, errors='xmlcharrefreplace')
-        if content_type.startswith('application/json') or \
-                content_type.startswith('text/json'):
-            try:
-                js = json.loads(u_content)
-                uresp['json'] = js
-            except:
-                pass
-    else:
-        u_content = unicode(content, content_encoding, errors='xmlcharrefreplace')
+    uresp, u_content = format_response(resp, content)
 
     if resp['status'] not in status_code:
         module.fail_json(msg="Status code was not " + str(status_code), content=u_content, **uresp)
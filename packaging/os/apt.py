@@ -93,11 +93,33 @@ options:
        - Path to a .deb package on the remote machine.
      required: false
      version_added: "1.6"
+  changes:
+     description:
+       - A list of changes to plan and apply together, each a hash with
+         either a C(name), which can carry a version or a wildcard as in
+         I(name), or a C(deb) path, and a C(state) of C(present), C(latest)
+         or C(absent) (a C(deb) can only be C(present)).
+       - The whole plan is worked out in-process against one open package
+         cache, with one dependency solve, and applied with one commit.
+         Local .deb files, and the dependencies they are missing, are part
+         of the same plan; the files themselves are installed with a single
+         dpkg run after the commit.
+       - I(purge), I(install_recommends), I(force), I(default_release) and
+         I(dpkg_options) apply to all the changes. As with apt-get, packages
+         which cannot be authenticated are refused unless I(force) is set.
+       - May not be used with I(name), I(upgrade) or I(deb).
+     required: false
+     default: null
+     version_added: "2.0"
 requirements: [ python-apt, aptitude ]
 author: Matthew Williams
 notes:
    - Three of the upgrade modes (C(full), C(safe) and its alias C(yes)) require C(aptitude), otherwise
      C(apt-get) suffices.
+   - Without I(update_cache), C(state=present) and C(state=absent) first check
+     the packages against C(/var/lib/dpkg/status), whose index is kept in
+     C(~/.ansible/dpkg) until the file changes, and only read the package
+     lists when something may need to change.
 '''
 
 EXAMPLES = '''
@@ -136,6 +158,14 @@ EXAMPLES = '''
 
 # Install the build dependencies for package "foo"
 - apt: pkg=foo state=build-dep
+
+# Install, upgrade and remove packages, and install a .deb, in one go
+- apt:
+    changes:
+      - { name: nginx, state: latest }
+      - { name: 'openssl=1.0.1*' }
+      - { name: apache2, state: absent }
+      - { deb: /tmp/mypackage.deb }
 '''
 
 RETURN = '''
@@ -149,6 +179,11 @@ cache_update_time:
     returned: success, in some cases
     type: datetime
     sample: 1425828348000
+packages:
+    description: what was done to each package by a I(changes) run
+    returned: success, when I(changes) is used
+    type: dictionary
+    sample: {"nginx": "upgraded", "libssl1.0.0": "installed", "apache2": "removed"}
 stdout:
     description: output from apt
     returned: success, when needed
@@ -170,6 +205,7 @@ import os
 import datetime
 import fnmatch
 import itertools
+import tempfile
 
 # APT related constants
 APT_ENV_VARS = dict(
@@ -183,11 +219,14 @@ APT_GET_ZERO = "0 upgraded, 0 newly installed"
 APTITUDE_ZERO = "0 packages upgraded, 0 newly installed"
 APT_LISTS_PATH = "/var/lib/apt/lists"
 APT_UPDATE_SUCCESS_STAMP_PATH = "/var/lib/apt/periodic/update-success-stamp"
+DPKG_STATUS_PATH = "/var/lib/dpkg/status"
+DPKG_INDEX_DIR = "~/.ansible/dpkg"
 
 HAS_PYTHON_APT = True
 try:
     import apt
     import apt.debfile
+    import apt.progress.base
     import apt_pkg
 except ImportError:
     HAS_PYTHON_APT = False
@@ -292,6 +331,100 @@ def package_status(m, pkgname, version, cache, state):
 
     return package_is_installed, package_is_upgradable, has_files
 
+def parse_dpkg_status(status_path, native_arch):
+    """
+    returns {name: [version, state]} for the packages in the dpkg status
+    file, packages of a foreign architecture being named name:arch
+    """
+    index = {}
+    fields = {}
+    infile = open(status_path)
+    try:
+        for line in itertools.chain(infile, ['\n']):
+            if not line.strip():
+                if 'Package' in fields and 'Status' in fields:
+                    name = fields['Package']
+                    arch = fields.get('Architecture', 'all')
+                    entry = [fields.get('Version', ''), fields['Status'].split()[-1]]
+                    index['%s:%s' % (name, arch)] = entry
+                    if arch in (native_arch, 'all'):
+                        index[name] = entry
+                fields = {}
+            elif not line[0].isspace() and ':' in line:
+                key, value = line.split(':', 1)
+                if key in ('Package', 'Version', 'Status', 'Architecture'):
+                    fields[key] = value.strip()
+    finally:
+        infile.close()
+    return index
+
+def load_dpkg_index(status_path, native_arch):
+    """
+    returns the dpkg status index, parsed again only when the status file
+    has changed since another run saved it
+    """
+    try:
+        st = os.stat(status_path)
+    except OSError:
+        return None
+    stamp = [st.st_size, st.st_mtime, native_arch]
+    index_path = os.path.join(os.path.expanduser(DPKG_INDEX_DIR), 'status.json')
+    try:
+        infile = open(index_path)
+        try:
+            saved = json.load(infile)
+        finally:
+            infile.close()
+        if saved.get('stamp') == stamp:
+            return saved['packages']
+    except (IOError, ValueError, KeyError):
+        pass
+
+    try:
+        index = parse_dpkg_status(status_path, native_arch)
+    except IOError:
+        return None
+    try:
+        index_dir = os.path.dirname(index_path)
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir, 0700)
+        fd, tmp = tempfile.mkstemp(prefix='.status-', dir=index_dir)
+        outfile = os.fdopen(fd, 'w')
+        try:
+            json.dump(dict(stamp=stamp, packages=index), outfile)
+        finally:
+            outfile.close()
+        os.rename(tmp, index_path)
+    except (IOError, OSError):
+        # the index is only an optimization
+        pass
+    return index
+
+def dpkg_status_satisfies(index, pkgspec, state, purge):
+    """
+    True when the dpkg status alone shows every package already in the
+    wanted state, False when it takes the apt cache to tell
+    """
+    for package in pkgspec:
+        name, version = package_split(package)
+        if frozenset('*?[]!').intersection(name):
+            return False
+        entry = index.get(name)
+        if state == 'present':
+            if entry is None or entry[1] != 'installed':
+                return False
+            # a version wildcard could match a newer candidate, which apt
+            # would upgrade to
+            if version and (frozenset('*?[]!').intersection(version) or entry[0] != version):
+                return False
+        else:
+            if version:
+                return False
+            if entry is not None and (entry[1] not in ('not-installed', 'config-files') or
+                                      (purge and entry[1] == 'config-files')):
+                return False
+    return True
+
 def expand_dpkg_options(dpkg_options_compressed):
     options_list = dpkg_options_compressed.split(',')
     dpkg_options = ""
@@ -487,6 +620,166 @@ def remove(m, pkgspec, cache, purge=False,
             m.fail_json(msg="'apt-get remove %s' failed: %s" % (packages, err), stdout=out, stderr=err)
         m.exit_json(changed=True, stdout=out, stderr=err)
 
+def change_outcome(pkg):
+    if pkg.marked_delete:
+        return 'removed'
+    elif pkg.marked_upgrade:
+        return 'upgraded'
+    elif pkg.marked_downgrade:
+        return 'downgraded'
+    elif pkg.marked_reinstall:
+        return 'reinstalled'
+    return 'installed'
+
+def mark_change(m, cache, package, state, purge):
+    name, version = package_split(package)
+    if state == 'absent':
+        installed, upgradable, has_files = package_status(m, name, version, cache, state='remove')
+        if installed or (has_files and purge):
+            cache[name].mark_delete(purge=purge)
+        return
+    installed, upgradable, has_files = package_status(m, name, version, cache, state='install')
+    if installed and not (upgradable and (state == 'latest' or version)):
+        return
+    try:
+        pkg = cache[name]
+    except KeyError:
+        # a virtual package, which apt can only install through the
+        # single package providing it
+        provided_packages = cache.get_providing_packages(name)
+        if len(provided_packages) != 1:
+            m.fail_json(msg="'%s' is provided by more than one package, please pick one" % name)
+        pkg = provided_packages[0]
+    if version:
+        matches = [v for v in pkg.versions if fnmatch.fnmatch(v.version, version)]
+        if not matches:
+            m.fail_json(msg="No version of '%s' matching '%s' is available" % (name, version))
+        # the newest of the matching versions
+        pkg.candidate = max(matches)
+    pkg.mark_install()
+
+def apply_changes(m, changes, cache, purge=False, install_recommends=True,
+                  force=False, dpkg_options=DPKG_OPTIONS):
+    debs = []
+    deps_to_install = []
+    outcomes = {}
+    for change in changes:
+        if not isinstance(change, dict):
+            m.fail_json(msg="each of the changes must be a dict with a name or a deb: %s" % (change,))
+        state = change.get('state', 'present')
+        if state not in ('present', 'latest', 'absent'):
+            m.fail_json(msg="invalid state in changes: %s" % state)
+        if bool(change.get('name')) == bool(change.get('deb')):
+            m.fail_json(msg="each of the changes needs either a name or a deb")
+        if change.get('deb'):
+            if state != 'present':
+                m.fail_json(msg="deb only supports state=present")
+            try:
+                pkg = apt.debfile.DebPackage(change['deb'], cache)
+            except SystemError, e:
+                m.fail_json(msg="System Error: %s" % str(e))
+            if pkg.compare_to_version_in_cache() == pkg.VERSION_SAME:
+                continue
+            if not pkg.check() and not force:
+                m.fail_json(msg=pkg._failure_string)
+            deps_to_install.extend(pkg.missing_deps)
+            debs.append(change['deb'])
+            outcomes[pkg.pkgname] = 'installed'
+
+    # checking the debs can leave marks behind, start the plan afresh
+    cache.clear()
+    try:
+        apt_pkg.config.set('APT::Install-Recommends', install_recommends and '1' or '0')
+    except AttributeError:
+        apt_pkg.Config.Set('APT::Install-Recommends', install_recommends and '1' or '0')
+
+    actiongroup = apt_pkg.ActionGroup(cache._depcache)
+    try:
+        for package in deps_to_install:
+            mark_change(m, cache, package, 'present', purge)
+        for change in changes:
+            if not change.get('name'):
+                continue
+            state = change.get('state', 'present')
+            if state == 'latest' and '=' in change['name']:
+                m.fail_json(msg='version number inconsistent with state=latest: %s' % change['name'])
+            for package in expand_pkgspec_from_fnmatches(m, [change['name']], cache):
+                mark_change(m, cache, package, state, purge)
+    finally:
+        actiongroup.release()
+
+    if cache.broken_count > 0:
+        m.fail_json(msg="The changes would leave broken packages, apt cannot resolve their dependencies")
+
+    for pkg in cache.get_changes():
+        outcomes[pkg.name] = change_outcome(pkg)
+
+    if m.check_mode or not outcomes:
+        m.exit_json(changed=bool(outcomes), packages=outcomes)
+
+    if not force:
+        # like apt-get, only install packages from signed repositories
+        # unless forced
+        untrusted = []
+        for pkg in cache.get_changes():
+            if pkg.marked_delete:
+                continue
+            trusted = False
+            for origin in pkg.candidate.origins:
+                if origin.trusted:
+                    trusted = True
+            if not trusted:
+                untrusted.append(pkg.name)
+        if untrusted:
+            m.fail_json(msg="The following packages cannot be authenticated: %s, use force=yes to install them anyway" % ', '.join(untrusted), packages=outcomes)
+
+    for (k,v) in APT_ENV_VARS.iteritems():
+        os.environ[k] = v
+    for dpkg_option in dpkg_options.split(','):
+        apt_pkg.config.set('DPkg::Options::', '--%s' % dpkg_option)
+
+    # python-apt may only have been imported by main(), so the progress
+    # class that sends dpkg's output to a file instead of the module's
+    # output is defined here
+    class CapturedInstallProgress(apt.progress.base.InstallProgress):
+        def __init__(self, output):
+            apt.progress.base.InstallProgress.__init__(self)
+            self.output = output
+
+        def fork(self):
+            pid = os.fork()
+            if pid == 0:
+                os.dup2(self.output.fileno(), 1)
+                os.dup2(self.output.fileno(), 2)
+            return pid
+
+    output = tempfile.TemporaryFile()
+    try:
+        try:
+            if cache.get_changes():
+                cache.commit(apt.progress.base.AcquireProgress(), CapturedInstallProgress(output))
+        except SystemError, e:
+            output.seek(0)
+            m.fail_json(msg="Applying the changes failed: %s" % str(e), stdout=output.read())
+        output.seek(0)
+        stdout = output.read()
+    finally:
+        output.close()
+    stderr = ''
+
+    if debs:
+        options = ' '.join(["--%s"% x for x in dpkg_options.split(",")])
+        if force:
+            options += " --force-all"
+        cmd = "dpkg %s -i %s" % (options, " ".join(debs))
+        rc, out, err = m.run_command(cmd)
+        stdout += out
+        stderr += err
+        if rc != 0:
+            m.fail_json(msg="%s failed" % cmd, stdout=stdout, stderr=stderr, packages=outcomes)
+
+    m.exit_json(changed=True, packages=outcomes, stdout=stdout, stderr=stderr)
+
 def upgrade(m, mode="yes", force=False, default_release=None,
             dpkg_options=expand_dpkg_options(DPKG_OPTIONS)):
     if m.check_mode:
@@ -549,10 +842,11 @@ def main():
             install_recommends = dict(default='yes', aliases=['install-recommends'], type='bool'),
             force = dict(default='no', type='bool'),
             upgrade = dict(choices=['yes', 'safe', 'full', 'dist']),
-            dpkg_options = dict(default=DPKG_OPTIONS)
+            dpkg_options = dict(default=DPKG_OPTIONS),
+            changes = dict(default=None, type='list')
         ),
-        mutually_exclusive = [['package', 'upgrade', 'deb']],
-        required_one_of = [['package', 'upgrade', 'update_cache', 'deb']],
+        mutually_exclusive = [['package', 'upgrade', 'deb', 'changes']],
+        required_one_of = [['package', 'upgrade', 'update_cache', 'deb', 'changes']],
         supports_check_mode = True
     )
 
@@ -562,6 +856,7 @@ def main():
             global apt, apt_pkg
             import apt
             import apt.debfile
+            import apt.progress.base
             import apt_pkg
         except ImportError:
             module.fail_json(msg="Could not import python modules: apt, apt_pkg. Please install python-apt package.")
@@ -587,14 +882,25 @@ def main():
         p['state'] = 'absent'
 
     try:
-        cache = apt.Cache()
+        # present and absent are mostly asked about packages that are
+        # already that way, which the dpkg status file can tell without
+        # reading every package list into a cache
+        if p['state'] in ('present', 'absent') and p['package'] and not p['update_cache']:
+            try:
+                native_arch = apt_pkg.config.find('APT::Architecture')
+            except AttributeError:
+                native_arch = apt_pkg.Config.Find('APT::Architecture')
+            index = load_dpkg_index(DPKG_STATUS_PATH, native_arch)
+            if index is not None and dpkg_status_satisfies(index, p['package'], p['state'], p['purge']):
+                module.exit_json(changed=False, cache_updated=False, cache_update_time=0)
+
         if p['default_release']:
             try:
                 apt_pkg.config['APT::Default-Release'] = p['default_release']
             except AttributeError:
                 apt_pkg.Config['APT::Default-Release'] = p['default_release']
-            # reopen cache w/ modified config
-            cache.open(progress=None)
+        # open the cache once, with the modified config already in place
+        cache = apt.Cache()
 
         if p['update_cache']:
             # Default is: always update the cache
@@ -624,7 +930,7 @@ def main():
                 cache.open(progress=None)
                 updated_cache = True
                 updated_cache_time = int(time.mktime(now.timetuple()))
-            if not p['package'] and not p['upgrade'] and not p['deb']:
+            if not p['package'] and not p['upgrade'] and not p['deb'] and not p['changes']:
                 module.exit_json(changed=False, cache_updated=updated_cache, cache_update_time=updated_cache_time)
         else:
             updated_cache = False
@@ -632,6 +938,11 @@ def main():
 
         force_yes = p['force']
 
+        if p['changes']:
+            apply_changes(module, p['changes'], cache, purge=p['purge'],
+                          install_recommends=install_recommends,
+                          force=force_yes, dpkg_options=p['dpkg_options'])
+
         if p['upgrade']:
             upgrade(module, p['upgrade'], force_yes, p['default_release'], dpkg_options)
 
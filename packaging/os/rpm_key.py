@@ -65,6 +65,98 @@ import os.path
 import re
 import tempfile
 
+RPMDB_CACHE_DIR = '~/.ansible/rpmdb'
+RPMDB_FILES = ['/var/lib/rpm/Packages', '/var/lib/rpm/rpmdb.sqlite']
+RPMDB_QF = '[%{NAME}\\t%{VERSION}\\t%{RELEASE}\\t%{ARCH}\\t%{PROVIDENAME}\\n]'
+
+rpmdb_index = None
+
+def rpmdb_stamp():
+    for path in RPMDB_FILES:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        return [path, st.st_size, st.st_mtime]
+    return None
+
+def build_rpmdb_index(module, rpmbin):
+    """
+    returns the installed packages as {'packages': {spec: [nevra]},
+    'provides': {provide: [nevra]}}, where a package can be looked up as
+    name, name.arch, name-version, name-version-release or nevra
+    """
+
+    rc, out, err = module.run_command([rpmbin, '-qa', '--qf', RPMDB_QF])
+    if rc != 0:
+        return None
+    packages = {}
+    provides = {}
+    for line in out.splitlines():
+        fields = line.split('\t')
+        if len(fields) != 5:
+            continue
+        (name, version, release, arch, provide) = fields
+        nevra = '%s-%s-%s.%s' % (name, version, release, arch)
+        for spec in (name, '%s.%s' % (name, arch), '%s-%s' % (name, version),
+                     '%s-%s-%s' % (name, version, release), nevra):
+            nevras = packages.setdefault(spec, [])
+            if nevra not in nevras:
+                nevras.append(nevra)
+        nevras = provides.setdefault(provide, [])
+        if nevra not in nevras:
+            nevras.append(nevra)
+    return {'packages': packages, 'provides': provides}
+
+def load_rpmdb_index(module, rpmbin):
+    """
+    returns the index of installed packages, rebuilt with one rpm query
+    only when the rpmdb has changed since another run saved it
+    """
+
+    global rpmdb_index
+    stamp = rpmdb_stamp()
+    if stamp is None or not rpmbin:
+        return None
+    if rpmdb_index is not None and rpmdb_index['stamp'] == stamp:
+        return rpmdb_index
+    index_path = os.path.join(os.path.expanduser(RPMDB_CACHE_DIR), 'index.json')
+    try:
+        infile = open(index_path)
+        try:
+            index = json.load(infile)
+        finally:
+            infile.close()
+        if index.get('stamp') == stamp:
+            rpmdb_index = index
+            return index
+    except (IOError, ValueError):
+        pass
+
+    index = build_rpmdb_index(module, rpmbin)
+    if index is None:
+        return None
+    # the rpmdb could have changed while it was being queried
+    if rpmdb_stamp() != stamp:
+        return index
+    index['stamp'] = stamp
+    try:
+        cache_dir = os.path.dirname(index_path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0700)
+        fd, tmp = tempfile.mkstemp(prefix='.index-', dir=cache_dir)
+        outfile = os.fdopen(fd, 'w')
+        try:
+            json.dump(index, outfile)
+        finally:
+            outfile.close()
+        os.rename(tmp, index_path)
+    except (IOError, OSError):
+        # the index is only an optimization
+        pass
+    rpmdb_index = index
+    return index
+
 def is_pubkey(string):
     """Verifies if string is a pubkey"""
     pgp_regex = ".*?(-----BEGIN PGP PUBLIC KEY BLOCK-----.*?-----END PGP PUBLIC KEY BLOCK-----).*"
@@ -164,7 +256,11 @@ class RpmKey:
         return stdout, stderr
 
     def is_key_imported(self, keyid):
-        stdout, stderr = self.execute_command([self.rpm, '-qa', 'gpg-pubkey'])
+        index = load_rpmdb_index(self.module, self.rpm)
+        if index is not None:
+            stdout = '\n'.join(index['packages'].get('gpg-pubkey', []))
+        else:
+            stdout, stderr = self.execute_command([self.rpm, '-qa', 'gpg-pubkey'])
         for line in stdout.splitlines():
             line = line.strip()
             if not line:
@@ -189,7 +189,119 @@ def po_to_nevra(po):
     else:
         return '%s-%s-%s.%s' % (po.name, po.version, po.release, po.arch)
 
+RPMDB_CACHE_DIR = '~/.ansible/rpmdb'
+RPMDB_FILES = ['/var/lib/rpm/Packages', '/var/lib/rpm/rpmdb.sqlite']
+RPMDB_QF = '[%{NAME}\\t%{VERSION}\\t%{RELEASE}\\t%{ARCH}\\t%{PROVIDENAME}\\n]'
+
+rpmdb_index = None
+
+def rpmdb_stamp():
+    for path in RPMDB_FILES:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        return [path, st.st_size, st.st_mtime]
+    return None
+
+def build_rpmdb_index(module, rpmbin):
+    """
+    returns the installed packages as {'packages': {spec: [nevra]},
+    'provides': {provide: [nevra]}}, where a package can be looked up as
+    name, name.arch, name-version, name-version-release or nevra
+    """
+
+    rc, out, err = module.run_command([rpmbin, '-qa', '--qf', RPMDB_QF])
+    if rc != 0:
+        return None
+    packages = {}
+    provides = {}
+    for line in out.splitlines():
+        fields = line.split('\t')
+        if len(fields) != 5:
+            continue
+        (name, version, release, arch, provide) = fields
+        nevra = '%s-%s-%s.%s' % (name, version, release, arch)
+        for spec in (name, '%s.%s' % (name, arch), '%s-%s' % (name, version),
+                     '%s-%s-%s' % (name, version, release), nevra):
+            nevras = packages.setdefault(spec, [])
+            if nevra not in nevras:
+                nevras.append(nevra)
+        nevras = provides.setdefault(provide, [])
+        if nevra not in nevras:
+            nevras.append(nevra)
+    return {'packages': packages, 'provides': provides}
+
+def load_rpmdb_index(module, rpmbin):
+    """
+    returns the index of installed packages, rebuilt with one rpm query
+    only when the rpmdb has changed since another run saved it
+    """
+
+    global rpmdb_index
+    stamp = rpmdb_stamp()
+    if stamp is None or not rpmbin:
+        return None
+    if rpmdb_index is not None and rpmdb_index['stamp'] == stamp:
+        return rpmdb_index
+    index_path = os.path.join(os.path.expanduser(RPMDB_CACHE_DIR), 'index.json')
+    try:
+        infile = open(index_path)
+        try:
+            index = json.load(infile)
+        finally:
+            infile.close()
+        if index.get('stamp') == stamp:
+            rpmdb_index = index
+            return index
+    except (IOError, ValueError):
+        pass
+
+    index = build_rpmdb_index(module, rpmbin)
+    if index is None:
+        return None
+    # the rpmdb could have changed while it was being queried
+    if rpmdb_stamp() != stamp:
+        return index
+    index['stamp'] = stamp
+    try:
+        cache_dir = os.path.dirname(index_path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0700)
+        fd, tmp = tempfile.mkstemp(prefix='.index-', dir=cache_dir)
+        outfile = os.fdopen(fd, 'w')
+        try:
+            json.dump(index, outfile)
+        finally:
+            outfile.close()
+        os.rename(tmp, index_path)
+    except (IOError, OSError):
+        # the index is only an optimization
+        pass
+    rpmdb_index = index
+    return index
+
+def rpmdb_index_lookup(index, pkgspec, is_pkg=False):
+    """
+    returns the nevras installed for pkgspec from the index, or None when
+    the spec is a form only rpm itself can match (globs, files, versioned
+    requires, epochs)
+    """
+
+    if index is None or set('*?[]/:<>= ').intersection(set(pkgspec)):
+        return None
+    pkgs = index['packages'].get(pkgspec, [])
+    if not pkgs and not is_pkg:
+        pkgs = index['provides'].get(pkgspec, [])
+    return list(pkgs)
+
 def is_installed(module, repoq, pkgspec, conf_file, qf=def_qf, en_repos=None, dis_repos=None, is_pkg=False):
+    if qf == def_qf:
+        # answer from the index of the rpmdb when it can, without a
+        # repoquery or YumBase
+        pkgs = rpmdb_index_lookup(load_rpmdb_index(module, module.get_bin_path('rpm')), pkgspec, is_pkg)
+        if pkgs is not None:
+            return pkgs
     if en_repos is None:
         en_repos = []
     if dis_repos is None:
@@ -377,6 +489,93 @@ def what_provides(module, repoq, req_spec, conf_file,  qf=def_qf, en_repos=None,
 
     return []
 
+class YumResolver(object):
+    """
+    Answers whether specs are installed, available, updatable or provided,
+    for all the specs of one run, from a single load of the rpmdb and the
+    repo metadata instead of a YumBase or repoquery run per question
+    """
+
+    def __init__(self, module, conf_file, en_repos=None, dis_repos=None, my=None):
+        self.module = module
+        self.answers = {}
+        self.update_tuples = None
+        self.index = load_rpmdb_index(module, module.get_bin_path('rpm'))
+        try:
+            if my is None:
+                my = yum_base(conf_file)
+                for rid in dis_repos or []:
+                    my.repos.disableRepo(rid)
+                for rid in en_repos or []:
+                    my.repos.enableRepo(rid)
+        except Exception, e:
+            module.fail_json(msg="Failure talking to yum: %s" % e)
+        self.my = my
+
+    def answer(self, key, lookup):
+        if key not in self.answers:
+            try:
+                self.answers[key] = lookup()
+            except Exception, e:
+                self.module.fail_json(msg="Failure talking to yum: %s" % e)
+        return self.answers[key]
+
+    def nevras(self, pkgs):
+        # in the form repoquery prints with def_qf
+        nevras = []
+        for po in pkgs:
+            nevra = '%s-%s-%s.%s' % (po.name, po.version, po.release, po.arch)
+            if nevra not in nevras:
+                nevras.append(nevra)
+        return nevras
+
+    def installed(self, spec, is_pkg=False):
+        def lookup():
+            pkgs = rpmdb_index_lookup(self.index, spec, is_pkg)
+            if pkgs is not None:
+                return pkgs
+            e,m,u = self.my.rpmdb.matchPackageNames([spec])
+            pkgs = e + m
+            if not pkgs and not is_pkg:
+                pkgs.extend(self.my.returnInstalledPackagesByDep(spec))
+            return self.nevras(pkgs)
+        return self.answer(('installed', spec, is_pkg), lookup)
+
+    def available(self, spec):
+        def lookup():
+            e,m,u = self.my.pkgSack.matchPackageNames([spec])
+            pkgs = e + m
+            if not pkgs:
+                pkgs.extend(self.my.returnPackagesByDep(spec))
+            return self.nevras(pkgs)
+        return self.answer(('available', spec), lookup)
+
+    def updates(self, spec):
+        def lookup():
+            if self.update_tuples is None:
+                # the list of updates is the same for every spec
+                updates = self.my.doPackageLists(pkgnarrow='updates').updates
+                self.update_tuples = set([po.pkgtup for po in updates])
+            pkgs = self.my.returnPackagesByDep(spec) + self.my.returnInstalledPackagesByDep(spec)
+            if not pkgs:
+                e,m,u = self.my.pkgSack.matchPackageNames([spec])
+                pkgs = e + m
+            return set(self.nevras([po for po in pkgs if po.pkgtup in self.update_tuples]))
+        return self.answer(('updates', spec), lookup)
+
+    def provides(self, spec):
+        def lookup():
+            pkgs = self.my.returnPackagesByDep(spec) + self.my.returnInstalledPackagesByDep(spec)
+            if not pkgs:
+                e,m,u = self.my.pkgSack.matchPackageNames([spec])
+                pkgs.extend(e)
+                pkgs.extend(m)
+                e,m,u = self.my.rpmdb.matchPackageNames([spec])
+                pkgs.extend(e)
+                pkgs.extend(m)
+            return set(self.nevras(pkgs))
+        return self.answer(('provides', spec), lookup)
+
 def transaction_exists(pkglist):
     """ 
     checks the package list to see if any packages are 
@@ -432,6 +631,51 @@ def local_nvra(module, path):
                             header[rpm.RPMTAG_RELEASE],
                             header[rpm.RPMTAG_ARCH])
     
+def nevra_name(nevra):
+    """return the name out of a name-version-release.arch"""
+
+    return nevra.rsplit('-', 2)[0]
+
+def transacted_packages(out):
+    """
+    returns a dict of name to name-version-release.arch for the packages
+    yum lists as installed or updated at the end of a transaction
+    """
+
+    sections = ['Installed', 'Dependency Installed', 'Updated', 'Dependency Updated']
+    pkgs = {}
+    tokens = []
+    section = None
+    for line in out.splitlines() + ['']:
+        if line.startswith(' ') and section in sections:
+            # entries are 'name.arch epoch:version-release' pairs, which
+            # yum wraps over as many lines as it needs to
+            tokens.extend(line.split())
+            continue
+        for i in range(0, len(tokens) - 1, 2):
+            if '.' not in tokens[i]:
+                continue
+            (name, arch) = tokens[i].rsplit('.', 1)
+            evr = tokens[i+1].split(':', 1)[-1]
+            pkgs[name] = '%s-%s.%s' % (name, evr, arch)
+        tokens = []
+        section = line.strip().rstrip(':')
+    return pkgs
+
+def attribute_results(res, plan, out, verb):
+    """
+    says in the results which of the planned specs the packages of one
+    transaction went in for
+    """
+
+    transacted = transacted_packages(out)
+    for entry in plan:
+        spec, names = entry[0], entry[-1]
+        for name in names:
+            if name in transacted:
+                res['results'].append('%s providing %s was %s' % (transacted[name], spec, verb))
+                break
+
 def pkg_to_dict(pkgstr):
 
     if pkgstr.strip():
@@ -483,7 +727,7 @@ def list_stuff(module, conf_file, stuff):
     else:
         return [ pkg_to_dict(p) for p in is_installed(module, repoq, stuff, conf_file, qf=qf) + is_available(module, repoq, stuff, conf_file, qf=qf) if p.strip() ]
 
-def install(module, items, repoq, yum_basecmd, conf_file, en_repos, dis_repos):
+def install(module, items, resolver, yum_basecmd):
 
     res = {}
     res['results'] = []
@@ -492,8 +736,13 @@ def install(module, items, repoq, yum_basecmd, conf_file, en_repos, dis_repos):
     res['changed'] = False
     tempdir = tempfile.mkdtemp()
 
+    # work out what has to be installed for all the specs first, each of
+    # them as (spec, what to pass to yum install, the package names it
+    # should bring in)
+    plan = []
     for spec in items:
         pkg = None
+        names = []
 
         # check if pkgspec is installed (if possible for idempotence)
         # localpkg
@@ -505,10 +754,11 @@ def install(module, items, repoq, yum_basecmd, conf_file, en_repos, dis_repos):
 
             nvra = local_nvra(module, spec)
             # look for them in the rpmdb
-            if is_installed(module, repoq, nvra, conf_file, en_repos=en_repos, dis_repos=dis_repos):
+            if resolver.installed(nvra):
                 # if they are there, skip it
                 continue
             pkg = spec
+            names = [nevra_name(nvra)]
 
         # URL
         elif '://' in spec:
@@ -540,13 +790,13 @@ def install(module, items, repoq, yum_basecmd, conf_file, en_repos, dis_repos):
             # short circuit all the bs - and search for it as a pkg in is_installed
             # if you find it then we're done
             if not set(['*','?']).intersection(set(spec)):
-                pkgs = is_installed(module, repoq, spec, conf_file, en_repos=en_repos, dis_repos=dis_repos, is_pkg=True)
+                pkgs = resolver.installed(spec, is_pkg=True)
                 if pkgs:
                     res['results'].append('%s providing %s is already installed' % (pkgs[0], spec))
                     continue
             
             # look up what pkgs provide this
-            pkglist = what_provides(module, repoq, spec, conf_file, en_repos=en_repos, dis_repos=dis_repos)
+            pkglist = resolver.provides(spec)
             if not pkglist:
                 res['msg'] += "No Package matching '%s' found available, installed or updated" % spec
                 module.fail_json(**res)
@@ -563,7 +813,7 @@ def install(module, items, repoq, yum_basecmd, conf_file, en_repos, dis_repos):
 
             found = False
             for this in pkglist:
-                if is_installed(module, repoq, this, conf_file, en_repos=en_repos, dis_repos=dis_repos, is_pkg=True):
+                if resolver.installed(this, is_pkg=True):
                     found = True
                     res['results'].append('%s providing %s is already installed' % (this, spec))
                     break
@@ -574,7 +824,7 @@ def install(module, items, repoq, yum_basecmd, conf_file, en_repos, dis_repos):
             # but virt provides should be all caught in what_provides on its own.
             # highly irritating
             if not found:
-                if is_installed(module, repoq, spec, conf_file, en_repos=en_repos, dis_repos=dis_repos):
+                if resolver.installed(spec):
                     found = True
                     res['results'].append('package providing %s is already installed' % (spec))
                     
@@ -585,38 +835,46 @@ def install(module, items, repoq, yum_basecmd, conf_file, en_repos, dis_repos):
             # we could get here if nothing provides it but that's not
             # the error we're catching here
             pkg = spec
+            names = [spec] + [nevra_name(this) for this in pkglist]
 
-        cmd = yum_basecmd + ['install', pkg]
+        plan.append((spec, pkg, names))
 
-        if module.check_mode:
-            # Remove rpms downloaded for EL5 via url
-            try:
-                shutil.rmtree(tempdir)
-            except Exception, e:
-                module.fail_json(msg="Failure deleting temp directory %s, %s" % (tempdir, e))
-            module.exit_json(changed=True)
+    if plan and module.check_mode:
+        # Remove rpms downloaded for EL5 via url
+        try:
+            shutil.rmtree(tempdir)
+        except Exception, e:
+            module.fail_json(msg="Failure deleting temp directory %s, %s" % (tempdir, e))
+        module.exit_json(changed=True, results=res['results'] + ['%s would be installed' % spec for (spec, pkg, names) in plan])
+
+    if plan:
+        # everything goes in as one transaction, with one depsolve
+        cmd = yum_basecmd + ['install'] + [pkg for (spec, pkg, names) in plan]
 
         changed = True
 
         rc, out, err = module.run_command(cmd)
 
         # Fail on invalid urls:
-        if (rc == 1 and '://' in spec and ('No package %s available.' % spec in out or 'Cannot open: %s. Skipping.' % spec in err)):
-            err = 'Package at %s could not be installed' % spec
-            module.fail_json(changed=False,msg=err,rc=1)
-        elif (rc != 0 and 'Nothing to do' in err) or 'Nothing to do' in out:
+        for (spec, pkg, names) in plan:
+            if (rc == 1 and '://' in spec and ('No package %s available.' % spec in out or 'Cannot open: %s. Skipping.' % spec in err)):
+                err = 'Package at %s could not be installed' % spec
+                module.fail_json(changed=False,msg=err,rc=1)
+        if (rc != 0 and 'Nothing to do' in err) or 'Nothing to do' in out:
             # avoid failing in the 'Nothing To Do' case
             # this may happen with an URL spec.
             # for an already installed group,
             # we get rc = 0 and 'Nothing to do' in out, not in err.
             rc = 0
             err = ''
-            out = '%s: Nothing to do' % spec
+            out = '%s: Nothing to do' % ', '.join([spec for (spec, pkg, names) in plan])
             changed = False
 
         res['rc'] += rc
         res['results'].append(out)
         res['msg'] += err
+        if rc == 0:
+            attribute_results(res, plan, out, 'installed')
 
         # FIXME - if we did an install - go and check the rpmdb to see if it actually installed
         # look for the pkg in rpmdb
@@ -634,7 +892,7 @@ def install(module, items, repoq, yum_basecmd, conf_file, en_repos, dis_repos):
     module.exit_json(**res)
 
 
-def remove(module, items, repoq, yum_basecmd, conf_file, en_repos, dis_repos):
+def remove(module, items, resolver, yum_basecmd, conf_file, en_repos, dis_repos):
 
     res = {}
     res['results'] = []
@@ -642,22 +900,24 @@ def remove(module, items, repoq, yum_basecmd, conf_file, en_repos, dis_repos):
     res['changed'] = False
     res['rc'] = 0
 
+    # work out what has to be removed first, as (spec, is it a group)
+    plan = []
     for pkg in items:
-        is_group = False
         # group remove - this is doom on a stick
         if pkg.startswith('@'):
-            is_group = True
+            plan.append((pkg, True))
+        elif not resolver.installed(pkg):
+            res['results'].append('%s is not installed' % pkg)
         else:
-            if not is_installed(module, repoq, pkg, conf_file, en_repos=en_repos, dis_repos=dis_repos):
-                res['results'].append('%s is not installed' % pkg)
-                continue
+            plan.append((pkg, False))
 
+    if plan and module.check_mode:
+        module.exit_json(changed=True, results=res['results'] + ['%s would be removed' % pkg for (pkg, is_group) in plan])
+
+    for (pkg, is_group) in plan:
         # run an actual yum transaction
         cmd = yum_basecmd + ["remove", pkg]
 
-        if module.check_mode:
-            module.exit_json(changed=True)
-
         rc, out, err = module.run_command(cmd)
 
         res['rc'] += rc
@@ -668,22 +928,24 @@ def remove(module, items, repoq, yum_basecmd, conf_file, en_repos, dis_repos):
         # then mark changed
         # at the end - if we've end up failed then fail out of the rest
         # of the process
+        if rc != 0:
+            module.fail_json(**res)
 
-        # at this point we should check to see if the pkg is no longer present
-        
+    # at this point we should check to see if the pkgs are no longer
+    # present, against the rpmdb as the removals left it
+    if plan:
+        resolver = YumResolver(module, conf_file, en_repos, dis_repos)
+    for (pkg, is_group) in plan:
         if not is_group: # we can't sensibly check for a group being uninstalled reliably
             # look to see if the pkg shows up from is_installed. If it doesn't
-            if not is_installed(module, repoq, pkg, conf_file, en_repos=en_repos, dis_repos=dis_repos):
+            if not resolver.installed(pkg):
                 res['changed'] = True
             else:
                 module.fail_json(**res)
 
-        if rc != 0:
-            module.fail_json(**res)
-            
     module.exit_json(**res)
 
-def latest(module, items, repoq, yum_basecmd, conf_file, en_repos, dis_repos):
+def latest(module, items, resolver, yum_basecmd):
 
     res = {}
     res['results'] = []
@@ -691,43 +953,46 @@ def latest(module, items, repoq, yum_basecmd, conf_file, en_repos, dis_repos):
     res['changed'] = False
     res['rc'] = 0
 
+    # work out what has to be installed or updated first, as (spec, command,
+    # the package names it should bring in)
+    plan = []
+    update_all = False
     for spec in items:
 
-        pkg = None
+        names = []
         basecmd = 'update'
-        cmd = ''
         # groups, again
         if spec.startswith('@'):
-            pkg = spec
+            pass
         
         elif spec == '*': #update all
             # use check-update to see if there is any need
             rc,out,err = module.run_command(yum_basecmd + ['check-update'])
             if rc == 100:
-                cmd = yum_basecmd + [basecmd]
+                update_all = True
             else:
                 res['results'].append('All packages up to date')
-                continue
+            continue
         
         # dep/pkgname  - find it
         else:
-            if is_installed(module, repoq, spec, conf_file, en_repos=en_repos, dis_repos=dis_repos):
+            if resolver.installed(spec):
                 basecmd = 'update'
             else:
                 basecmd = 'install'
 
-            pkglist = what_provides(module, repoq, spec, conf_file, en_repos=en_repos, dis_repos=dis_repos)
+            pkglist = resolver.provides(spec)
             if not pkglist:
                 res['msg'] += "No Package matching '%s' found available, installed or updated" % spec
                 module.fail_json(**res)
             
             nothing_to_do = True
             for this in pkglist:
-                if basecmd == 'install' and is_available(module, repoq, this, conf_file, en_repos=en_repos, dis_repos=dis_repos):
+                if basecmd == 'install' and resolver.available(this):
                     nothing_to_do = False
                     break
                     
-                if basecmd == 'update' and is_update(module, repoq, this, conf_file, en_repos=en_repos, dis_repos=dis_repos):
+                if basecmd == 'update' and resolver.updates(this):
                     nothing_to_do = False
                     break
                     
@@ -742,13 +1007,28 @@ def latest(module, items, repoq, yum_basecmd, conf_file, en_repos, dis_repos):
                 res['msg'] += "The following packages have pending transactions: %s" % ", ".join(conflicts)
                 module.fail_json(**res)
 
-            pkg = spec
-        if not cmd:
-            cmd = yum_basecmd + [basecmd, pkg]
-
-        if module.check_mode:
-            return module.exit_json(changed=True)
-
+            names = [spec] + [nevra_name(this) for this in pkglist]
+        plan.append((spec, basecmd, names))
+
+    if (plan or update_all) and module.check_mode:
+        would = ['%s would be updated or installed' % spec for (spec, basecmd, names) in plan]
+        if update_all:
+            would.append('All packages would be updated')
+        return module.exit_json(changed=True, results=res['results'] + would)
+
+    # the installed packages and groups go in as one update, and the rest
+    # as one install. Updating everything covers all the update specs
+    to_update = [entry for entry in plan if entry[1] == 'update']
+    to_install = [entry for entry in plan if entry[1] == 'install']
+    transactions = []
+    if update_all:
+        transactions.append((yum_basecmd + ['update'], to_update, 'updated'))
+    elif to_update:
+        transactions.append((yum_basecmd + ['update'] + [spec for (spec, basecmd, names) in to_update], to_update, 'updated'))
+    if to_install:
+        transactions.append((yum_basecmd + ['install'] + [spec for (spec, basecmd, names) in to_install], to_install, 'installed'))
+
+    for (cmd, planned, verb) in transactions:
         rc, out, err = module.run_command(cmd)
 
         res['rc'] += rc
@@ -762,6 +1042,7 @@ def latest(module, items, repoq, yum_basecmd, conf_file, en_repos, dis_repos):
             res['failed'] = True
         else:
             res['changed'] = True
+            attribute_results(res, planned, out, verb)
 
     module.exit_json(**res)
 
@@ -771,15 +1052,8 @@ def ensure(module, state, pkgs, conf_file, enablerepo, disablerepo,
     # need debug level 2 to get 'Nothing to do' for groupinstall.
     yum_basecmd = [yumbin, '-d', '2', '-y']
 
-    if not repoquery:
-        repoq = None
-    else:
-        repoq = [repoquery, '--show-duplicates', '--plugins', '--quiet']
-
     if conf_file and os.path.exists(conf_file):
         yum_basecmd += ['-c', conf_file]
-        if repoq:
-            repoq += ['-c', conf_file]
 
     dis_repos =[]
     en_repos = []
@@ -819,16 +1093,22 @@ def ensure(module, state, pkgs, conf_file, enablerepo, disablerepo,
                     module.fail_json(msg="Error setting/accessing repos: %s" % (e))
         except yum.Errors.YumBaseError, e:
             module.fail_json(msg="Error accessing repos: %s" % e)
+        # the repos are set up, answer all the questions about the specs
+        # from this one load of the rpmdb and repo metadata
+        resolver = YumResolver(module, conf_file, my=my)
+    else:
+        resolver = YumResolver(module, conf_file, en_repos, dis_repos)
+
     if state in ['installed', 'present']:
         if disable_gpg_check:
             yum_basecmd.append('--nogpgcheck')
-        install(module, pkgs, repoq, yum_basecmd, conf_file, en_repos, dis_repos)
+        install(module, pkgs, resolver, yum_basecmd)
     elif state in ['removed', 'absent']:
-        remove(module, pkgs, repoq, yum_basecmd, conf_file, en_repos, dis_repos)
+        remove(module, pkgs, resolver, yum_basecmd, conf_file, en_repos, dis_repos)
     elif state == 'latest':
         if disable_gpg_check:
             yum_basecmd.append('--nogpgcheck')
-        latest(module, pkgs, repoq, yum_basecmd, conf_file, en_repos, dis_repos)
+        latest(module, pkgs, resolver, yum_basecmd)
 
     # should be caught by AnsibleModule argument_spec
     return dict(changed=False, failed=True, results='', errors='unexpected state')
@@ -58,9 +58,36 @@ options:
       - When enabled, the daemon will open a local socket file which can be used by future daemon executions to 
         upload a new key to the already running daemon, so that multiple users can connect using different keys.
         This access still requires an ssh connection as the uid for which the daemon is currently running.
+      - Keys uploaded this way are dropped again once they have not been used for I(minutes).
     required: false
     default: no
     version_added: "1.6"
+  unencrypted_transfers:
+    description:
+      - When enabled, controllers may request that fetched files are sent without payload
+        encryption, using sendfile() or a memory mapped file for the body so large files are
+        not read, encoded and encrypted chunk by chunk. Requests and responses are still encrypted.
+      - Only enable this when the daemon port is reached through an already encrypted tunnel
+        (such as an SSH port forward or stunnel), it is only honored for connections coming
+        from the loopback address.
+    required: false
+    default: no
+    version_added: "2.0"
+  max_connections:
+    description:
+      - The maximum number of controller connections handled at the same time. Connections
+        are persistent and each holds a worker until it is closed, so further connections
+        are refused until one of them closes.
+    required: false
+    default: 64
+    version_added: "2.0"
+  max_commands:
+    description:
+      - The maximum number of commands run at the same time, across all connections.
+        Further commands are queued until a worker is free.
+    required: false
+    default: 16
+    version_added: "2.0"
 notes:
     - See the advanced playbooks chapter for more about using accelerated mode.
 requirements:
@@ -84,9 +111,12 @@ import base64
 import errno
 import getpass
 import json
+import mmap
 import os
 import os.path
 import pwd
+import Queue
+import shutil
 import signal
 import socket
 import struct
@@ -99,7 +129,7 @@ import traceback
 import SocketServer
 
 from datetime import datetime
-from threading import Thread, Lock
+from threading import Thread, Lock, Event
 
 # import module snippets
 # we must import this here at the top so we can use get_module_path()
@@ -113,6 +143,21 @@ syslog.openlog('ansible-%s' % os.path.basename(__file__))
 # which leaves room for the TCP/IP header
 CHUNK_SIZE=10240
 
+# binary transfers send length-prefixed encrypted frames of raw file
+# data (a one byte flags header followed by the chunk) instead of
+# base64 encoded JSON, and are only ACKed every N frames, so they can
+# use much larger chunks. The controller picks the chunk size and the
+# ACK window, but they must fit within these limits
+BINARY_MAX_CHUNK_SIZE=4*1024*1024
+BINARY_MAX_WINDOW=64
+
+# frame flags for binary transfers
+FRAME_LAST=0x01
+
+# keyczar prefixes every ciphertext with a version byte and a four byte
+# hash of the key, which is used to pick the key for a new connection
+KEY_HEADER_SIZE=5
+
 # FIXME: this all should be moved to module_common, as it's 
 #        pretty much a copy from the callbacks/util code
 DEBUG_LEVEL=0
@@ -142,6 +187,7 @@ except ImportError:
     pass
 
 SOCKET_FILE = os.path.join(get_module_path(), '.ansible-accelerate', ".local.socket")
+FORK_SOCKET_FILE = os.path.join(get_module_path(), '.ansible-accelerate', ".fork.socket")
 
 def get_pid_location(module):
     """
@@ -197,6 +243,32 @@ def daemonize_self(module, password, port, minutes, pid_file):
     os.dup2(dev_null.fileno(), sys.stderr.fileno())
     log("daemonizing successful")
 
+def prepare_socket_file(path):
+    """
+    Make sure the directory holding a socket file exists and is only
+    accessible to this user, and remove any stale socket file. Returns
+    False if the socket can't be created there
+    """
+    try:
+        if os.path.exists(path):
+            os.remove(path)
+        else:
+            dir = os.path.dirname(path)
+            if os.path.exists(dir):
+                if not os.path.isdir(dir):
+                    log("The socket file path (%s) exists, but is not a directory" % dir)
+                    return False
+                else:
+                    # make sure the directory is accessible only to this
+                    # user, as socket files derive their permissions from
+                    # the directory that contains them
+                    os.chmod(dir, 0700)
+            elif not os.path.exists(dir):
+                os.makedirs(dir, 0700)
+    except OSError:
+        pass
+    return True
+
 class LocalSocketThread(Thread):
     server = None
     terminated = False
@@ -206,24 +278,9 @@ class LocalSocketThread(Thread):
         Thread.__init__(self, group, target, name, args, kwargs, Verbose)
 
     def run(self):
-        try:
-            if os.path.exists(SOCKET_FILE):
-                os.remove(SOCKET_FILE)
-            else:
-                dir = os.path.dirname(SOCKET_FILE)
-                if os.path.exists(dir):
-                    if not os.path.isdir(dir):
-                        log("The socket file path (%s) exists, but is not a directory. No local connections will be available" % dir)
-                        return
-                    else:
-                        # make sure the directory is accessible only to this
-                        # user, as socket files derive their permissions from
-                        # the directory that contains them
-                        os.chmod(dir, 0700)
-                elif not os.path.exists(dir):
-                    os.makedirs(dir, 0700)
-        except OSError:
-            pass
+        if not prepare_socket_file(SOCKET_FILE):
+            log("No local connections will be available")
+            return
         self.s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self.s.bind(SOCKET_FILE)
         self.s.listen(5)
@@ -237,17 +294,8 @@ class LocalSocketThread(Thread):
                 try:
                     try:
                         new_key = AesKey.Read(data.strip())
-                        found = False
-                        for key in self.server.key_list:
-                            try:
-                                new_key.Decrypt(key.Encrypt("foo"))
-                                found = True
-                                break
-                            except:
-                                pass
-                        if not found:
+                        if self.server.add_key(new_key):
                             vv("adding new key to the key list")
-                            self.server.key_list.append(new_key)
                             conn.sendall("OK\n")
                         else:
                             vv("key already exists in the key list, ignoring")
@@ -276,27 +324,266 @@ class LocalSocketThread(Thread):
         self.s.shutdown(socket.SHUT_RDWR)
         self.s.close()
 
-class ThreadWithReturnValue(Thread):
-    def __init__(self, group=None, target=None, name=None, args=(), kwargs={}, Verbose=None):
-        Thread.__init__(self, group, target, name, args, kwargs, Verbose)
-        self._return = None
+class Job(object):
+    """
+    A function submitted to a WorkerPool, which can be waited on
+    for completion and holds the return value once it's done
+    """
+    def __init__(self, target, args=()):
+        self.target = target
+        self.args = args
+        self.result = None
+        self.done = Event()
 
     def run(self):
-        if self._Thread__target is not None:
-            self._return = self._Thread__target(*self._Thread__args,
-                                                **self._Thread__kwargs)
+        try:
+            try:
+                self.result = self.target(*self.args)
+            except:
+                tb = traceback.format_exc()
+                log("unhandled exception in a worker job:\n%s" % tb)
+                self.result = dict(failed=True, msg="unhandled error in a worker job")
+        finally:
+            self.done.set()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the job to finish, returning True if it did or False
+        if the timeout expired first
+        """
+        self.done.wait(timeout)
+        return self.done.isSet()
+
+class WorkerPool(object):
+    """
+    A fixed number of worker threads which run jobs from a queue, so
+    the number of threads doesn't grow with the number of requests
+    """
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.queue = Queue.Queue()
+        self.lock = Lock()
+        self.busy = 0
+        self.outstanding = 0
+        self.completed = 0
+        self.refused = 0
+        self.max_queued = 0
+        for i in range(workers):
+            t = Thread(target=self.worker, name="%s-%d" % (name, i))
+            t.setDaemon(True)
+            t.start()
+
+    def submit(self, target, *args):
+        try:
+            self.lock.acquire()
+            self.outstanding += 1
+        finally:
+            self.lock.release()
+        job = Job(target, args)
+        self.queue.put(job)
+        queued = self.queue.qsize()
+        try:
+            self.lock.acquire()
+            if queued > self.max_queued:
+                self.max_queued = queued
+        finally:
+            self.lock.release()
+        if queued > 0:
+            vvvv("%s pool: %d job(s) queued" % (self.name, queued))
+        return job
+
+    def try_submit(self, target, *args):
+        """
+        Submit a job only if a worker is free to run it, returning None
+        rather than queueing it behind the running ones
+        """
+        try:
+            self.lock.acquire()
+            if self.outstanding >= self.workers:
+                self.refused += 1
+                return None
+            self.outstanding += 1
+        finally:
+            self.lock.release()
+        job = Job(target, args)
+        self.queue.put(job)
+        return job
+
+    def worker(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            try:
+                self.lock.acquire()
+                self.busy += 1
+            finally:
+                self.lock.release()
+            try:
+                job.run()
+            finally:
+                try:
+                    self.lock.acquire()
+                    self.busy -= 1
+                    self.outstanding -= 1
+                    self.completed += 1
+                finally:
+                    self.lock.release()
+
+    def stats(self):
+        try:
+            self.lock.acquire()
+            return dict(
+                workers=self.workers,
+                busy=self.busy,
+                queued=self.queue.qsize(),
+                max_queued=self.max_queued,
+                completed=self.completed,
+                refused=self.refused,
+            )
+        finally:
+            self.lock.release()
 
-    def join(self,timeout=None):
-        Thread.join(self, timeout=timeout)
-        return self._return
+    def stop(self):
+        for i in range(self.workers):
+            self.queue.put(None)
 
-class ThreadedTCPServer(SocketServer.ThreadingTCPServer):
+def python_interpreter(path):
+    """
+    Return the interpreter from the shebang line of a module if it is
+    a python module, or None otherwise
+    """
+    try:
+        fd = open(path, 'rb')
+        try:
+            line = fd.readline(1024)
+        finally:
+            fd.close()
+    except IOError:
+        return None
+    if not line.startswith('#!') or 'python' not in line:
+        return None
+    return line[2:].split()[0]
+
+def run_module_payload(module_path, args_path, environment):
+    """
+    Execute a python module in the current process, which is a child
+    forked from the fork server, returning (rc, stdout, stderr)
+    """
+    out_fd = tempfile.TemporaryFile()
+    err_fd = tempfile.TemporaryFile()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(out_fd.fileno(), sys.stdout.fileno())
+    os.dup2(err_fd.fileno(), sys.stderr.fileno())
+
+    rc = 0
+    try:
+        try:
+            os.environ.update(environment)
+            sys.argv = [module_path]
+            if args_path:
+                sys.argv.append(args_path)
+            source = open(module_path).read()
+            code = compile(source, module_path, 'exec')
+            module_globals = dict(__name__='__main__', __file__=module_path, __builtins__=__builtins__)
+            exec code in module_globals
+        except SystemExit, e:
+            if e.code is None:
+                rc = 0
+            elif isinstance(e.code, int):
+                rc = e.code
+            else:
+                sys.stderr.write("%s\n" % e.code)
+                rc = 1
+        except:
+            traceback.print_exc()
+            rc = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+    out_fd.seek(0)
+    err_fd.seek(0)
+    return (rc, out_fd.read(), err_fd.read())
+
+class ModuleRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Runs in a child forked from the fork server for each request, which
+    is a single line of json, and answers with the json module result
+    """
+    def handle(self):
+        try:
+            data = json.loads(self.rfile.readline())
+            (rc, stdout, stderr) = run_module_payload(data['module_path'], data.get('args_path'), data.get('environment') or {})
+            response = dict(rc=rc, stdout=stdout, stderr=stderr)
+        except:
+            response = dict(rc=1, stdout='', stderr=traceback.format_exc())
+        self.wfile.write(json.dumps(response))
+
+class ModuleForkServer(SocketServer.ForkingMixIn, SocketServer.UnixStreamServer):
+    # wake up regularly to reap children and notice the daemon exiting
+    timeout = 5
+
+def start_fork_server():
+    """
+    Fork a single threaded process which forks again for every module
+    request. Its children start with the interpreter and the standard
+    library modules the daemon uses already loaded, so python modules
+    don't pay for a fresh interpreter, although each payload still runs
+    its own copy of the module snippets. This has to be done before any
+    threads are started, since only the forking thread survives in the
+    child. Returns the pid of the fork server, or None if it could not be
+    started
+    """
+    if not prepare_socket_file(FORK_SOCKET_FILE):
+        return None
+
+    try:
+        server = ModuleForkServer(FORK_SOCKET_FILE, ModuleRequestHandler)
+    except socket.error, e:
+        log("could not create the fork server socket: %s" % e)
+        return None
+
+    parent = os.getpid()
+    try:
+        pid = os.fork()
+    except OSError, e:
+        log("could not fork the module fork server: %s" % e)
+        server.server_close()
+        return None
+
+    if pid > 0:
+        server.socket.close()
+        vv("started the module fork server with pid %s" % pid)
+        return pid
+
+    try:
+        try:
+            while os.getppid() == parent:
+                server.handle_request()
+        except:
+            log("the module fork server failed:\n%s" % traceback.format_exc())
+    finally:
+        os._exit(0)
+
+class ThreadedTCPServer(SocketServer.TCPServer):
     key_list = []
     last_event = datetime.now()
     last_event_lock = Lock()
-    def __init__(self, server_address, RequestHandlerClass, module, password, timeout, use_ipv6=False):
+    def __init__(self, server_address, RequestHandlerClass, module, password, timeout, use_ipv6=False, fork_server=None):
         self.module = module
-        self.key_list.append(AesKey.Read(password))
+        self.fork_server = fork_server
+        self.key_lock = Lock()
+        self.key_index = {}
+        self.key_headers = {}
+        self.key_last_used = {}
+        self.unencrypted_transfers = module.params.get('unencrypted_transfers', False)
+        self.connection_pool = WorkerPool('connection', int(module.params.get('max_connections', 64)))
+        self.command_pool = WorkerPool('command', int(module.params.get('max_commands', 16)))
+        self.primary_key = AesKey.Read(password)
+        self.add_key(self.primary_key)
         self.allow_reuse_address = True
         self.timeout = timeout
 
@@ -308,12 +595,135 @@ class ThreadedTCPServer(SocketServer.ThreadingTCPServer):
             self.local_thread = LocalSocketThread(kwargs=dict(server=self))
             self.local_thread.start()
 
-        SocketServer.ThreadingTCPServer.__init__(self, server_address, RequestHandlerClass)
+        SocketServer.TCPServer.__init__(self, server_address, RequestHandlerClass)
+
+    def key_header(self, key):
+        try:
+            return key.Header()[:KEY_HEADER_SIZE]
+        except:
+            # older keyczar versions may not expose the header, those
+            # keys are only found by trying them one after the other
+            return None
+
+    def add_key(self, key):
+        '''
+        Add a key to the key list, returning False if it was already there
+        '''
+        header = self.key_header(key)
+        try:
+            self.key_lock.acquire()
+            if header is not None and header in self.key_index:
+                # the header is only a four byte hash, so make sure it
+                # really is the same key before treating it as a duplicate
+                try:
+                    key.Decrypt(self.key_index[header].Encrypt("foo"))
+                    return False
+                except:
+                    pass
+            else:
+                for existing in self.key_list:
+                    if self.key_headers.get(id(existing)) is None:
+                        try:
+                            key.Decrypt(existing.Encrypt("foo"))
+                            return False
+                        except:
+                            pass
+            self.key_list.append(key)
+            if header is not None and header not in self.key_index:
+                self.key_index[header] = key
+            self.key_headers[id(key)] = header
+            self.key_last_used[id(key)] = datetime.now()
+            return True
+        finally:
+            self.key_lock.release()
+
+    def find_key(self, data):
+        '''
+        Find the key the data was encrypted with, returning a tuple of the
+        key and the decrypted data, or (None, None) if no key matches
+        '''
+        try:
+            self.key_lock.acquire()
+            # only keys which aren't reachable through the index (no
+            # header, or a header hash collision) need to be tried in turn
+            first = self.key_index.get(data[:KEY_HEADER_SIZE])
+            candidates = []
+            if first is not None:
+                candidates.append(first)
+            for key in self.key_list:
+                if key is not first and self.key_index.get(self.key_headers.get(id(key))) is not key:
+                    candidates.append(key)
+        finally:
+            self.key_lock.release()
+
+        for key in candidates:
+            try:
+                data = key.Decrypt(data)
+            except:
+                continue
+            self.touch_key(key)
+            return (key, data)
+        return (None, None)
+
+    def touch_key(self, key):
+        try:
+            self.key_lock.acquire()
+            self.key_last_used[id(key)] = datetime.now()
+        finally:
+            self.key_lock.release()
+
+    def evict_idle_keys(self, max_idle):
+        '''
+        Drop keys uploaded over the local socket which have not been used
+        for max_idle seconds. The key the daemon was started with is kept
+        '''
+        now = datetime.now()
+        try:
+            self.key_lock.acquire()
+            for key in self.key_list[:]:
+                if key is self.primary_key:
+                    continue
+                td = now - self.key_last_used.get(id(key), now)
+                if td.seconds + td.days * 24 * 3600 >= max_idle:
+                    vv("removing a key which has been idle for %d seconds" % td.seconds)
+                    self.key_list.remove(key)
+                    self.key_last_used.pop(id(key), None)
+                    header = self.key_headers.pop(id(key), None)
+                    if header is not None and self.key_index.get(header) is key:
+                        del self.key_index[header]
+        finally:
+            self.key_lock.release()
+
+    def process_request(self, request, client_address):
+        # hand the connection to the pool instead of starting a new
+        # thread for it, the way SocketServer.ThreadingMixIn would. A
+        # connection holds its worker until it is closed, so one that
+        # had to wait for a worker could wait forever
+        if self.connection_pool.try_submit(self.process_request_thread, request, client_address) is None:
+            log("refusing a connection from %s, all %d connection workers are in use" % (client_address[0], self.connection_pool.workers))
+            self.close_request(request)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+            self.close_request(request)
+        except:
+            self.handle_error(request, client_address)
+            self.close_request(request)
+
+    def stats(self):
+        return dict(
+            connections=self.connection_pool.stats(),
+            commands=self.command_pool.stats(),
+        )
 
     def shutdown(self):
-        self.local_thread.terminate()
+        if hasattr(self, 'local_thread'):
+            self.local_thread.terminate()
         self.running = False
-        SocketServer.ThreadingTCPServer.shutdown(self)
+        SocketServer.TCPServer.shutdown(self)
+        self.connection_pool.stop()
+        self.command_pool.stop()
 
 class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler):
     # the key to use for this connection
@@ -346,20 +756,25 @@ class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler):
                 return None
         vvvv("in recv_data(), got the header, unpacking")
         data_len = struct.unpack('!Q',data[:header_len])[0]
-        data = data[header_len:]
-        vvvv("data received so far (expecting %d): %d" % (data_len,len(data)))
-        while len(data) < data_len:
+        # binary transfer frames can be several MB, so collect the pieces
+        # and join them once rather than growing a string on every recv()
+        pieces = []
+        received = 0
+        vvvv("data received so far (expecting %d): %d" % (data_len,received))
+        while received < data_len:
             try:
-                d = self.request.recv(data_len - len(data))
+                d = self.request.recv(min(data_len - received, 1024*1024))
                 if not d:
                     vvv("received nothing, bailing out")
                     return None
-                data += d
-                vvvv("data received so far (expecting %d): %d" % (data_len,len(data)))
+                pieces.append(d)
+                received += len(d)
+                vvvv("data received so far (expecting %d): %d" % (data_len,received))
             except:
                 # probably got a connection reset
                 vvvv("exception received while waiting for recv(), returning None")
                 return None
+        data = "".join(pieces)
         vvvv("received all of the data, returning")
 
         try:
@@ -370,6 +785,53 @@ class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler):
 
         return data
 
+    def send_frame(self, chunk, last=False):
+        flags = 0
+        if last:
+            flags |= FRAME_LAST
+        data = self.active_key.Encrypt(struct.pack('!B', flags) + chunk)
+        return self.send_data(data)
+
+    def recv_frame(self):
+        '''
+        Receive a binary transfer frame, returning a tuple of the
+        chunk and whether it was the last frame, or None on failure
+        '''
+        data = self.recv_data()
+        if not data:
+            return None
+        data = self.active_key.Decrypt(data)
+        flags = struct.unpack('!B', data[:1])[0]
+        return (data[1:], bool(flags & FRAME_LAST))
+
+    def send_response(self, response):
+        data = json.dumps(response)
+        data = self.active_key.Encrypt(data)
+        return self.send_data(data)
+
+    def recv_response(self):
+        data = self.recv_data()
+        if not data:
+            return None
+        data = self.active_key.Decrypt(data)
+        return json.loads(data)
+
+    def get_transfer_params(self, data):
+        '''
+        Validate the chunk size and ACK window requested by the controller
+        for a binary transfer, returning (chunk_size, window) or None
+        '''
+        try:
+            chunk_size = int(data.get('chunk_size', CHUNK_SIZE))
+            window = int(data.get('window', 1))
+        except (TypeError, ValueError):
+            return None
+        if chunk_size < 1 or chunk_size > BINARY_MAX_CHUNK_SIZE:
+            return None
+        if window < 1 or window > BINARY_MAX_WINDOW:
+            return None
+        return (chunk_size, window)
+
     def handle(self):
         try:
             while True:
@@ -380,14 +842,8 @@ class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler):
                     break
                 vvvv("got data, decrypting")
                 if not self.active_key:
-                    for key in self.server.key_list:
-                        try:
-                            data = key.Decrypt(data)
-                            self.active_key = key
-                            break
-                        except:
-                            pass
-                    else:
+                    (self.active_key, data) = self.server.find_key(data)
+                    if not self.active_key:
                         vv("bad decrypt, exiting the connection handler")
                         return
                 else:
@@ -396,28 +852,24 @@ class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler):
                     except:
                         vv("bad decrypt, exiting the connection handler")
                         return
+                    self.server.touch_key(self.active_key)
 
                 vvvv("decryption done, loading json from the data")
                 data = json.loads(data)
 
                 mode = data['mode']
                 response = {}
-                last_pong = datetime.now()
-                if mode == 'command':
-                    vvvv("received a command request, running it")
-                    twrv = ThreadWithReturnValue(target=self.command, args=(data,))
-                    twrv.start()
-                    response = None
-                    while twrv.is_alive():
-                        if (datetime.now() - last_pong).seconds >= 15:
-                            last_pong = datetime.now()
-                            vvvv("command still running, sending keepalive packet")
-                            data2 = json.dumps(dict(pong=True))
-                            data2 = self.active_key.Encrypt(data2)
-                            self.send_data(data2)
-                        time.sleep(0.1)
-                    response = twrv._return
-                    vvvv("thread is done, response from join was %s" % response)
+                if mode in ('command', 'module'):
+                    vvvv("received a %s request, queueing it" % mode)
+                    if mode == 'command':
+                        job = self.server.command_pool.submit(self.command, data)
+                    else:
+                        job = self.server.command_pool.submit(self.run_module, data)
+                    while not job.wait(15):
+                        vvvv("command still running, sending keepalive packet")
+                        self.send_response(dict(pong=True))
+                    response = job.result
+                    vvvv("job is done, response was %s" % response)
                 elif mode == 'put':
                     vvvv("received a put request, putting it")
                     response = self.put(data)
@@ -427,6 +879,12 @@ class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler):
                 elif mode == 'validate_user':
                     vvvv("received a request to validate the user id")
                     response = self.validate_user(data)
+                elif mode == 'capabilities':
+                    vvvv("received a request for the daemon capabilities")
+                    response = self.capabilities(data)
+                elif mode == 'stats':
+                    vvvv("received a request for the worker pool stats")
+                    response = self.server.stats()
 
                 vvvv("response result is %s" % str(response))
                 json_response = json.dumps(response)
@@ -469,6 +927,20 @@ class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler):
         else:
             return dict(rc=1)
 
+    def capabilities(self, data):
+        # older daemons respond to unknown modes with an empty dict, so
+        # controllers can use this to decide whether binary transfers
+        # may be requested or they need to fall back to the json framing
+        transfer = ['json', 'binary']
+        if self.allow_raw_transfer():
+            transfer.append('raw')
+        return dict(
+            modes=['command', 'module', 'put', 'fetch', 'validate_user', 'capabilities', 'stats'],
+            transfer=transfer,
+            max_chunk_size=BINARY_MAX_CHUNK_SIZE,
+            max_window=BINARY_MAX_WINDOW,
+        )
+
     def command(self, data):
         if 'cmd' not in data:
             return dict(failed=True, msg='internal error: cmd is required')
@@ -492,10 +964,94 @@ class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler):
 
         return dict(rc=rc, stdout=stdout, stderr=stderr)
 
+    def run_module(self, data):
+        '''
+        Run a module which has already been put on the remote side. Python
+        modules using the same interpreter as the daemon are executed by a
+        child of the fork server, anything else is executed directly. As
+        with put, a user other than the one the daemon runs as is reached
+        through sudo, which the fork server children can't do
+        '''
+        if 'module_path' not in data:
+            return dict(failed=True, msg='internal error: module_path is required')
+        if 'tmp_path' not in data:
+            return dict(failed=True, msg='internal error: tmp_path is required')
+
+        module_path = data['module_path']
+        args_path = data.get('args_path')
+        environment = data.get('environment') or {}
+        user = data.get('user')
+        if user == getpass.getuser():
+            user = None
+
+        response = None
+        interpreter = python_interpreter(module_path)
+        if self.server.fork_server and not user and interpreter and \
+           os.path.realpath(interpreter) == os.path.realpath(sys.executable):
+            vvvv("running %s with the fork server" % module_path)
+            response = self.run_forked_module(module_path, args_path, environment)
+
+        if response is None:
+            vvvv("executing: %s" % module_path)
+            # other requests run in threads of this process, so the
+            # environment is passed through env rather than os.environ
+            cmd = []
+            if user:
+                vvv("the target user doesn't match this user, running the module via sudo")
+                cmd.extend(['sudo', '-n', '-H', '-u', user])
+            if environment:
+                cmd.append('env')
+                for (k, v) in environment.items():
+                    cmd.append('%s=%s' % (k, v))
+            cmd.append(module_path)
+            if args_path:
+                cmd.append(args_path)
+            rc, stdout, stderr = self.server.module.run_command(cmd, close_fds=True)
+            response = dict(rc=rc, stdout=stdout or '', stderr=stderr or '')
+
+        if data.get('cleanup', False):
+            tmp_path = data['tmp_path']
+            if os.path.basename(tmp_path.rstrip('/')).startswith('ansible-tmp-'):
+                shutil.rmtree(tmp_path, ignore_errors=True)
+
+        return response
+
+    def run_forked_module(self, module_path, args_path, environment):
+        '''
+        Send a module request to the fork server, returning None if the
+        fork server could not be reached
+        '''
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                s.connect(FORK_SOCKET_FILE)
+            except socket.error, e:
+                vv("could not connect to the fork server, running the module directly (%s)" % e)
+                return None
+            request = dict(module_path=module_path, args_path=args_path, environment=environment)
+            s.sendall(json.dumps(request) + '\n')
+            pieces = []
+            while True:
+                d = s.recv(65536)
+                if not d:
+                    break
+                pieces.append(d)
+        finally:
+            s.close()
+        try:
+            return json.loads("".join(pieces))
+        except ValueError:
+            return dict(rc=1, stdout='', stderr='the fork server child exited without a result')
+
     def fetch(self, data):
         if 'in_path' not in data:
             return dict(failed=True, msg='internal error: in_path is required')
 
+        if data.get('transfer') == 'binary':
+            return self.fetch_binary(data)
+        elif data.get('transfer') == 'raw':
+            return self.fetch_raw(data)
+
         try:
             fd = file(data['in_path'], 'rb')
             fstat = os.stat(data['in_path'])
@@ -531,12 +1087,150 @@ class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler):
         fd.close()
         return dict()
 
+    def fetch_binary(self, data):
+        '''
+        Stream the file as binary frames, after a header describing the
+        transfer. The controller ACKs every window frames and the last one
+        '''
+        params = self.get_transfer_params(data)
+        if params is None:
+            return dict(failed=True, msg='invalid chunk_size or window requested for a binary transfer')
+        (chunk_size, window) = params
+
+        try:
+            fd = open(data['in_path'], 'rb')
+        except IOError, e:
+            return dict(failed=True, stderr="Could not fetch the file: %s" % str(e))
+
+        try:
+            try:
+                fstat = os.fstat(fd.fileno())
+                vvv("FETCH file is %d bytes (binary, chunk_size=%d, window=%d)" % (fstat.st_size, chunk_size, window))
+                self.send_response(dict(transfer='binary', size=fstat.st_size, chunk_size=chunk_size, window=window))
+
+                frames = 0
+                while True:
+                    chunk = fd.read(chunk_size)
+                    # stop on a short read too, in case the file was
+                    # truncated after we stat'ed it
+                    last = not chunk or fd.tell() >= fstat.st_size
+                    self.send_frame(chunk, last)
+                    frames += 1
+
+                    if last or frames % window == 0:
+                        response = self.recv_response()
+                        if response is None:
+                            log("failed to get a response, aborting")
+                            return dict(failed=True, stderr="Failed to get a response from the master")
+                        if response.get('failed',False):
+                            log("got a failed response from the master")
+                            return dict(failed=True, stderr="Master reported failure, aborting transfer")
+                    if last:
+                        break
+            except Exception, e:
+                tb = traceback.format_exc()
+                log("failed to fetch the file: %s" % tb)
+                return dict(failed=True, stderr="Could not fetch the file: %s" % str(e))
+        finally:
+            fd.close()
+
+        return dict()
+
+    def allow_raw_transfer(self):
+        '''
+        Raw transfers skip payload encryption, so they are only allowed when
+        enabled on the daemon and the peer is the local end of a tunnel
+        '''
+        if not self.server.unencrypted_transfers:
+            return False
+        host = self.client_address[0]
+        if host.startswith('::ffff:'):
+            host = host[7:]
+        return host == '::1' or host.startswith('127.')
+
+    def send_file_body(self, fd, size):
+        '''
+        Send size bytes of the file to the socket without copying the
+        contents through python strings
+        '''
+        if size == 0:
+            return
+        sock = self.request
+        if hasattr(os, 'sendfile'):
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(sock.fileno(), fd.fileno(), offset, size - offset)
+                if sent == 0:
+                    raise IOError("the file was truncated while sending it")
+                offset += sent
+        else:
+            mm = mmap.mmap(fd.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                offset = 0
+                while offset < size:
+                    length = min(size - offset, BINARY_MAX_CHUNK_SIZE)
+                    sock.sendall(buffer(mm, offset, length))
+                    offset += length
+            finally:
+                mm.close()
+
+    def fetch_raw(self, data):
+        '''
+        Send a header describing the transfer followed by the unencrypted
+        file body, which the controller ACKs once it has all of it
+        '''
+        if not self.allow_raw_transfer():
+            return dict(failed=True, msg='unencrypted transfers are not enabled for this connection')
+
+        try:
+            fd = open(data['in_path'], 'rb')
+        except IOError, e:
+            return dict(failed=True, stderr="Could not fetch the file: %s" % str(e))
+
+        try:
+            try:
+                size = os.fstat(fd.fileno()).st_size
+                vvv("FETCH file is %d bytes (raw)" % size)
+                self.send_response(dict(transfer='raw', size=size))
+                self.send_file_body(fd, size)
+
+                # the body is not length prefixed, so update the idle
+                # time here the same way send_data() would
+                try:
+                    self.server.last_event_lock.acquire()
+                    self.server.last_event = datetime.now()
+                finally:
+                    self.server.last_event_lock.release()
+
+                response = self.recv_response()
+                if response is None:
+                    log("failed to get a response, aborting")
+                    return dict(failed=True, stderr="Failed to get a response from the master")
+                if response.get('failed',False):
+                    log("got a failed response from the master")
+                    return dict(failed=True, stderr="Master reported failure, aborting transfer")
+            except Exception, e:
+                tb = traceback.format_exc()
+                log("failed to fetch the file: %s" % tb)
+                return dict(failed=True, stderr="Could not fetch the file: %s" % str(e))
+        finally:
+            fd.close()
+
+        return dict()
+
     def put(self, data):
-        if 'data' not in data:
+        binary = data.get('transfer') == 'binary'
+        if 'data' not in data and not binary:
             return dict(failed=True, msg='internal error: data is required')
         if 'out_path' not in data:
             return dict(failed=True, msg='internal error: out_path is required')
 
+        if binary:
+            params = self.get_transfer_params(data)
+            if params is None:
+                return dict(failed=True, msg='invalid chunk_size or window requested for a binary transfer')
+            (chunk_size, window) = params
+
         final_path = None
         if 'user' in data and data.get('user') != getpass.getuser():
             vvv("the target user doesn't match this user, we'll move the file into place via sudo")
@@ -553,6 +1247,9 @@ class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler):
             out_path = data['out_path']
             out_fd = open(out_path, 'w')
 
+        if binary:
+            return self.put_binary(out_fd, out_path, final_path, chunk_size, window)
+
         try:
             bytes=0
             while True:
@@ -583,10 +1280,51 @@ class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler):
             self.server.module.atomic_move(out_path, final_path)
         return dict()
 
+    def put_binary(self, out_fd, out_path, final_path, chunk_size, window):
+        '''
+        Receive the file as binary frames. The request is answered first
+        so the controller knows the transfer was accepted, then an ACK is
+        sent every window frames and after the last one
+        '''
+        try:
+            bytes=0
+            frames=0
+            self.send_response(dict(transfer='binary', chunk_size=chunk_size, window=window))
+            while True:
+                frame = self.recv_frame()
+                if frame is None:
+                    raise Exception("failed to receive a frame")
+                (chunk, last) = frame
+                if len(chunk) > chunk_size:
+                    raise Exception("received a frame larger than the negotiated chunk size")
+                out_fd.write(chunk)
+                bytes += len(chunk)
+                frames += 1
+                if last or frames % window == 0:
+                    self.send_response(dict())
+                if last:
+                    break
+        except:
+            out_fd.close()
+            tb = traceback.format_exc()
+            log("failed to put the file: %s" % tb)
+            return dict(failed=True, stdout="Could not write the file")
+
+        vvvv("wrote %d bytes in %d frames" % (bytes, frames))
+        out_fd.close()
+
+        if final_path:
+            vvv("moving %s to %s" % (out_path, final_path))
+            self.server.module.atomic_move(out_path, final_path)
+        return dict()
+
 def daemonize(module, password, port, timeout, minutes, use_ipv6, pid_file):
     try:
         daemonize_self(module, password, port, minutes, pid_file)
 
+        # this must happen before any threads are started
+        fork_server = start_fork_server()
+
         def timer_handler(signum, _):
             try:
                 try:
@@ -602,6 +1340,8 @@ def daemonize(module, password, port, timeout, minutes, use_ipv6, pid_file):
                     else:
                         # reschedule the check
                         vvvv("daemon idle for %d seconds (timeout=%d)" % (total_seconds,minutes*60))
+                        vv("worker pool stats: %s" % server.stats())
+                        server.evict_idle_keys(minutes * 60)
                         signal.alarm(30)
                 except:
                     pass
@@ -618,7 +1358,7 @@ def daemonize(module, password, port, timeout, minutes, use_ipv6, pid_file):
                     address = ("::", port)
                 else:
                     address = ("0.0.0.0", port)
-                server = ThreadedTCPServer(address, ThreadedTCPRequestHandler, module, password, timeout, use_ipv6=use_ipv6)
+                server = ThreadedTCPServer(address, ThreadedTCPRequestHandler, module, password, timeout, use_ipv6=use_ipv6, fork_server=fork_server)
                 server.allow_reuse_address = True
                 break
             except Exception, e:
@@ -642,6 +1382,12 @@ def daemonize(module, password, port, timeout, minutes, use_ipv6, pid_file):
         # wait for the thread to exit fully
         server_thread.join()
 
+        if fork_server:
+            try:
+                os.kill(fork_server, signal.SIGTERM)
+            except OSError:
+                pass
+
         v("server thread terminated, exiting!")
         sys.exit(0)
     except Exception, e:
@@ -656,6 +1402,9 @@ def main():
             port=dict(required=False, default=5099),
             ipv6=dict(required=False, default=False, type='bool'),
             multi_key=dict(required=False, default=False, type='bool'),
+            max_connections=dict(required=False, default=64, type='int'),
+            max_commands=dict(required=False, default=16, type='int'),
+            unencrypted_transfers=dict(required=False, default=False, type='bool'),
             timeout=dict(required=False, default=300),
             password=dict(required=True),
             minutes=dict(required=False, default=30),
@@ -672,6 +1421,10 @@ def main():
     ipv6      = module.params['ipv6']
     multi_key = module.params['multi_key']
 
+    for option in ('max_connections', 'max_commands'):
+        if module.params[option] < 1:
+            module.fail_json(msg="%s must be at least 1" % option)
+
     if not HAS_KEYCZAR:
         module.fail_json(msg="keyczar is not installed (on the remote side)")
 